@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Benchmarks of chain resolution and execution, printed as JSON so runs of
+different versions can be compared:
+
+    python benchmarks/run.py --chains 5000 --resources 3 --hot-share 0.2 > before.json
+    python benchmarks/run.py --db postgres --pg-name bench > before_pg.json
+
+The data is generated from `--seed`, so the same arguments benchmark the same
+chains. Each benchmark runs against a throwaway test database.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOT_RESOURCES = 10
+
+
+def configure(args):
+    from django.conf import settings
+
+    if args.db == 'postgres':
+        database = {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': args.pg_name,
+            'HOST': args.pg_host,
+            'PORT': args.pg_port,
+            'USER': args.pg_user,
+            'PASSWORD': args.pg_password,
+        }
+    else:
+        database = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+
+    settings.configure(
+        DATABASES={'default': database},
+        INSTALLED_APPS=(
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'dispatcher',
+        ),
+        USE_TZ=True,
+        SECRET_KEY='benchmarks',
+        DISPATCHER_EVENTS={'BACKEND': args.events},
+    )
+
+    import django
+    django.setup()
+
+
+def generate(args):
+    """
+    (chain_type, rsc_mappings) of `args.chains` chains. Each has a unique
+    booking and `args.resources - 1` more resources, one of which is picked
+    among a few hot ones for `args.hot_share` of the chains.
+    """
+    rand = random.Random(args.seed)
+    items = []
+    for i in range(args.chains):
+        rsc_mappings = [('booking', str(i))]
+        for j in range(1, args.resources):
+            if j == 1 and rand.random() < args.hot_share:
+                rsc_mappings.append(('departure', str(rand.randrange(HOT_RESOURCES))))
+            else:
+                rsc_mappings.append(('resource_%s' % j, str(rand.randrange(args.chains * 10))))
+        items.append(('bench_chain', rsc_mappings))
+    return items
+
+
+def timings(func, calls):
+    """
+    Run `func` over `calls` and sum up how long each call took
+    """
+    durations = []
+    start = default_timer()
+    for call in calls:
+        call_start = default_timer()
+        func(call)
+        durations.append(default_timer() - call_start)
+    total = default_timer() - start
+
+    durations.sort()
+    return {
+        'ops': len(durations),
+        'seconds': round(total, 6),
+        'ops_per_second': round(len(durations) / total, 2) if total else None,
+        'p50_ms': round(durations[len(durations) // 2] * 1000, 4) if durations else None,
+        'p95_ms': round(durations[int(len(durations) * 0.95)] * 1000, 4) if durations else None,
+    }
+
+
+def run(args):
+    from django.db import connection
+
+    from dispatcher import Dispatcher, Transition
+    from dispatcher.constants import NEW
+    from dispatcher.models import Chain
+
+    class Invalid(Transition):
+        final_state = 'invalid'
+
+        def is_valid(self):
+            return False
+
+    class Started(Transition):
+        final_state = 'started'
+
+        def is_valid(self):
+            return True
+
+    dispatcher = Dispatcher({'chains': [{
+        'chain_type': 'bench_chain',
+        'transitions': {NEW: [Invalid, Started]},
+    }]})
+
+    rand = random.Random(args.seed)
+    items = generate(args)
+    sample = rand.sample(items, min(args.sample, len(items)))
+    results = {}
+
+    start = default_timer()
+    dispatcher.get_or_create_resource_chains(items)
+    results['bulk_create'] = {
+        'ops': len(items),
+        'seconds': round(default_timer() - start, 6),
+    }
+
+    results['resolve_exact'] = timings(
+        lambda item: dispatcher.get_or_create_resource_chain(*item),
+        sample,
+    )
+    # the booking and the next resource, a hot departure for `hot_share` of
+    # the chains, whose many rows the lookup has to go through
+    results['resolve_subset'] = timings(
+        lambda item: dispatcher.get_or_create_resource_chain(item[0], item[1][:2], can_be_subset=True),
+        sample,
+    )
+
+    chain_ids = rand.sample(list(Chain.objects.values_list('pk', flat=True)), len(sample))
+    chains = list(Chain.objects.filter(pk__in=chain_ids))
+    results['find_transition'] = timings(lambda chain: chain.find_transition(None), chains)
+    results['execute'] = timings(lambda chain: chain.execute(callback=lambda transition: None), chains)
+
+    return {
+        'python': platform.python_version(),
+        'django': __import__('django').get_version(),
+        'db': connection.vendor,
+        'params': {
+            'chains': args.chains,
+            'resources': args.resources,
+            'hot_share': args.hot_share,
+            'sample': args.sample,
+            'seed': args.seed,
+            'events': args.events,
+        },
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', choices=('sqlite', 'postgres'), default='sqlite')
+    parser.add_argument('--chains', type=int, default=2000)
+    parser.add_argument('--resources', type=int, default=3, help='Resources per chain')
+    parser.add_argument(
+        '--hot-share', type=float, default=0.2,
+        help='Share of the chains with one of %s hot resources' % HOT_RESOURCES,
+    )
+    parser.add_argument('--sample', type=int, default=500, help='Calls per benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--events', choices=('db', 'null'), default='db',
+        help='Event backend used while executing',
+    )
+    parser.add_argument('--pg-name', default=os.environ.get('PGDATABASE', 'dispatcher_bench'))
+    parser.add_argument('--pg-host', default=os.environ.get('PGHOST', 'localhost'))
+    parser.add_argument('--pg-port', default=os.environ.get('PGPORT', '5432'))
+    parser.add_argument('--pg-user', default=os.environ.get('PGUSER', ''))
+    parser.add_argument('--pg-password', default=os.environ.get('PGPASSWORD', ''))
+    args = parser.parse_args()
+
+    configure(args)
+
+    from django.db import connection
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        report = run(args)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
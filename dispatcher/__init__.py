@@ -1,4 +1,4 @@
-from dispatcher import Dispatcher
-from transition import Transition
+from .dispatcher import Dispatcher
+from .transition import Transition
 
-from constants import NEW, DONE
+from .constants import NEW, DONE
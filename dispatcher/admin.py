@@ -1,12 +1,48 @@
 import datetime
 
 from django.contrib import admin
+from django.core.paginator import Paginator
 from django.db import connections
+from django.forms.models import BaseInlineFormSet
+from django.utils import timezone
+from django.utils.functional import cached_property
 
 from .models import Chain, ChainResource, ChainEvent
+from .transition import to_datetime
 
-TODAY = datetime.datetime.utcnow()
-TOMORROW = TODAY + datetime.timedelta(days=1)
+# below this, counting the rows is cheap and the planner's estimate is off
+EXACT_COUNT_THRESHOLD = 10000
+
+EVENTS_SHOWN = 50
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses postgres' estimate of the table size instead of a `COUNT(*)` when
+    the whole table is paginated. Filtered changelists are still counted.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if getattr(queryset, 'query', None) is not None and not queryset.query.where:
+            estimate = self.estimate_count(queryset)
+            if estimate is not None and estimate > EXACT_COUNT_THRESHOLD:
+                return estimate
+        return super(EstimatedCountPaginator, self).count
+
+    def estimate_count(self, queryset):
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+        return row and int(row[0])
 
 
 class DateNextUpdateFilter(admin.SimpleListFilter):
@@ -21,7 +57,8 @@ class DateNextUpdateFilter(admin.SimpleListFilter):
         element is the human readable option.
         """
         return (
-            ('today', 'Today'),
+            ('due', 'Due'),
+            ('today', 'Later Today'),
             ('tomorrow', 'Tomorrow And Beyond'),
         )
 
@@ -30,10 +67,15 @@ class DateNextUpdateFilter(admin.SimpleListFilter):
         Return the filtered queryset based on the value provided by the query
         string
         """
-        if self.value() == 'today':
-            return queryset.filter(date_next_update__gt=TODAY).filter(date_next_update__lt=TOMORROW)
+        # relative to the request, not to when the process started
+        now = timezone.now()
+        tomorrow = to_datetime(timezone.localtime(now).date() + datetime.timedelta(days=1))
+        if self.value() == 'due':
+            return queryset.filter(date_next_update__lte=now)
+        elif self.value() == 'today':
+            return queryset.filter(date_next_update__gt=now, date_next_update__lt=tomorrow)
         elif self.value() == 'tomorrow':
-            return queryset.filter(date_next_update__gte=TOMORROW)
+            return queryset.filter(date_next_update__gte=tomorrow)
 
 
 class ChainResourceInline(admin.TabularInline):
@@ -43,23 +85,73 @@ class ChainResourceInline(admin.TabularInline):
     extra = 0
 
 
+class LatestEventsFormSet(BaseInlineFormSet):
+    """
+    Only the latest `EVENTS_SHOWN` events of the chain
+    """
+
+    def get_queryset(self):
+        if not hasattr(self, '_latest_events'):
+            self._latest_events = list(self.queryset.order_by('-pk')[:EVENTS_SHOWN])
+        return self._latest_events
+
+
 class ChainEventInLine(admin.TabularInline):
     model = ChainEvent
+    formset = LatestEventsFormSet
     fields = ('action', 'value', 'date_created', 'requested_by')
     readonly_fields = ('date_created', 'action', 'value', 'requested_by')
+    verbose_name_plural = 'Latest %s chain events' % EVENTS_SHOWN
     extra = 0
+    max_num = 0
+    can_delete = False
+
 
 class ChainAdmin(admin.ModelAdmin):
     list_display = ('state', 'chain_type', 'disabled', 'date_created', 'date_modified', 'date_next_update')
     list_filter = (DateNextUpdateFilter, 'chain_type', 'state')
-    ordering = ('-date_modified', )
+    # sorting millions of chains by an unindexed column is what makes the
+    # changelist slow, the newest chains come first instead
+    ordering = ('-pk', )
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
-    search_fields = ['resources__resource_id']
+    # `resource_type:resource_id` or a resource_id alone, matched exactly, or
+    # `id:<chain id>`. See `get_search_results`.
+    search_fields = ['resources__resource_type', 'resources__resource_id']
 
     inlines = [
         ChainResourceInline,
         ChainEventInLine,
     ]
 
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Exact lookups using the (resource_type, resource_id) index, through a
+        subquery so chains aren't duplicated by the join. A resource_id alone
+        matches it under any resource type, as the plain search did (without
+        the index). `id:123` is chain 123.
+        """
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+
+        if ':' not in search_term:
+            chain_ids = ChainResource.objects.filter(resource_id=search_term).values('chain_id')
+            return queryset.filter(pk__in=chain_ids), False
+
+        resource_type, resource_id = [part.strip() for part in search_term.split(':', 1)]
+        if resource_type == 'id':
+            if not resource_id.isdigit():
+                return queryset.none(), False
+            return queryset.filter(pk=int(resource_id)), False
+
+        chain_ids = ChainResource.objects.filter(
+            resource_type=resource_type,
+            resource_id=resource_id,
+        ).values('chain_id')
+        return queryset.filter(pk__in=chain_ids), False
+
 
 admin.site.register(Chain, ChainAdmin)
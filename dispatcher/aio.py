@@ -0,0 +1,311 @@
+"""
+asyncio execution path (python 3 only).
+
+Transitions whose checks and callbacks wait on remote services can subclass
+`AsyncTransition` and define `async def is_valid` (and optionally `async def
+callback`). `aexecute` runs a chain like `Chain.execute` does, without
+blocking the event loop, so many chains can be in flight on a single thread.
+
+Django's ORM is synchronous, the database steps (locking, saving, logging the
+event) are run in a thread pool.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from django.db import connections
+
+from .cache import MISSING, batch_scope, get_batch_scope, get_cache, in_batch_scope, make_key
+from .constants import DONE
+from .events import EventScope, buffered_events
+from .metrics import increment, timed
+from .models import PendingCallback
+from .scheduler import Scheduler
+from .transition import Transition
+
+
+class AsyncTransition(Transition):
+
+    is_async = True
+
+    async def is_valid(self):
+        raise NotImplementedError('%s has no `is_valid` function' % self)
+
+
+def cached_resource(resource_type, ttl=None):
+    """
+    `dispatcher.cache.cached_resource` for coroutine methods
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, resource_id):
+            if not in_batch_scope():
+                return await func(self, resource_id)
+
+            cache = get_cache()
+            key = make_key(resource_type, resource_id)
+            value = cache.get(key, MISSING)
+            if value is MISSING:
+                value = await func(self, resource_id)
+                cache.set(key, value, ttl)
+            return value
+        return wrapper
+    return decorator
+
+
+def _run_sync(executor, func, *args, events_scope=None):
+    """
+    Run `func` in the executor, within the loop's `batch_scope` if any and its
+    events buffered in `events_scope` if given. The events scope isn't bound
+    to the loop's thread, where it would apply to every coroutine on the loop.
+    """
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(
+        executor, functools.partial(_in_scope, get_batch_scope(), events_scope, func, *args))
+
+
+def _in_scope(batch, events_scope, func, *args):
+    with ExitStack() as stack:
+        if batch is not None:
+            stack.enter_context(batch_scope(batch))
+        if events_scope is not None:
+            stack.enter_context(buffered_events(events_scope))
+        return func(*args)
+
+
+async def _call(executor, func, *args, **kwargs):
+    """
+    Await coroutine functions, run regular functions in the executor
+    """
+    if asyncio.iscoroutinefunction(func):
+        return await func(*args, **kwargs)
+    return await _run_sync(executor, functools.partial(func, *args, **kwargs))
+
+
+async def _timed(name, labels, awaitable):
+    with timed(name, **labels):
+        return await awaitable
+
+
+def _check(executor, transition):
+    return _timed(
+        'dispatcher_is_valid_seconds',
+        transition.chain.metric_labels(transition),
+        _call(executor, transition.is_valid),
+    )
+
+
+async def afind_transition(chain, initial_context, executor=None, concurrent=False):
+    """
+    `Chain.find_transition`, awaiting asynchronous `is_valid` checks. With
+    `concurrent`, all the candidates' checks run at the same time.
+    """
+    chain._errors = {}
+    if chain.state == DONE:
+        # the transition with final_state==DONE
+        Transition = chain.graph.done_transition
+        return Transition and Transition(chain, initial_context)
+
+    transitions = [
+        Transition(chain, initial_context)
+        for Transition in chain.graph.get_transitions(chain.state)
+    ]
+    if concurrent:
+        checks = [
+            asyncio.ensure_future(_check(executor, transition))
+            for transition in transitions
+        ]
+    else:
+        checks = [_check(executor, transition) for transition in transitions]
+
+    try:
+        for transition, check in zip(transitions, checks):
+            if await check:
+                return transition
+            else:
+                # why did it not transition
+                chain.errors.update({str(transition): transition.errors})
+    finally:
+        for check in checks:
+            if not concurrent:
+                # coroutines never awaited
+                check.close()
+            elif not check.done():
+                check.cancel()
+            elif not check.cancelled():
+                # so a failed check after the returned one isn't reported as
+                # an exception never retrieved
+                check.exception()
+
+
+async def aexecute(chain, executor=None, events_scope=None, **kwargs):
+    """
+    Same as `Chain.execute`, taking the same arguments. The callback, either
+    on the transition or passed in, can be a coroutine function.
+
+    Args:
+        executor: `concurrent.futures.Executor` running the database steps
+            and synchronous transitions/callbacks, the loop's default executor
+            if not given
+        events_scope: `dispatcher.events.EventScope` buffering the events,
+            written by its owner
+    """
+    options = await _run_sync(executor, chain.start_execution, kwargs)
+
+    if events_scope is None and options['max_steps'] > 1:
+        events_scope = EventScope()
+        try:
+            return await _execute_steps(chain, options, executor, events_scope)
+        finally:
+            await _run_sync(executor, events_scope.flush)
+    return await _execute_steps(chain, options, executor, events_scope)
+
+
+async def _run_callback(chain, transition, options, executor):
+    callback = options['callback']
+    cb_kwargs = options['callback_kwargs']
+    with timed('dispatcher_callback_seconds', **chain.metric_labels(transition)):
+        if hasattr(transition, 'callback'):
+            logging.debug('Callback found on transition, executing with %s', cb_kwargs)
+            await _call(executor, transition.callback, **cb_kwargs)
+
+        elif callback:
+            logging.debug('Callback found, executing with %s', cb_kwargs)
+            await _call(executor, callback, transition, **cb_kwargs)
+
+        else:
+            logging.warning('Nothing configured to happen during execution')
+
+
+async def _execute_steps(chain, options, executor, events_scope=None):
+    taken = []
+    while True:
+        try:
+            transition = await afind_transition(
+                chain, options['initial_context'], executor, options['concurrent'])
+        except Exception:
+            logging.exception('Error while finding transition: %s', traceback.format_exc())
+            increment('dispatcher_errors_total', **chain.metric_labels())
+            await _run_sync(executor, chain.unlock, events_scope=events_scope)
+            raise Exception(traceback.format_exc())
+
+        if not transition and taken:
+            # stable
+            return await _run_sync(
+                executor, chain.run_results, taken[-1], len(taken), events_scope=events_scope)
+
+        if not chain.needs_callback(transition):
+            return await _run_sync(
+                executor, chain.finish_without_callback, transition, len(taken),
+                events_scope=events_scope)
+
+        try:
+            pending_callback = None
+            if options['outbox']:
+                pending_callback = PendingCallback.for_transition(transition, options)
+            else:
+                await _run_callback(chain, transition, options, executor)
+
+            taken.append(transition)
+            if chain.is_last_step(transition, len(taken), options['max_steps']):
+                return await _run_sync(
+                    executor, chain.finish_transition, transition, options['requested_by'],
+                    len(taken), pending_callback, events_scope=events_scope)
+
+            await _run_sync(
+                executor, chain.persist_transition, transition, options['requested_by'],
+                False, pending_callback, events_scope=events_scope)
+
+        except Exception:
+            logging.exception('Error executing chain: %s', traceback.format_exc())
+            increment('dispatcher_errors_total', **chain.metric_labels(transition))
+            await _run_sync(executor, chain.unlock, events_scope=events_scope)
+            raise Exception(traceback.format_exc())
+
+
+async def _close_connections(executor, workers):
+    """
+    Close the database connections of every thread in the executor. The
+    barrier makes sure each thread runs exactly one of these.
+    """
+    barrier = threading.Barrier(workers)
+
+    def close():
+        barrier.wait()
+        connections.close_all()
+
+    await asyncio.gather(*[_run_sync(executor, close) for _ in range(workers)])
+
+
+async def arun_chains(chains, concurrency=100, db_workers=10, **execute_kwargs):
+    """
+    Execute a batch of chains on the running event loop, with at most
+    `concurrency` of them in flight at once. Like `run_chains`, the
+    transitions' `prefetch` hooks are called first and the chain types'
+    limits are followed.
+
+    Args:
+        chains: chains to execute
+        concurrency: max number of chains executing at the same time
+        db_workers: size of the thread pool running the database steps
+        execute_kwargs: passed on to every `aexecute` call
+
+    Returns the same aggregated results as `dispatcher.runner.run_chains`.
+    """
+    from .runner import prefetch_transitions, summarize
+
+    chains = list(chains)
+    scheduler = Scheduler(chains, max_in_flight=concurrency)
+    changed = asyncio.Event()
+    executor = ThreadPoolExecutor(max_workers=db_workers)
+    events_scope = EventScope()
+    results = [None] * len(chains)
+
+    async def execute_one(i, chain):
+        try:
+            result = await aexecute(
+                chain, executor=executor, events_scope=events_scope, **dict(execute_kwargs))
+        except Exception as e:
+            logging.warning('Chain %s failed to execute: %s', chain.pk, e)
+            results[i] = {'chain_id': chain.pk, 'result': None, 'error': str(e)}
+        else:
+            results[i] = {'chain_id': chain.pk, 'result': result, 'error': None}
+        finally:
+            scheduler.done(chain)
+            changed.set()
+
+    async def dispatch():
+        tasks = []
+        while True:
+            item, wait = scheduler.next()
+            if item is not None:
+                tasks.append(asyncio.ensure_future(execute_one(*item)))
+                continue
+            if not scheduler.pending:
+                break
+            # until a chain is done, or a token is due
+            changed.clear()
+            try:
+                await asyncio.wait_for(changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+        await asyncio.gather(*tasks)
+
+    try:
+        with batch_scope():
+            await _run_sync(
+                executor, prefetch_transitions, chains, execute_kwargs.get('initial_context'))
+            try:
+                await dispatch()
+            finally:
+                # write what's left in the thread pool rather than on the loop
+                await _run_sync(executor, events_scope.flush)
+    finally:
+        await _close_connections(executor, db_workers)
+        executor.shutdown(wait=True)
+
+    return summarize(results, scheduler.waits())
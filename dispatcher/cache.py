@@ -0,0 +1,261 @@
+"""
+Cache shared across the chains of a batch run.
+
+Many chains point at the same booking or departure. Transitions can cache
+the methods loading those by id with `cached_resource`, so a resource used
+by thousands of chains in a batch is only loaded once:
+
+    class BookingPaid(Transition):
+
+        @cached_resource('booking')
+        def get_booking(self, booking_id):
+            return Booking.objects.get(pk=booking_id)
+
+Each batch run (`batch_scope`, entered by `run_chains`) has its own share of
+the cache, dropped when it ends. The methods aren't cached outside of a
+batch, nor in threads not working for it. The cached methods only take the
+resource's id, extra arguments raise a `TypeError`: the value is shared by
+every method cached under the same resource type. The backend is configured
+with `settings.DISPATCHER_CACHE`:
+
+    DISPATCHER_CACHE = {
+        'BACKEND': 'local',  # in-process LRU, or 'django' for django's cache framework
+        'TTL': 300,          # seconds
+        'MAX_SIZE': 10000,   # entries, local backend only
+        'ALIAS': 'default',  # django backend only
+    }
+
+`settings.DISPATCHER_CHAIN_CACHE`, configured the same way, enables a
+separate read-through cache of `Dispatcher.get_or_create_resource_chain`,
+see `get_chain_cache`. It isn't scoped to batch runs.
+"""
+import functools
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# distinguishes a cached None from a miss
+MISSING = object()
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_SIZE = 10000
+
+
+class LocalCache(object):
+    """
+    In-process cache evicting the least recently used entries past
+    `max_size`, and entries older than their ttl
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            if expires < time.time():
+                return default
+
+            # most recently used go last
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoCache(object):
+    """
+    Backed by one of django's caches, shared by every worker process.
+    Entries expire with their ttl, `clear` doesn't flush the django cache.
+    """
+
+    def __init__(self, alias='default', ttl=DEFAULT_TTL):
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(key, value, self.ttl if ttl is None else ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        pass
+
+
+BACKENDS = {
+    'local': LocalCache,
+    'django': DjangoCache,
+}
+
+_cache = None
+_chain_cache = MISSING
+# batch scopes in progress in the process, the cache is emptied when there
+# are none left
+_scopes = {'active': 0}
+_scopes_lock = threading.Lock()
+_local = threading.local()
+
+
+def build_cache(config):
+    config = dict(config)
+    backend = config.pop('BACKEND', 'local')
+    if backend not in BACKENDS:
+        raise ValueError('Invalid cache backend %s. Use one of %s' % (backend, tuple(BACKENDS)))
+
+    kwargs = {'ttl': config.pop('TTL', DEFAULT_TTL)}
+    if backend == 'local':
+        kwargs['max_size'] = config.pop('MAX_SIZE', DEFAULT_MAX_SIZE)
+    else:
+        kwargs['alias'] = config.pop('ALIAS', 'default')
+    return BACKENDS[backend](**kwargs)
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = build_cache(getattr(settings, 'DISPATCHER_CACHE', {}))
+    return _cache
+
+
+def set_cache(cache):
+    """
+    Use `cache` instead of the one configured in settings, `None` resets it
+    """
+    global _cache
+    _cache = cache
+
+
+def get_chain_cache():
+    """
+    The cache of the chains found by resources, None unless
+    `settings.DISPATCHER_CHAIN_CACHE` is set
+    """
+    global _chain_cache
+    if _chain_cache is MISSING:
+        config = getattr(settings, 'DISPATCHER_CHAIN_CACHE', None)
+        _chain_cache = build_cache(config) if config is not None else None
+    return _chain_cache
+
+
+def set_chain_cache(cache):
+    """
+    Use `cache` instead of the one configured in settings, `MISSING` resets
+    it and `None` disables it
+    """
+    global _chain_cache
+    _chain_cache = cache
+
+
+def make_chain_key(chain_type, resource_key):
+    return 'dispatcher:chain:%s:%s' % (chain_type, resource_key)
+
+
+class BatchScope(object):
+    """
+    A batch run's share of the cache: the keys of what it caches are
+    prefixed with its generation. Shared by the threads that joined it.
+    """
+
+    def __init__(self):
+        self.generation = uuid.uuid4().hex
+
+
+def get_batch_scope():
+    """
+    The `batch_scope` of the current thread, None outside of one
+    """
+    return getattr(_local, 'scope', None)
+
+
+def in_batch_scope():
+    return get_batch_scope() is not None
+
+
+@contextmanager
+def batch_scope(scope=None):
+    """
+    Whatever the current thread caches within the scope is shared by the
+    scope, and dropped when it's left. Nested scopes are part of the
+    outermost one.
+
+    Threads working for the scope join it by passing it, as yielded, as
+    `scope`. Other threads don't see it.
+    """
+    previous = get_batch_scope()
+    owner = scope is None and previous is None
+    if owner:
+        scope = BatchScope()
+        with _scopes_lock:
+            _scopes['active'] += 1
+    elif scope is None:
+        scope = previous
+
+    _local.scope = scope
+    try:
+        yield scope
+    finally:
+        _local.scope = previous
+        if owner:
+            with _scopes_lock:
+                _scopes['active'] -= 1
+                if not _scopes['active']:
+                    get_cache().clear()
+
+
+def make_key(resource_type, resource_id):
+    return 'dispatcher:%s:%s:%s' % (get_batch_scope().generation, resource_type, resource_id)
+
+
+def cached_resource(resource_type, ttl=None):
+    """
+    Cache a method loading a resource by id, its only argument. The value is
+    shared with every chain and every method cached under the same
+    `resource_type`. Outside of the current thread's `batch_scope` the method
+    isn't cached.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, resource_id):
+            if not in_batch_scope():
+                return func(self, resource_id)
+
+            cache = get_cache()
+            key = make_key(resource_type, resource_id)
+            value = cache.get(key, MISSING)
+            if value is MISSING:
+                value = func(self, resource_id)
+                cache.set(key, value, ttl)
+            return value
+        return wrapper
+    return decorator
@@ -1,7 +1,27 @@
 import json
 import requests
-import logging
-from constants import NEW
+from collections import OrderedDict
+from itertools import islice
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Q, prefetch_related_objects
+from django.utils import six, timezone
+
+from .constants import NEW
+from .graph import compile_config, register
+from .metrics import timed
+
+# keeps the number of bound parameters per query well below the limits of
+# the supported backends (sqlite caps at 999)
+BULK_QUERY_SIZE = 400
+
+
+def chunked(iterable, size=BULK_QUERY_SIZE):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 class Dispatcher:
@@ -11,22 +31,85 @@ class Dispatcher:
 
     def __init__(self, chain_config):
         self.config = chain_config
+        self._configs = {
+            _config.get('chain_type'): _config
+            for _config in chain_config.get('chains') or []
+        }
+        # compiled and validated once, every chain of a type shares its graph
+        self.graphs = compile_config(chain_config)
+        register(self.graphs)
+
+    def _attach_graph(self, chain):
+        """
+        Hand the chain this dispatcher's compiled config of its type, rather
+        than whichever was registered last
+        """
+        graph = self.graphs.get(chain.chain_type)
+        if graph is not None:
+            chain._graph = graph
+        return chain
 
     def _get_config(self, chain_type):
-        return next((
-            _config for _config in self.config.get('chains')
-            if _config.get('chain_type') == chain_type
-        ), None)
+        return self._configs.get(chain_type)
 
+    def _check_chain_type(self, chain_type):
+        if chain_type not in self.graphs:
+            raise ValueError("Couldn't find a configuration for chain_type: %s" % chain_type)
 
     def _clean_rsc_map(self, rsc_map):
         for r_type, r_id in rsc_map:
-            if not (isinstance(r_type, str) or isinstance(r_id, unicode)):
+            if not isinstance(r_type, six.string_types):
                 raise ValueError('Invalid resource_type. Use str')
 
-            if not (isinstance(r_id, str) or isinstance(r_id, unicode)):
+            if not isinstance(r_id, six.string_types):
                 raise ValueError('Invalid resource_id. Use str')
 
+    def _create_chain(self, chain_type, rsc_mappings):
+        """
+        Insert a chain and its resources, or return the one a concurrent
+        worker committed first for the same chain_type and resources.
+        """
+        from .models import Chain, ChainResource, make_resource_key
+
+        resource_key = make_resource_key(rsc_mappings)
+        try:
+            with transaction.atomic():
+                chain = Chain.objects.create(
+                    chain_type=chain_type,
+                    state=NEW,
+                    resource_key=resource_key,
+                )
+                ChainResource.objects.bulk_create([
+                    ChainResource(chain=chain, resource_type=r_type, resource_id=r_id)
+                    for r_type, r_id in set(rsc_mappings)
+                ])
+        except IntegrityError:
+            chain = Chain.objects.get(chain_type=chain_type, resource_key=resource_key)
+
+        return chain
+
+    def _subset_query(self, chain_type, rsc_mappings):
+        """
+        Chains of `chain_type` having all of `rsc_mappings` among their
+        resources. The matching is done in the database: the join is limited
+        to the provided resources and only chains matching every one of them
+        are kept.
+        """
+        from .models import Chain
+
+        provided_rsc_set = set(rsc_mappings)
+        lookup = Q()
+        for r_type, r_id in provided_rsc_set:
+            lookup |= Q(resources__resource_type=r_type, resources__resource_id=r_id)
+
+        return Chain.objects.filter(
+            chain_type=chain_type,
+        ).filter(lookup).annotate(
+            matched_resources=Count('resources'),
+        ).filter(
+            matched_resources=len(provided_rsc_set),
+        )
+
     def get_or_create_resource_chain(self, chain_type, rsc_mappings, can_be_subset=False):
         """
         Args:
@@ -63,59 +146,38 @@ class Dispatcher:
                     the chain will not match because chain.resources contains
                     resources the rsc_map does not contain
         """
-        from .models import Chain, ChainResource
+        self._check_chain_type(chain_type)
+        self._clean_rsc_map(rsc_mappings)
 
-        config = self._get_config(chain_type)
+        match = 'subset' if can_be_subset else 'exact'
+        with timed('dispatcher_resolve_seconds', chain_type=chain_type, match=match):
+            chain = self._get_or_create_resource_chain(chain_type, rsc_mappings, can_be_subset)
+        return self._attach_graph(chain)
 
-        if not config:
-            raise ValueError("Couldn't find a configuration for chain_type: %s" % chain_type)
+    def _get_or_create_resource_chain(self, chain_type, rsc_mappings, can_be_subset):
+        from .models import Chain, cache_chain, get_cached_chain, make_resource_key
 
-        self._clean_rsc_map(rsc_mappings)
-
-        # this is an attempt at an AND statement with
-        # a variety related objects (chain resources)
-        # We want to find a chain that has all the resources
-        # present (if more resources, we don't care)
-        found_chains = {}
-        query = """
-        SELECT
-            DISTINCT chain.*
-        FROM
-            dispatcher_chain chain,
-            dispatcher_chainresource rsc
-        WHERE
-            chain.id = rsc.chain_id AND
-            (rsc.resource_type, rsc.resource_id) IN %s
-        """
-        found_chains = []
-
-        # there's a silly thing where tuples, when singular,
-        # have a trailing ',', stringifying to '((),)', which
-        # is invalid for postgres lookups
-        # it only happens when there's only one argument, but it's
-        # safe to always remove it
-        sql_args = tuple((str(rsc_type), str(rsc_id)) for rsc_type, rsc_id in rsc_mappings)
-        sql_args_str = str(sql_args).replace('),)', '))')
+        if not can_be_subset:
+            resource_key = make_resource_key(rsc_mappings)
+            chain = get_cached_chain(chain_type, resource_key)
+            if chain is not None:
+                return chain
 
-        provided_rsc_set = set(rsc_mappings)
-        chains = Chain.objects.raw(query % sql_args_str)
-        for chain in chains:
-            chain_rsc_set = {
-                (rsc.resource_type, rsc.resource_id)
-                for rsc in chain.resources.all()
-            }
+            # exact matches are a single probe on the (chain_type, resource_key)
+            # unique index
+            chain = Chain.objects.filter(
+                chain_type=chain_type,
+                resource_key=resource_key,
+            ).first()
+            if chain is None:
+                chain = self._create_chain(chain_type, rsc_mappings)
 
-            # compare only exactly the specified resources
-            logging.info('Resources provided %s | resources found %s', provided_rsc_set, chain_rsc_set)
-            logging.info('Exact match %s', chain_rsc_set == provided_rsc_set)
-            if can_be_subset is False and chain_rsc_set == provided_rsc_set:
-                found_chains.append(chain)
+            cache_chain(chain)
+            return chain
 
-            # the resource provided can be a subset, but all the
-            # provided ones have to be present
-            logging.info('Subset result %s', not provided_rsc_set - chain_rsc_set)
-            if can_be_subset and not provided_rsc_set - chain_rsc_set:
-                found_chains.append(chain)
+        # the chain has to have all the provided resources, any others it
+        # has are ignored
+        found_chains = list(self._subset_query(chain_type, rsc_mappings)[:2])
 
         if len(found_chains) > 1:
             raise ValueError('More than 1 chain found with %s', rsc_mappings)
@@ -124,19 +186,266 @@ class Dispatcher:
             chain = found_chains[0]
 
         else:
-            chain = Chain(
-                chain_type=chain_type,
-                state=NEW,
-            )
-            chain.save()
-            for r_type, r_id in rsc_mappings:
-                chain_rsc = ChainResource(
-                    chain=chain,
-                    resource_type=r_type,
-                    resource_id=r_id,
+            chain = self._create_chain(chain_type, rsc_mappings)
+
+        return chain
+
+    def get_or_create_resource_chains(self, items, can_be_subset=False):
+        """
+        Bulk version of `get_or_create_resource_chain`.
+
+        Args:
+            items: list of (chain_type, rsc_mappings) tuples
+                [
+                    ('chain_type1', [(resource_type1, resource_id1)]),
+                    ('chain_type1', [(resource_type1, resource_id2)]),
+                ]
+            can_be_subset: the matching algorithm, see
+                `get_or_create_resource_chain`
+
+        Returns the chains in the same order as `items`. Matches for the whole
+        batch are fetched together and missing chains (and their resources)
+        are created with bulk inserts. Items sharing the same chain_type and
+        resources resolve to the same chain.
+        """
+        from .models import Chain, make_resource_key
+
+        items = [
+            (chain_type, [tuple(rsc) for rsc in rsc_mappings])
+            for chain_type, rsc_mappings in items
+        ]
+        chain_types = set()
+        for chain_type, rsc_mappings in items:
+            if chain_type not in chain_types:
+                self._check_chain_type(chain_type)
+                chain_types.add(chain_type)
+            self._clean_rsc_map(rsc_mappings)
+
+        keys = [(chain_type, make_resource_key(rsc_mappings)) for chain_type, rsc_mappings in items]
+
+        if can_be_subset:
+            found = self._find_subset_chains(items)
+        else:
+            found = {}
+            for key_chunk in chunked({resource_key for _, resource_key in keys}):
+                chains = Chain.objects.filter(
+                    chain_type__in=list(chain_types),
+                    resource_key__in=key_chunk,
                 )
-                chain_rsc.save()
+                found.update(((chain.chain_type, chain.resource_key), chain) for chain in chains)
 
-        chain.transitions = config.get('transitions')
+        missing = OrderedDict()
+        # with can_be_subset, items matching a chain created for an earlier
+        # item, as if they were resolved one by one
+        created_for = {}
+        missing_by_rsc = {}
+        for key, (chain_type, rsc_mappings) in zip(keys, items):
+            if key in found or key in missing or key in created_for:
+                continue
 
-        return chain
+            if can_be_subset:
+                supersets = set.intersection(*[
+                    missing_by_rsc.get((chain_type, rsc), set()) for rsc in set(rsc_mappings)
+                ]) if rsc_mappings else set()
+                if len(supersets) > 1:
+                    raise ValueError('More than 1 chain found with %s', rsc_mappings)
+                elif supersets:
+                    created_for[key] = supersets.pop()
+                    continue
+
+                for rsc in set(rsc_mappings):
+                    missing_by_rsc.setdefault((chain_type, rsc), set()).add(key)
+            missing[key] = rsc_mappings
+
+        if missing:
+            found.update(self._create_chains(missing))
+        for key, other_key in created_for.items():
+            found[key] = found[other_key]
+
+        return [self._attach_graph(found[key]) for key in keys]
+
+    def notify(self, resource_type, resource_id, chain_types=None, requested_by=''):
+        """
+        A resource changed: make the chains referencing it due now and put
+        them on the work queue, for workers to execute them right away (see
+        `Chain.objects.claim_queued` and `dispatcher_run --queue`) instead of
+        waiting for their next scheduled update.
+
+        Args:
+            resource_type, resource_id: the resource that changed
+            chain_types: only notify chains of these types, defaults to the
+                ones configured on this dispatcher
+            requested_by: recorded on the queue
+
+        Returns the number of chains notified, whether this call queued them
+        or they were queued already.
+        """
+        from .models import Chain, ChainResource, QueuedChain
+
+        chain_ids = set(ChainResource.objects.filter(
+            resource_type=resource_type,
+            resource_id=str(resource_id),
+            chain__chain_type__in=list(chain_types or self.graphs),
+            chain__disabled=False,
+        ).values_list('chain_id', flat=True))
+        if not chain_ids:
+            return 0
+
+        now = timezone.now()
+        queued = 0
+        for id_chunk in chunked(chain_ids):
+            Chain.objects.filter(pk__in=id_chunk, date_next_update__gt=now).update(
+                date_next_update=now)
+
+            already_queued = set(
+                QueuedChain.objects.filter(chain__in=id_chunk).values_list('chain_id', flat=True))
+            new_items = [
+                QueuedChain(chain_id=chain_id, requested_by=requested_by)
+                for chain_id in id_chunk if chain_id not in already_queued
+            ]
+            try:
+                with transaction.atomic():
+                    QueuedChain.objects.bulk_create(new_items)
+            except IntegrityError:
+                # another notification queued some of them meanwhile
+                for item in new_items:
+                    QueuedChain.objects.get_or_create(
+                        chain_id=item.chain_id, defaults={'requested_by': requested_by})
+            queued += len(id_chunk)
+
+        return queued
+
+    def iter_chains_for_resources(self, rsc_mappings, chain_type=None, state=None,
+                                  chunk_size=BULK_QUERY_SIZE):
+        """
+        Iterate over the chains referencing any of the resources, by id, with
+        their resources prefetched.
+
+        The chains are read from a server side cursor where the backend
+        supports it, and their resources loaded `chunk_size` chains at a time,
+        so going through all the chains of a popular resource takes constant
+        memory.
+
+        Args:
+            rsc_mappings: list of resource_type, resource_id tuples
+            chain_type: only chains of this type
+            state: only chains in this state
+        """
+        from .models import Chain, ChainResource
+
+        self._clean_rsc_map(rsc_mappings)
+        if not rsc_mappings:
+            raise ValueError('No resources to look up chains for')
+
+        lookup = Q()
+        for r_type, r_id in set(rsc_mappings):
+            lookup |= Q(resource_type=r_type, resource_id=r_id)
+
+        chains = Chain.objects.filter(
+            pk__in=ChainResource.objects.filter(lookup).values('chain_id'),
+        )
+        if chain_type is not None:
+            chains = chains.filter(chain_type=chain_type)
+        if state is not None:
+            chains = chains.filter(state=state)
+
+        return self._iter_prefetched(chains.order_by('pk').iterator(), chunk_size)
+
+    def _iter_prefetched(self, chains, chunk_size):
+        for chunk in chunked(chains, chunk_size):
+            prefetch_related_objects(chunk, 'resources')
+            for chain in chunk:
+                yield self._attach_graph(chain)
+
+    def _find_subset_chains(self, items):
+        """
+        Returns {(chain_type, resource_key): chain} for every item that has a
+        chain containing all of its resources.
+        """
+        from .models import Chain, ChainResource, make_resource_key
+
+        chain_types = list({chain_type for chain_type, _ in items})
+        requested = {rsc for _, rsc_mappings in items for rsc in rsc_mappings}
+
+        # only the rows for the requested resources are loaded, whatever
+        # other resources the chains have don't matter for a subset match
+        matched_rsc_sets = {}
+        for rsc_chunk in chunked(requested):
+            lookup = Q()
+            for r_type, r_id in rsc_chunk:
+                lookup |= Q(resource_type=r_type, resource_id=r_id)
+            rscs = ChainResource.objects.filter(
+                chain__chain_type__in=chain_types,
+            ).filter(lookup).values_list(
+                'chain_id', 'chain__chain_type', 'resource_type', 'resource_id',
+            )
+            for chain_id, chain_type, r_type, r_id in rscs:
+                matched_rsc_sets.setdefault(chain_id, (chain_type, set()))[1].add((r_type, r_id))
+
+        chains_by_rsc = {}
+        for chain_id, (chain_type, rsc_set) in matched_rsc_sets.items():
+            for rsc in rsc_set:
+                chains_by_rsc.setdefault((chain_type, rsc), set()).add(chain_id)
+
+        found_ids = {}
+        for chain_type, rsc_mappings in items:
+            provided_rsc_set = set(rsc_mappings)
+            candidates = set()
+            for rsc in provided_rsc_set:
+                candidates |= chains_by_rsc.get((chain_type, rsc), set())
+
+            found_chains = [
+                chain_id for chain_id in candidates
+                if not provided_rsc_set - matched_rsc_sets[chain_id][1]
+            ]
+
+            if len(found_chains) > 1:
+                raise ValueError('More than 1 chain found with %s', rsc_mappings)
+
+            elif found_chains:
+                found_ids[(chain_type, make_resource_key(rsc_mappings))] = found_chains[0]
+
+        chains = {}
+        for id_chunk in chunked(set(found_ids.values())):
+            chains.update((chain.pk, chain) for chain in Chain.objects.filter(pk__in=id_chunk))
+
+        found = {key: chains[chain_id] for key, chain_id in found_ids.items()}
+        return found
+
+    def _create_chains(self, missing):
+        """
+        Bulk insert chains and their resources.
+
+        Args:
+            missing: ordered mapping of (chain_type, resource_key) to rsc_mappings
+
+        Returns {(chain_type, resource_key): chain}. Should another worker
+        commit any of the same chains first, every chain is upserted one by one
+        instead.
+        """
+        from .models import Chain, ChainResource
+
+        new_chains = [
+            Chain(chain_type=chain_type, state=NEW, resource_key=resource_key)
+            for chain_type, resource_key in missing
+        ]
+        try:
+            with transaction.atomic():
+                if connection.features.can_return_ids_from_bulk_insert:
+                    new_chains = Chain.objects.bulk_create(new_chains)
+                else:
+                    for chain in new_chains:
+                        chain.save()
+
+                ChainResource.objects.bulk_create([
+                    ChainResource(chain=chain, resource_type=r_type, resource_id=r_id)
+                    for rsc_mappings, chain in zip(missing.values(), new_chains)
+                    for r_type, r_id in set(rsc_mappings)
+                ])
+        except IntegrityError:
+            return {
+                key: self._create_chain(key[0], rsc_mappings)
+                for key, rsc_mappings in missing.items()
+            }
+
+        return dict(zip(missing, new_chains))
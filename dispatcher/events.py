@@ -0,0 +1,265 @@
+"""
+Where the chains' events (`Chain.log_event`) are written.
+
+By default every event is saved to the `ChainEvent` table right away, in the
+transaction persisting the transition. Within `buffered_events` (entered by
+`run_chains`) the events of the current thread are buffered instead and
+written in bulk, once `BATCH_SIZE` events are pending or `FLUSH_INTERVAL`
+seconds passed, and when the scope is left. Other threads aren't affected,
+unless they join the scope with `buffered_events(scope)`, as the workers of a
+batch run do. Events still buffered when a worker dies are lost.
+
+The backend is configured with `settings.DISPATCHER_EVENTS`:
+
+    DISPATCHER_EVENTS = {
+        'BACKEND': 'db',         # ChainEvent table, 'jsonl' for a local file or 'null'
+        'BATCH_SIZE': 500,       # events
+        'FLUSH_INTERVAL': 5,     # seconds
+        'PATH': 'events.jsonl',  # jsonl backend only
+        # chain types writing their events elsewhere
+        'CHAIN_TYPES': {
+            'noisy_chain': {'BACKEND': 'jsonl', 'PATH': '/var/log/noisy_chain.jsonl'},
+        },
+    }
+"""
+import io
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+
+from django.conf import settings
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 5
+
+
+class EventSink(object):
+    """
+    Writes events with `write`, implemented by the backends, in bulk within
+    `buffered_events`
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+    def make_event(self, chain, action, value, requested_by):
+        return {
+            'chain_id': chain.pk,
+            'chain_type': chain.chain_type,
+            'action': action,
+            'value': value,
+            'requested_by': requested_by,
+            'date_created': date.today().isoformat(),
+        }
+
+    def emit(self, chain, action, value, requested_by):
+        event = self.make_event(chain, action, value, requested_by)
+        scope = get_event_scope()
+        if scope is None:
+            self.write([event])
+        else:
+            scope.add(self, event)
+
+    def write(self, events):
+        raise NotImplementedError('%s has no `write` function' % self.__class__.__name__)
+
+
+class EventScope(object):
+    """
+    The events buffered within a `buffered_events` scope, per sink. Shared by
+    the threads that joined the scope.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self._last_flush = {}
+        self._lock = threading.Lock()
+
+    def add(self, sink, event):
+        with self._lock:
+            events = self._buffers.setdefault(sink, [])
+            events.append(event)
+            last_flush = self._last_flush.setdefault(sink, time.time())
+            flush = (
+                len(events) >= sink.batch_size or
+                time.time() - last_flush >= sink.flush_interval
+            )
+        if flush:
+            self.flush(sink)
+
+    def flush(self, sink=None):
+        """
+        Write what's pending for `sink`, or for every sink
+        """
+        with self._lock:
+            sinks = [sink] if sink is not None else list(self._buffers)
+            pending = [(s, self._buffers.pop(s, [])) for s in sinks]
+            for s in sinks:
+                self._last_flush[s] = time.time()
+        for s, events in pending:
+            if events:
+                s.write(events)
+
+
+class DatabaseSink(EventSink):
+
+    def make_event(self, chain, action, value, requested_by):
+        from .models import ChainEvent
+
+        return ChainEvent(
+            chain_id=chain.pk,
+            action=action,
+            value=value,
+            requested_by=requested_by,
+        )
+
+    def write(self, events):
+        from .models import ChainEvent
+
+        ChainEvent.objects.bulk_create(events, batch_size=self.batch_size)
+
+
+class JSONLSink(EventSink):
+    """
+    Appends the events to a file, one json object per line
+    """
+
+    def __init__(self, path, **kwargs):
+        super(JSONLSink, self).__init__(**kwargs)
+        self.path = path
+        self._file_lock = threading.Lock()
+
+    def write(self, events):
+        lines = u''.join(u'%s\n' % json.dumps(event, sort_keys=True) for event in events)
+        with self._file_lock:
+            with io.open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+
+
+class NullSink(EventSink):
+    """
+    Drops the events, for benchmarks
+    """
+
+    def emit(self, chain, action, value, requested_by):
+        pass
+
+    def write(self, events):
+        pass
+
+
+BACKENDS = {
+    'db': DatabaseSink,
+    'jsonl': JSONLSink,
+    'null': NullSink,
+}
+
+# chain_type (None for the default) -> sink
+_sinks = {}
+_sinks_lock = threading.Lock()
+# the scope of the current thread, see `buffered_events`
+_local = threading.local()
+
+
+def build_sink(config):
+    config = dict(config)
+    config.pop('CHAIN_TYPES', None)
+    backend = config.pop('BACKEND', 'db')
+    if backend not in BACKENDS:
+        raise ValueError('Invalid event backend %s. Use one of %s' % (backend, tuple(BACKENDS)))
+
+    kwargs = {
+        'batch_size': config.pop('BATCH_SIZE', DEFAULT_BATCH_SIZE),
+        'flush_interval': config.pop('FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+    }
+    if backend == 'jsonl':
+        if not config.get('PATH'):
+            raise ValueError('The jsonl event backend needs a PATH')
+        kwargs['path'] = config.pop('PATH')
+    return BACKENDS[backend](**kwargs)
+
+
+def get_sink(chain_type=None):
+    """
+    The sink of `chain_type`'s events, the default one unless configured in
+    `CHAIN_TYPES`
+    """
+    with _sinks_lock:
+        if chain_type in _sinks:
+            return _sinks[chain_type]
+
+        config = getattr(settings, 'DISPATCHER_EVENTS', {})
+        chain_types = config.get('CHAIN_TYPES') or {}
+        if chain_type is not None and chain_type not in chain_types:
+            sink = _sinks.get(None) or build_sink(config)
+            _sinks[None] = sink
+        else:
+            sink = build_sink(chain_types.get(chain_type, config))
+        _sinks[chain_type] = sink
+        return sink
+
+
+def set_sink(sink, chain_type=None):
+    """
+    Use `sink` instead of the one configured in settings. `set_sink(None)`
+    resets all of them.
+    """
+    with _sinks_lock:
+        if chain_type is None:
+            # chain types without their own sink share the default one
+            _sinks.clear()
+        else:
+            _sinks.pop(chain_type, None)
+        if sink is not None:
+            _sinks[chain_type] = sink
+
+
+def get_event_scope():
+    return getattr(_local, 'scope', None)
+
+
+def flush_events():
+    """
+    Write the events buffered in the current thread's scope
+    """
+    scope = get_event_scope()
+    if scope is not None:
+        scope.flush()
+
+
+def is_buffering():
+    return get_event_scope() is not None
+
+
+@contextmanager
+def buffered_events(scope=None):
+    """
+    Within the scope, the events emitted by the current thread are buffered
+    and written in bulk. Whatever is still pending is written when the
+    outermost scope is left.
+
+    Threads working for the scope join it by passing it, as yielded, as
+    `scope`. What they buffer is written by whoever started the scope.
+    """
+    previous = get_event_scope()
+    owner = scope is None and previous is None
+    if owner:
+        scope = EventScope()
+    elif scope is None:
+        scope = previous
+
+    _local.scope = scope
+    try:
+        yield scope
+    finally:
+        _local.scope = previous
+        if owner:
+            try:
+                scope.flush()
+            except Exception:
+                logging.exception('Failed to write the buffered chain events')
+                raise
@@ -0,0 +1,122 @@
+import logging
+from collections import deque
+
+from django.utils import six
+
+from .constants import NEW, DONE
+from .scheduler import ChainTypeLimits
+
+# chain_type -> ChainGraph, for the chains loaded from the database rather
+# than returned by a `Dispatcher`, which hands out its own graphs
+_graphs = {}
+
+
+class ChainGraph(object):
+    """
+    A chain_type's transitions config, compiled once: the candidate
+    transitions of each state as tuples and the transition leading to DONE,
+    and how batch runs may execute its chains (see `dispatcher.scheduler`).
+    """
+
+    def __init__(self, chain_type, transitions, limits=None):
+        self.chain_type = chain_type
+        self.limits = limits or ChainTypeLimits()
+        self.transitions = {
+            state: tuple(candidates or ())
+            for state, candidates in transitions.items()
+        }
+        self.done_transition = next((
+            T for state in self.states()
+            for T in self.transitions.get(state, ())
+            if getattr(T, 'final_state', None) == DONE
+        ), None)
+
+    def __repr__(self):
+        return '<ChainGraph: %s>' % self.chain_type
+
+    def same_config(self, other):
+        return (
+            self.chain_type == other.chain_type and
+            self.transitions == other.transitions and
+            vars(self.limits) == vars(other.limits)
+        )
+
+    def get_transitions(self, state):
+        return self.transitions.get(state, ())
+
+    def states(self):
+        """
+        The configured states, breadth first from NEW, followed by any that
+        can't be reached from it
+        """
+        reachable = self._reachable_states()
+        return reachable + sorted(set(self.transitions) - set(reachable))
+
+    def _reachable_states(self):
+        states = []
+        queue = deque([NEW])
+        while queue:
+            state = queue.popleft()
+            if state in states:
+                continue
+            states.append(state)
+            queue.extend(
+                T.final_state for T in self.transitions.get(state, ())
+                if isinstance(getattr(T, 'final_state', None), six.string_types)
+            )
+        return states
+
+    def validate(self):
+        if NEW not in self.transitions:
+            raise ValueError('%r has no transitions from %s' % (self, NEW))
+
+        for candidates in self.transitions.values():
+            for T in candidates:
+                if not isinstance(getattr(T, 'final_state', None), six.string_types):
+                    raise ValueError('%r: %s has no `final_state`' % (self, T))
+
+        unreachable = set(self.transitions) - set(self._reachable_states())
+        if unreachable:
+            raise ValueError('%r: %s can never be reached from %s' % (
+                self, ', '.join(sorted(unreachable)), NEW))
+
+
+def compile_config(config):
+    """
+    Compile and validate a dispatcher config, returns {chain_type: ChainGraph}
+    """
+    graphs = {}
+    for chain_config in config.get('chains') or []:
+        chain_type = chain_config.get('chain_type')
+        if not chain_type:
+            raise ValueError('Chain config without a chain_type: %s' % chain_config)
+
+        if chain_type in graphs:
+            raise ValueError('chain_type %s is configured more than once' % chain_type)
+
+        graph = ChainGraph(
+            chain_type,
+            chain_config.get('transitions') or {},
+            limits=ChainTypeLimits.from_config(chain_config),
+        )
+        graph.validate()
+        graphs[chain_type] = graph
+
+    return graphs
+
+
+def register(graphs):
+    """
+    Make `graphs` the fallback of the chains of their types. Registering a
+    chain_type again with another config replaces it, the chains returned by
+    a `Dispatcher` keep their own graph either way.
+    """
+    for chain_type, graph in graphs.items():
+        registered = _graphs.get(chain_type)
+        if registered is not None and not registered.same_config(graph):
+            logging.warning('chain_type %s registered again with another config, replacing it', chain_type)
+    _graphs.update(graphs)
+
+
+def get_graph(chain_type):
+    return _graphs.get(chain_type)
@@ -0,0 +1,156 @@
+import gzip
+import json
+from collections import OrderedDict
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from dispatcher.models import ChainEvent
+
+ARCHIVED = 'archived_events'
+
+EVENT_FIELDS = (
+    'pk', 'chain_id', 'chain__chain_type', 'action', 'value', 'requested_by', 'date_created',
+)
+
+
+def serialize_event(event):
+    return json.dumps({
+        'id': event['pk'],
+        'chain_id': event['chain_id'],
+        'chain_type': event['chain__chain_type'],
+        'action': event['action'],
+        'value': event['value'],
+        'requested_by': event['requested_by'],
+        'date_created': event['date_created'].isoformat(),
+    }, sort_keys=True)
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Archive chain events older than a cutoff, or beyond the last N of each '
+        'chain, to gzipped JSONL and delete them'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=int, default=None, metavar='DAYS',
+            help='Only archive events created more than this many days ago',
+        )
+        parser.add_argument(
+            '--keep-last', type=int, default=None, metavar='N',
+            help='Keep the last N events of every chain',
+        )
+        parser.add_argument(
+            '--output',
+            help='Archive file, appended to as a gzip member per chunk',
+        )
+        parser.add_argument(
+            '--no-archive', action='store_true', default=False,
+            help='Delete the events without archiving them',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of events archived and deleted at a time',
+        )
+        parser.add_argument(
+            '--summary', action='store_true', default=False,
+            help='Log an event on each chain with the range of events archived',
+        )
+        parser.add_argument('--dry-run', action='store_true', default=False)
+
+    def handle(self, *args, **options):
+        if options['older_than'] is None and options['keep_last'] is None:
+            raise CommandError('Pass --older-than and/or --keep-last')
+
+        if not options['output'] and not options['no_archive']:
+            raise CommandError('Pass --output, or --no-archive to only delete the events')
+
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        self.options = options
+        archived, chains = 0, set()
+        chunk = []
+        for event in self.iter_events(options['older_than'], options['keep_last']):
+            chunk.append(event)
+            if len(chunk) >= options['chunk_size']:
+                archived += self.archive(chunk)
+                chains.update(e['chain_id'] for e in chunk)
+                chunk = []
+        if chunk:
+            archived += self.archive(chunk)
+            chains.update(e['chain_id'] for e in chunk)
+
+        self.stdout.write('%s %s events of %s chains%s' % (
+            'Would archive' if options['dry_run'] else 'Archived',
+            archived,
+            len(chains),
+            ' to %s' % options['output'] if options['output'] else '',
+        ))
+
+    def iter_events(self, older_than, keep_last):
+        """
+        Stream the events to archive, from a server side cursor where the
+        backend supports it
+        """
+        queryset = ChainEvent.objects.all()
+        cutoff = None
+        if older_than is not None:
+            cutoff = date.today() - timedelta(days=older_than)
+
+        if keep_last is None:
+            queryset = queryset.filter(date_created__lt=cutoff).order_by('pk')
+            for event in queryset.values(*EVENT_FIELDS).iterator():
+                yield event
+            return
+
+        # newest first, so the first `keep_last` of each chain are skipped
+        chain_id, rank = None, 0
+        queryset = queryset.order_by('chain_id', '-pk')
+        for event in queryset.values(*EVENT_FIELDS).iterator():
+            if event['chain_id'] != chain_id:
+                chain_id, rank = event['chain_id'], 0
+            rank += 1
+            if rank > keep_last and (cutoff is None or event['date_created'] < cutoff):
+                yield event
+
+    def archive(self, events):
+        if self.options['dry_run']:
+            return len(events)
+
+        # the archive is written before anything is deleted, and each chunk
+        # is a complete gzip member, so an interrupted run loses nothing
+        if self.options['output']:
+            with gzip.open(self.options['output'], 'ab') as f:
+                f.write(''.join('%s\n' % serialize_event(e) for e in events).encode('utf-8'))
+
+        with transaction.atomic():
+            ChainEvent.objects.filter(pk__in=[e['pk'] for e in events]).delete()
+            if self.options['summary']:
+                ChainEvent.objects.bulk_create(self.summarize(events))
+
+        return len(events)
+
+    def summarize(self, events):
+        ranges = OrderedDict()
+        for event in events:
+            count, first, last = ranges.get(event['chain_id'], (0, None, None))
+            day = event['date_created']
+            ranges[event['chain_id']] = (
+                count + 1,
+                day if first is None else min(first, day),
+                day if last is None else max(last, day),
+            )
+
+        return [
+            ChainEvent(
+                chain_id=chain_id,
+                action=ARCHIVED,
+                value='%s events from %s to %s' % (count, first.isoformat(), last.isoformat()),
+                requested_by='dispatcher_archive_events',
+            )
+            for chain_id, (count, first, last) in ranges.items()
+        ]
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from dispatcher.outbox import drain
+
+
+class Command(BaseCommand):
+
+    help = 'Run the callbacks queued by `execute(outbox=True)`'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-workers', type=int, default=4)
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of callbacks claimed and run at a time',
+        )
+        parser.add_argument(
+            '--poll', type=float, default=None, metavar='SECONDS',
+            help='Wait for more callbacks once none are due instead of exiting',
+        )
+
+    def handle(self, *args, **options):
+        totals = {'done': 0, 'retry': 0, 'failed': 0}
+        while True:
+            counts = drain(options['batch_size'], max_workers=options['max_workers'])
+            for key in totals:
+                totals[key] += counts[key]
+
+            if not any(counts.values()):
+                if not options['poll']:
+                    break
+                time.sleep(options['poll'])
+
+        self.stdout.write(
+            'Ran %s callbacks: %s failed and will be retried, %s gave up' % (
+                totals['done'] + totals['retry'] + totals['failed'], totals['retry'], totals['failed'],
+            )
+        )
@@ -0,0 +1,122 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import six
+from django.utils.module_loading import import_string
+
+from dispatcher.dispatcher import Dispatcher
+from dispatcher.models import Chain
+from dispatcher.projection import format_report, project
+from dispatcher.runner import EXECUTORS, THREAD, run_chains
+
+
+def get_dispatcher_config():
+    """
+    `settings.DISPATCHER_CONFIG` is either the config itself or the dotted
+    path to it
+    """
+    config = getattr(settings, 'DISPATCHER_CONFIG', None)
+    if config is None:
+        raise CommandError('settings.DISPATCHER_CONFIG is not set')
+
+    if isinstance(config, six.string_types):
+        config = import_string(config)
+    return config
+
+
+class Command(BaseCommand):
+
+    help = 'Execute the chains due for an update, in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--executor', choices=EXECUTORS, default=THREAD)
+        parser.add_argument('--max-workers', type=int, default=4)
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of chains claimed and executed at a time',
+        )
+        parser.add_argument(
+            '--limit', type=int, default=None,
+            help='Stop after executing this many chains',
+        )
+        parser.add_argument(
+            '--chain-type', action='append', dest='chain_types',
+            help='Only execute chains of this type, can be repeated',
+        )
+        parser.add_argument('--dry-run', action='store_true', default=False)
+        parser.add_argument(
+            '--queue', action='store_true', default=False,
+            help='Drain the work queue filled by Dispatcher.notify instead of the due chains',
+        )
+        parser.add_argument(
+            '--poll', type=float, default=None, metavar='SECONDS',
+            help='With --queue, wait for more work once the queue is empty instead of exiting',
+        )
+        parser.add_argument(
+            '--project', action='store_true', default=False,
+            help='Report where the due chains would transition, without locking or executing them',
+        )
+        parser.add_argument(
+            '--outbox', action='store_true', default=False,
+            help='Queue the callbacks for dispatcher_drain_outbox instead of running them under the chains\' locks',
+        )
+        parser.add_argument('--requested-by', default='dispatcher_run')
+
+    def handle(self, *args, **options):
+        dispatcher = Dispatcher(get_dispatcher_config())
+        chain_types = options['chain_types'] or list(dispatcher.graphs)
+        limit = options['limit']
+
+        if options['project']:
+            chains = Chain.objects.due(chain_types).order_by('pk')
+            if limit is not None:
+                chains = chains[:limit]
+            report = project(chains, chunk_size=options['batch_size'])
+            self.stdout.write(format_report(report))
+            return
+
+        totals = {'transitions': 0, 'noops': 0, 'errors': 0}
+        after = None
+        executed = 0
+        while limit is None or executed < limit:
+            batch_size = options['batch_size']
+            if limit is not None:
+                batch_size = min(batch_size, limit - executed)
+
+            if options['queue']:
+                chains = Chain.objects.claim_queued(batch_size, chain_types=chain_types)
+                if not chains and options['poll']:
+                    time.sleep(options['poll'])
+                    continue
+            else:
+                chains = Chain.objects.claim_due(batch_size, chain_types=chain_types, after=after)
+            if not chains:
+                break
+
+            if not options['queue']:
+                # page past these whatever state executing leaves them in, so
+                # chains without a valid transition aren't picked up again
+                after = (chains[-1].date_next_update, chains[-1].pk)
+            executed += len(chains)
+
+            results = run_chains(
+                chains,
+                executor=options['executor'],
+                max_workers=options['max_workers'],
+                dry_run=options['dry_run'],
+                requested_by=options['requested_by'],
+                outbox=options['outbox'],
+            )
+            for key in totals:
+                totals[key] += results[key]
+
+            for result in results['results']:
+                if result['error'] is not None:
+                    self.stderr.write('Chain %s: %s' % (result['chain_id'], result['error']))
+
+        self.stdout.write(
+            'Executed %s chains: %s transitions, %s no-ops, %s errors' % (
+                executed, totals['transitions'], totals['noops'], totals['errors'],
+            )
+        )
@@ -0,0 +1,173 @@
+"""
+Where the time goes when resolving and executing chains.
+
+Every measurement is kept in the in-process `registry`, which renders them in
+the Prometheus text format (see `metrics_view`), and is sent as a
+`metric_recorded` signal for whatever else wants them:
+
+    @receiver(metric_recorded)
+    def to_statsd(sender, name, kind, value, labels, **kwargs):
+        ...
+
+The durations are tagged with the chain_type, the state the chain was in and
+the transition class, where they apply. With the process executor, what the
+worker processes measure stays in their own registry.
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.dispatch import Signal
+from django.http import HttpResponse
+from django.utils import six
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+METRICS = OrderedDict([
+    ('dispatcher_resolve_seconds', (HISTOGRAM, 'Time to find or create chains for resources')),
+    ('dispatcher_chain_cache_hits_total', (COUNTER, 'Chains found by resources in the chain cache')),
+    ('dispatcher_chain_cache_misses_total', (COUNTER, 'Chains looked up by resources missing from the chain cache')),
+    ('dispatcher_lock_seconds', (HISTOGRAM, 'Time to acquire the lock of a chain')),
+    ('dispatcher_is_valid_seconds', (HISTOGRAM, 'Time spent in a transition\'s is_valid')),
+    ('dispatcher_callback_seconds', (HISTOGRAM, 'Time spent in the callback of a transition')),
+    ('dispatcher_persist_seconds', (HISTOGRAM, 'Time to save the result of an execution')),
+    ('dispatcher_lock_contention_total', (COUNTER, 'Executions given up as the chain was locked')),
+    ('dispatcher_transitions_total', (COUNTER, 'Executions that transitioned the chain')),
+    ('dispatcher_noops_total', (COUNTER, 'Executions without a valid transition')),
+    ('dispatcher_errors_total', (COUNTER, 'Executions that failed')),
+    ('dispatcher_outbox_retries_total', (COUNTER, 'Outbox callbacks that failed and were rescheduled')),
+    ('dispatcher_outbox_failed_total', (COUNTER, 'Outbox callbacks given up after their last attempt')),
+    ('dispatcher_scheduler_wait_seconds_total', (COUNTER, 'Time batch runs held chains back on a limit')),
+])
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+# sent for every measurement: name, kind (counter or histogram), value and
+# labels, a dict
+metric_recorded = Signal(providing_args=['name', 'kind', 'value', 'labels'])
+
+
+class MetricsRegistry(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        # (name, labels) -> [bucket counts..., sum, count]
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def get(self, name, **labels):
+        """
+        A counter's value, or a histogram's (sum, count)
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return tuple(self._histograms[key][-2:])
+            return self._counters.get(key, 0)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """
+        Everything recorded, in the Prometheus text exposition format
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+
+        names = list(METRICS) + sorted(
+            set(name for name, _ in list(counters) + list(histograms)) - set(METRICS))
+        lines = []
+        for name in names:
+            _, help_text = METRICS.get(name, (None, None))
+            counter_series = sorted((k, v) for k, v in counters.items() if k[0] == name)
+            histogram_series = sorted((k, v) for k, v in histograms.items() if k[0] == name)
+            if not counter_series and not histogram_series:
+                continue
+
+            if help_text:
+                lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, HISTOGRAM if histogram_series else COUNTER))
+
+            for (_, labels), value in counter_series:
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+
+            for (_, labels), histogram in histogram_series:
+                for bucket, count in zip(self.buckets, histogram):
+                    lines.append('%s_bucket%s %s' % (
+                        name, format_labels(labels + (('le', format_value(bucket)), )), count))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(histogram[-2])))
+                lines.append('%s_count%s %s' % (name, format_labels(labels), histogram[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, escape_label(value)) for key, value in labels)
+
+
+def escape_label(value):
+    return six.text_type(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
+
+
+def increment(name, value=1, **labels):
+    registry.increment(name, value, **labels)
+    metric_recorded.send(sender=MetricsRegistry, name=name, kind=COUNTER, value=value, labels=labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+    metric_recorded.send(sender=MetricsRegistry, name=name, kind=HISTOGRAM, value=value, labels=labels)
+
+
+@contextmanager
+def timed(name, **labels):
+    """
+    Observe how long the block takes, in seconds, whether it raises or not
+    """
+    start = default_timer()
+    try:
+        yield
+    finally:
+        observe(name, default_timer() - start, **labels)
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint, to add to the project's urls
+    """
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
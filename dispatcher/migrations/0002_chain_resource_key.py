@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+
+from django.db import migrations, models
+
+
+def make_resource_key(rsc_mappings):
+    """
+    Copy of `dispatcher.models.make_resource_key` when this migration was
+    written, so later changes to it don't change what the migration does
+    """
+    canonical = u'\x1e'.join(sorted(
+        u'%s\x1f%s' % (r_type, r_id) for r_type, r_id in set(rsc_mappings)
+    ))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def populate_resource_keys(apps, schema_editor):
+    """
+    Fingerprint the existing chains. When several chains of the same type
+    share the exact same resources, only the oldest one gets a key, the
+    others are left out of the exact-match lookup.
+    """
+    Chain = apps.get_model('dispatcher', 'Chain')
+    ChainResource = apps.get_model('dispatcher', 'ChainResource')
+
+    rsc_sets = {}
+    rscs = ChainResource.objects.values_list('chain_id', 'resource_type', 'resource_id')
+    for chain_id, r_type, r_id in rscs.iterator():
+        rsc_sets.setdefault(chain_id, set()).add((r_type, r_id))
+
+    seen = set()
+    chains = Chain.objects.order_by('pk').values_list('pk', 'chain_type')
+    for chain_id, chain_type in chains.iterator():
+        key = (chain_type, make_resource_key(rsc_sets.get(chain_id, ())))
+        if key in seen:
+            logging.warning('Chain %s duplicates the resources of another chain', chain_id)
+            continue
+
+        seen.add(key)
+        Chain.objects.filter(pk=chain_id).update(resource_key=key[1])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispatcher', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chain',
+            name='resource_key',
+            field=models.CharField(max_length=40, null=True, blank=True),
+        ),
+        migrations.RunPython(populate_resource_keys, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='chain',
+            unique_together=(('chain_type', 'resource_key'), ),
+        ),
+    ]
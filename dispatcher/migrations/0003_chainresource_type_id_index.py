@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispatcher', '0002_chain_resource_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chainresource',
+            index=models.Index(fields=['resource_type', 'resource_id'], name='dispatcher_rsc_type_id_idx'),
+        ),
+    ]
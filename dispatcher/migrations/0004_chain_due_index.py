@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispatcher', '0003_chainresource_type_id_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chain',
+            index=models.Index(
+                fields=['disabled', 'is_locked', 'date_next_update', 'chain_type'],
+                name='dispatcher_chain_due_idx',
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispatcher', '0004_chain_due_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chain',
+            name='lock_owner',
+            field=models.CharField(max_length=100, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='chain',
+            name='lock_expires',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
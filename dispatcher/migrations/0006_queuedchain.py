@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispatcher', '0005_chain_lock_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedChain',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date_queued', models.DateTimeField(auto_now_add=True)),
+                ('requested_by', models.CharField(max_length=100, blank=True)),
+                ('chain', models.OneToOneField(related_name='queued', to='dispatcher.Chain')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='queuedchain',
+            index=models.Index(fields=['date_queued'], name='dispatcher_queued_date_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def dates_to_datetimes(apps, schema_editor):
+    # other databases cast the column's dates to midnight, sqlite keeps the
+    # 'YYYY-MM-DD' strings, which don't parse as datetimes
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    Chain = apps.get_model('dispatcher', 'Chain')
+    schema_editor.execute(
+        "UPDATE {table} SET {column} = {column} || ' 00:00:00' WHERE length({column}) = 10".format(
+            table=schema_editor.quote_name(Chain._meta.db_table),
+            column=schema_editor.quote_name('date_next_update'),
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispatcher', '0006_queuedchain'),
+    ]
+
+    operations = [
+        # existing dates become the start of their day
+        migrations.AlterField(
+            model_name='chain',
+            name='date_next_update',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+        migrations.RunPython(dates_to_datetimes, migrations.RunPython.noop),
+    ]
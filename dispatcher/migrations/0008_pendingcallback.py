@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispatcher', '0007_chain_date_next_update_datetime'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingCallback',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('transition', models.CharField(max_length=200)),
+                ('callback', models.CharField(max_length=200, blank=True)),
+                ('context', models.TextField(default='{}')),
+                ('callback_kwargs', models.TextField(default='{}')),
+                ('idempotency_key', models.CharField(max_length=32, unique=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('failed', models.BooleanField(default=False)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_next_attempt', models.DateTimeField()),
+                ('lock_owner', models.CharField(max_length=100, null=True, blank=True)),
+                ('lock_expires', models.DateTimeField(null=True, blank=True)),
+                ('chain', models.ForeignKey(related_name='pending_callbacks', to='dispatcher.Chain')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pendingcallback',
+            index=models.Index(fields=['failed', 'date_next_attempt'], name='dispatcher_outbox_due_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispatcher', '0008_pendingcallback'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chain',
+            index=models.Index(fields=['is_locked', 'lock_expires'], name='dispatcher_chain_lease_idx'),
+        ),
+    ]
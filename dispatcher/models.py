@@ -1,9 +1,148 @@
+import hashlib
+import inspect
+import json
+import os
+import socket
 import traceback
 import logging
-from datetime import datetime
-from django.db import models
-
-from constants import DONE
+import uuid
+from datetime import date, timedelta
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, models, router, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .cache import get_chain_cache, make_chain_key
+from .constants import DONE
+from .events import buffered_events, get_sink
+from .graph import ChainGraph, get_graph
+from .metrics import increment, timed
+
+
+# bounds `execute(until_stable=True)`, should the transitions loop
+UNTIL_STABLE_MAX_STEPS = 100
+
+# what the chain cache keeps of a chain, the other fields are deferred
+CACHED_CHAIN_FIELDS = ('id', 'chain_type', 'state', 'resource_key')
+
+
+def make_resource_key(rsc_mappings):
+    """
+    Canonical fingerprint of a set of (resource_type, resource_id) tuples.
+    The order and duplicates of `rsc_mappings` don't matter.
+    """
+    canonical = u'\x1e'.join(sorted(
+        u'%s\x1f%s' % (r_type, r_id) for r_type, r_id in set(rsc_mappings)
+    ))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def get_cached_chain(chain_type, resource_key):
+    """
+    The chain of `chain_type` with the resources fingerprinted by
+    `resource_key`, from the chain cache (see `dispatcher.cache.get_chain_cache`)
+    and without a query. Its fields other than `CACHED_CHAIN_FIELDS` are
+    deferred, they're loaded on access. Its `state` may be stale, it's
+    reloaded once the chain is locked. None if it's not cached.
+    """
+    cache = get_chain_cache()
+    if cache is None:
+        return None
+
+    values = cache.get(make_chain_key(chain_type, resource_key))
+    if values is None:
+        increment('dispatcher_chain_cache_misses_total', chain_type=chain_type)
+        return None
+
+    increment('dispatcher_chain_cache_hits_total', chain_type=chain_type)
+    field_names = [f.attname for f in Chain._meta.concrete_fields if f.attname in values]
+    chain = Chain.from_db(
+        router.db_for_read(Chain), field_names, [values[name] for name in field_names])
+    chain._from_cache = True
+    return chain
+
+
+def cache_chain(chain):
+    cache = get_chain_cache()
+    if cache is not None and chain.resource_key:
+        cache.set(
+            make_chain_key(chain.chain_type, chain.resource_key),
+            {field: getattr(chain, field) for field in CACHED_CHAIN_FIELDS},
+        )
+
+
+def invalidate_cached_chain(chain_type, resource_key):
+    """
+    Drop a chain from the chain cache, now and once the current transaction
+    commits, so a concurrent lookup can't cache what's being changed
+    """
+    cache = get_chain_cache()
+    if cache is None or not resource_key:
+        return
+
+    key = make_chain_key(chain_type, resource_key)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+def make_lock_owner():
+    """
+    Identifies who holds a chain's lock: unique per acquisition, with the
+    process and host to track down stuck workers
+    """
+    return ('%s:%s@%s' % (uuid.uuid4().hex[:12], os.getpid(), socket.gethostname()))[:100]
+
+
+def get_lock_lease():
+    """
+    How long a lock is held before other workers may take it over,
+    `settings.DISPATCHER_LOCK_LEASE` in seconds
+    """
+    return timedelta(seconds=getattr(settings, 'DISPATCHER_LOCK_LEASE', 600))
+
+
+def _is_valid(transition):
+    with timed('dispatcher_is_valid_seconds', **transition.chain.metric_labels(transition)):
+        return transition.is_valid()
+
+
+def _check_transition(transition):
+    try:
+        return _is_valid(transition)
+    finally:
+        # the check runs in a throwaway thread
+        connections.close_all()
+
+
+def import_path(obj):
+    """
+    Dotted path `obj` (a module level class or function) is imported back from
+    """
+    path = '%s.%s' % (obj.__module__, getattr(obj, '__qualname__', obj.__name__))
+    try:
+        imported = import_string(path)
+    except ImportError:
+        imported = None
+    if imported is not obj:
+        raise ValueError('%r can not be imported back from %s' % (obj, path))
+    return path
+
+
+def lock_available(now, prefix=''):
+    """
+    Unlocked chains, or chains whose lease ran out. Locks without a lease,
+    taken by code predating the leases, aren't: see `ChainQuerySet.expire_locks`.
+    `prefix` is the path to the chain, e.g. 'chain__', when filtering related
+    models.
+    """
+    return (
+        models.Q(**{prefix + 'is_locked': False}) |
+        models.Q(**{prefix + 'lock_expires__lt': now})
+    )
 
 
 class ChainEvent(models.Model):
@@ -23,6 +162,140 @@ class ChainResource(models.Model):
 
     class Meta:
         unique_together = (('chain', 'resource_id', 'resource_type'), )
+        indexes = [
+            models.Index(fields=['resource_type', 'resource_id'], name='dispatcher_rsc_type_id_idx'),
+        ]
+
+
+class ChainQuerySet(models.QuerySet):
+
+    def due(self, chain_types=None, until=None):
+        """
+        Enabled, unlocked chains scheduled to update by now (or `until`).
+        Finished chains (DONE) are left out. Chains whose lock lease ran out
+        are due once `expire_locks` released them, which `claim_due` does
+        first: the due-time index only covers `is_locked=False`.
+        """
+        queryset = self.filter(
+            disabled=False,
+            is_locked=False,
+            date_next_update__lte=until or timezone.now(),
+        ).exclude(state=DONE)
+        if chain_types:
+            queryset = queryset.filter(chain_type__in=chain_types)
+        return queryset
+
+    def expire_locks(self):
+        """
+        Release the locks whose lease ran out, e.g. because their worker died.
+        Locks without a lease, taken by code predating the leases (say during
+        a rolling deploy), are given one, they're released once it runs out.
+
+        Returns the number of locks released.
+        """
+        now = timezone.now()
+        self.filter(is_locked=True, lock_expires__isnull=True).update(
+            lock_expires=now + get_lock_lease())
+        return self.filter(is_locked=True, lock_expires__lt=now).update(
+            is_locked=False,
+            lock_owner=None,
+            lock_expires=None,
+        )
+
+    def claim_due(self, limit, chain_types=None, after=None):
+        """
+        Lock and return up to `limit` due chains, the longest overdue first.
+
+        Concurrent callers get disjoint pages: on backends supporting it the
+        rows are selected with `SELECT ... FOR UPDATE SKIP LOCKED`, otherwise
+        (sqlite) each chain is claimed with a conditional update. The chains
+        are returned locked, ready to be `execute`d, which unlocks them.
+
+        Chains that stay due after executing (no valid transition) would be
+        claimed again on the next call. To walk through all the due chains
+        once, pass the (date_next_update, pk) of the last chain of the previous
+        page as `after`.
+        """
+        self.expire_locks()
+        queryset = self.due(chain_types).order_by('date_next_update', 'pk')
+        now = timezone.now()
+        lock_owner = make_lock_owner()
+        lock_fields = {
+            'is_locked': True,
+            'lock_owner': lock_owner,
+            'lock_expires': now + get_lock_lease(),
+        }
+        if after is not None:
+            date_next_update, pk = after
+            queryset = queryset.filter(
+                models.Q(date_next_update__gt=date_next_update) |
+                models.Q(date_next_update=date_next_update, pk__gt=pk)
+            )
+
+        with transaction.atomic(using=self.db):
+            if connections[self.db].features.has_select_for_update_skip_locked:
+                chain_ids = list(
+                    queryset.select_for_update(skip_locked=True)
+                    .values_list('pk', flat=True)[:limit]
+                )
+                self.filter(pk__in=chain_ids).update(**lock_fields)
+            else:
+                chain_ids = [
+                    chain_id for chain_id in queryset.values_list('pk', flat=True)[:limit]
+                    if self.filter(pk=chain_id, is_locked=False).update(**lock_fields)
+                ]
+
+        chains = list(self.filter(pk__in=chain_ids).order_by('date_next_update', 'pk'))
+        for chain in chains:
+            chain._lock_owner = lock_owner
+        return chains
+
+    def claim_queued(self, limit, chain_types=None):
+        """
+        Lock and return up to `limit` chains of the work queue (see
+        `Dispatcher.notify`), the first queued first, and take them off the
+        queue. Chains locked by someone else stay queued for later. Disabled
+        chains, and chains rescheduled since they were queued (e.g. executed
+        by a scheduled run meanwhile), are dropped from the queue.
+        """
+        now = timezone.now()
+        lock_owner = make_lock_owner()
+        # locked chains are skipped before taking `limit` of them, so they don't
+        # hold up the rest of the queue
+        dropped = models.Q(chain__disabled=True) | models.Q(chain__date_next_update__gt=now)
+        queue = QueuedChain.objects.using(self.db).filter(
+            lock_available(now, prefix='chain__') | dropped,
+        ).order_by('date_queued', 'pk')
+        if chain_types:
+            queue = queue.filter(chain__chain_type__in=chain_types)
+
+        with transaction.atomic(using=self.db):
+            if connections[self.db].features.has_select_for_update_skip_locked:
+                queue = queue.select_for_update(skip_locked=True)
+            chain_ids = list(queue.values_list('chain_id', flat=True)[:limit])
+
+            self.filter(
+                lock_available(now),
+                pk__in=chain_ids,
+                disabled=False,
+                date_next_update__lte=now,
+            ).update(
+                is_locked=True,
+                lock_owner=lock_owner,
+                lock_expires=now + get_lock_lease(),
+            )
+            chains = list(self.filter(pk__in=chain_ids, lock_owner=lock_owner))
+
+            QueuedChain.objects.using(self.db).filter(
+                models.Q(chain__in=[chain.pk for chain in chains]) |
+                models.Q(dropped, chain__in=chain_ids)
+            ).delete()
+
+        queued_order = {chain_id: i for i, chain_id in enumerate(chain_ids)}
+        chains.sort(key=lambda chain: queued_order[chain.pk])
+        for chain in chains:
+            chain._lock_owner = lock_owner
+        return chains
 
 
 class Chain(models.Model):
@@ -31,44 +304,208 @@ class Chain(models.Model):
     chain_type = models.CharField(max_length=100)
     date_created = models.DateField(auto_now_add=True)
     date_modified = models.DateField(auto_now=True)
-    date_next_update = models.DateField(auto_now_add=True, null=True)
+    date_next_update = models.DateTimeField(auto_now_add=True, null=True)
     disabled = models.BooleanField(default=False)
     is_locked = models.BooleanField(default=False)
+    lock_owner = models.CharField(max_length=100, null=True, blank=True)
+    lock_expires = models.DateTimeField(null=True, blank=True)
+    resource_key = models.CharField(max_length=40, null=True, blank=True)
+
+    objects = ChainQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (('chain_type', 'resource_key'), )
+        indexes = [
+            models.Index(
+                fields=['disabled', 'is_locked', 'date_next_update', 'chain_type'],
+                name='dispatcher_chain_due_idx',
+            ),
+            models.Index(fields=['is_locked', 'lock_expires'], name='dispatcher_chain_lease_idx'),
+        ]
 
     dry_run = False
-    errors = {}
+
+    # owner id of the lock this instance holds, as opposed to `lock_owner`,
+    # which is whoever held the lock when the chain was loaded
+    _lock_owner = None
+
+    # loaded from the chain cache, see `get_cached_chain`
+    _from_cache = False
 
     def lock(self):
-        if self.is_locked is False and not self.dry_run:
-            self.is_locked = True
-            self.save()
+        """
+        Take (or renew) the lock with a single conditional update of the lock
+        columns, so only one worker can succeed. A lock whose lease expired,
+        e.g. because its worker died, is taken over, and a lock without a
+        lease is given one (see `ChainQuerySet.expire_locks`). The state of a
+        chain from the chain cache is reloaded once locked.
+
+        Returns whether the lock is held.
+        """
+        if self.dry_run:
+            return True
+
+        now = timezone.now()
+        lock_owner = self._lock_owner or make_lock_owner()
+        lock_fields = {
+            'is_locked': True,
+            'lock_owner': lock_owner,
+            'lock_expires': now + get_lock_lease(),
+        }
+        acquired = Chain.objects.filter(
+            lock_available(now) | models.Q(lock_owner=lock_owner),
+            pk=self.pk,
+        ).update(**lock_fields)
+
+        if acquired:
+            self._lock_owner = lock_owner
+            for field, value in lock_fields.items():
+                setattr(self, field, value)
+            if self._from_cache:
+                self._reload_state()
+        else:
+            Chain.objects.filter(pk=self.pk, is_locked=True, lock_expires__isnull=True).update(
+                lock_expires=lock_fields['lock_expires'])
+        return bool(acquired)
+
+    def _reload_state(self):
+        """
+        Replace the cached state with the one in the db, which nobody else
+        can change while the lock is held
+        """
+        state = Chain.objects.filter(pk=self.pk).values_list('state', flat=True).get()
+        if state != self.state:
+            invalidate_cached_chain(self.chain_type, self.resource_key)
+            self.state = state
+        self._from_cache = False
 
     def unlock(self):
-        if self.is_locked and not self.dry_run:
-            self.is_locked = False
-            self.save()
+        """
+        Release the lock, if this instance holds it
+        """
+        if self._lock_owner is None:
+            return
+
+        self._release()
+
+    def _save_locked(self, **fields):
+        """
+        Write `fields` if the lock is still held, keeping it.
+
+        Returns whether the lock was still held, nothing is written otherwise.
+        """
+        return self._apply(self._update_locked(fields, release=False), release=False)
+
+    def _release(self, **fields):
+        """
+        Write `fields` and release the lock in a single conditional update,
+        instead of a full row `save` followed by another write to unlock.
+
+        Returns whether the lock was still held, nothing is written otherwise.
+        """
+        return self._apply(self._update_locked(fields, release=True), release=True)
+
+    def _update_locked(self, fields, release):
+        """
+        Write `fields` with a conditional update if the lock is still held,
+        releasing it with `release`. The instance isn't changed, see `_apply`.
+
+        Returns the fields written, None if the lock was lost.
+        """
+        fields = dict(fields)
+        if release:
+            fields.update({
+                'is_locked': False,
+                'lock_owner': None,
+                'lock_expires': None,
+            })
+        if not release or len(fields) > 3:
+            # `update` skips auto_now
+            fields['date_modified'] = date.today()
+
+        updated = Chain.objects.filter(pk=self.pk, lock_owner=self._lock_owner).update(**fields)
+        return fields if updated else None
+
+    def _apply(self, fields, release):
+        """
+        Reflect what `_update_locked` wrote on the instance. Within a
+        transaction, only call it once committed: if the write is rolled
+        back, the lock is still ours to `unlock`.
+        """
+        if release:
+            self._lock_owner = None
+        if fields is None:
+            return False
+
+        for field, value in fields.items():
+            setattr(self, field, value)
+        if 'state' in fields:
+            invalidate_cached_chain(self.chain_type, self.resource_key)
+        return True
 
     def transition_to(self, new_state):
         self.state = new_state
         self.save()
 
     @property
-    def transitions(self):
-        if not self._transitions:
+    def graph(self):
+        """
+        The compiled transitions config of the chain's type, registered by
+        the `Dispatcher` configuring it
+        """
+        graph = self._graph or get_graph(self.chain_type)
+        if not graph:
             raise NotImplementedError('Could not find transitions on chain')
-        return self._transitions
-    _transitions = None
+        return graph
+    _graph = None
+
+    @property
+    def prefetched(self):
+        """
+        {Transition class: data} loaded by `Transition.prefetch` for this chain
+        """
+        if self._prefetched is None:
+            self._prefetched = {}
+        return self._prefetched
+    _prefetched = None
+
+    @property
+    def errors(self):
+        """
+        Why the candidates checked by the last `find_transition` weren't
+        valid, {str(transition): transition.errors}
+        """
+        if self._errors is None:
+            self._errors = {}
+        return self._errors
+    _errors = None
+
+    @property
+    def transitions(self):
+        return self.graph.transitions
 
     @transitions.setter
     def transitions(self, value):
-        self._transitions = value
+        # overrides the registered config for this chain only
+        self._graph = ChainGraph(self.chain_type, value)
+
+    def metric_labels(self, transition=None):
+        """
+        Tags of the measurements taken while executing the chain, see
+        `dispatcher.metrics`
+        """
+        labels = {'chain_type': self.chain_type, 'state': self.state}
+        if transition is not None:
+            labels['transition'] = transition.__class__.__name__
+        return labels
 
-    def run_results(self, transition):
+    def run_results(self, transition, steps=0):
         self.unlock()
         return {
             'errors': self.errors,
             'dry_run': self.dry_run,
             'transition': transition and transition.to_dict(),
+            'steps': steps,
             'chain': {
                 'id': self.pk,
                 'state': self.state,
@@ -76,106 +513,425 @@ class Chain(models.Model):
         }
 
     def log_event(self, action, value, requested_by):
-        event_log = ChainEvent(**{
-            'chain': self,
-            'action': action,
-            'value': value,
-            'requested_by': requested_by,
-        })
-        event_log.save()
+        get_sink(self.chain_type).emit(self, action, value, requested_by)
 
-    def find_transition(self, initial_context):
+    def find_transition(self, initial_context, concurrent=False):
         """
         Find all the possible transitions and validate
+
+        With `concurrent`, the candidates' `is_valid` checks run at the same
+        time in a thread each. The first valid transition in config order is
+        still the one returned, and the errors of the invalid ones before it
+        are still collected.
         """
+        self._errors = {}
         if self.state == DONE:
-            # find the transition with final_state==DONE
-            return next((
-                T(self, initial_context)
-                for sublist in self.transitions.values()
-                for T in sublist if T.final_state == DONE
-            ), None)
-
-        for Transition in self.transitions.get(self.state) or []:
-            transition = Transition(self, initial_context)
-            if transition.is_valid():
+            # the transition with final_state==DONE
+            Transition = self.graph.done_transition
+            return Transition and Transition(self, initial_context)
+
+        transitions = [
+            Transition(self, initial_context)
+            for Transition in self.graph.get_transitions(self.state)
+        ]
+        for transition in transitions:
+            if transition.is_async:
+                raise ValueError('%s is asynchronous, use `aexecute`' % transition)
+
+        if concurrent and len(transitions) > 1:
+            pool = ThreadPool(len(transitions))
+            checks = [pool.apply_async(_check_transition, (t, )) for t in transitions]
+            # don't wait for the checks still running once a valid one is found
+            pool.close()
+            is_valid = (check.get() for check in checks)
+        else:
+            is_valid = (_is_valid(transition) for transition in transitions)
+
+        for transition, valid in zip(transitions, is_valid):
+            if valid:
                 return transition
             else:
                 # why did it not transition
                 self.errors.update({str(transition): transition.errors})
 
-    def execute(self, **kwargs):
-
-        # determine whether to actually transition and execute callback
-        self.dry_run = kwargs.pop('dry_run', False)
-
-        callback = kwargs.pop('callback', None)
-        callback_kwargs = kwargs.pop('callback_kwargs', None)
-        requested_by = kwargs.pop('requested_by', None)
-        initial_context = kwargs.pop('initial_context', None)
+    def start_execution(self, kwargs):
+        """
+        Pop the `execute` options out of `kwargs`, check the chain is due and
+        lock it. A lock already held, e.g. by chains claimed with
+        `claim_due`/`claim_queued`, is released if the checks fail.
+        """
+        try:
+            options = self._pop_options(kwargs)
+
+            if self.date_next_update > timezone.now():
+                logging.warning(
+                    'Chain is not scheduled to update til %s',
+                    self.date_next_update
+                )
+                raise ValueError('Chain not scheduled to update yet')
+        except Exception:
+            self.unlock()
+            raise
 
         # this will prevent duplicate runs should any processes take a
         # long time
-        if self.is_locked and not self.dry_run:
+        with timed('dispatcher_lock_seconds', **self.metric_labels()):
+            locked = self.lock()
+        if not locked:
+            increment('dispatcher_lock_contention_total', **self.metric_labels())
             logging.warning('Chain is locked, exiting early')
             raise ValueError('Chain is locked, exiting early')
 
-        if self.date_next_update > datetime.today().date():
-            logging.warning(
-                'Chain is not scheduled to update til %s',
-                self.date_next_update
-            )
-            raise ValueError('Chain not scheduled to update yet')
+        return options
 
-        self.lock()
-        try:
-            transition = self.find_transition(initial_context)
-        except:
-            logging.exception('Error while finding transition: %s', traceback.format_exc())
-            self.unlock()
-            raise Exception(traceback.format_exc())
+    def _pop_options(self, kwargs):
+        # determine whether to actually transition and execute callback
+        self.dry_run = kwargs.pop('dry_run', False)
 
-        if not transition:
-            return self.run_results(transition)
+        options = {
+            'callback': kwargs.pop('callback', None),
+            'callback_kwargs': kwargs.pop('callback_kwargs', None) or {},
+            'requested_by': kwargs.pop('requested_by', None),
+            'initial_context': kwargs.pop('initial_context', None),
+            'concurrent': kwargs.pop('concurrent', False),
+            'max_steps': kwargs.pop('max_steps', None),
+            'outbox': kwargs.pop('outbox', False),
+        }
+        until_stable = kwargs.pop('until_stable', False)
+        if options['max_steps'] is None:
+            options['max_steps'] = UNTIL_STABLE_MAX_STEPS if until_stable else 1
+        if options['max_steps'] < 1:
+            raise ValueError('max_steps must be at least 1')
+        if options['outbox'] and options['callback']:
+            # it's run later by whoever drains the outbox
+            options['callback_path'] = import_path(options['callback'])
+
+        return options
+
+    def needs_callback(self, transition):
+        """
+        Whether the transition found goes on to the callback. If it doesn't,
+        finish up with `finish_without_callback`
+        """
+        return bool(transition) and not self.dry_run and transition.final_state != DONE
 
-        if self.dry_run:
+    def finish_without_callback(self, transition, steps=0):
+        labels = self.metric_labels(transition)
+        if transition and self.dry_run:
             logging.info('Dry run found, exiting without executing/transitioning')
-            return self.run_results(transition)
 
-        if transition.final_state == DONE:
-            self.state = transition.final_state
-            return self.run_results(transition)
+        elif transition and transition.final_state == DONE:
+            with timed('dispatcher_persist_seconds', **labels):
+                released = self._release(state=transition.final_state)
+            if not released:
+                raise ValueError('Chain lock was lost, not saving the transition')
+            increment('dispatcher_transitions_total', **labels)
+            steps += 1
 
-        try:
+        elif not transition:
+            increment('dispatcher_noops_total', **labels)
+
+        return self.run_results(transition, steps)
+
+    def persist_transition(self, transition, requested_by, release=True, pending_callback=None):
+        """
+        Save the new state once the callback ran, releasing the lock unless
+        there are more steps to go. With `execute(outbox=True)`, the callback
+        hasn't run, its `PendingCallback` is saved along with the state.
+        """
+        fields = {'state': transition.final_state}
+        date_next_update = transition.get_date_next_update()
+        if date_next_update is not None:
+            fields['date_next_update'] = date_next_update
+
+        labels = self.metric_labels(transition)
+        # the new state, the unlock and the pending callback are written
+        # together or not at all, and so is the event unless it's buffered
+        # (see `dispatcher.events.buffered_events`): a buffered event is only
+        # written after the commit, and lost if that write fails
+        with timed('dispatcher_persist_seconds', **labels):
+            with transaction.atomic():
+                written = self._update_locked(fields, release)
+                if written is None:
+                    raise ValueError('Chain lock was lost, not saving the transition')
+
+                if pending_callback is not None:
+                    pending_callback.save()
+                self.log_event(
+                    action='state_transition',
+                    value=transition.final_state,
+                    requested_by=requested_by,
+                )
+            self._apply(written, release)
+        increment('dispatcher_transitions_total', **labels)
+
+    def finish_transition(self, transition, requested_by, steps=1, pending_callback=None):
+        """
+        Persist the new state once the callback ran
+        """
+        self.persist_transition(transition, requested_by, pending_callback=pending_callback)
+        return self.run_results(transition, steps)
+
+    def is_last_step(self, transition, steps, max_steps):
+        """
+        Whether to stop after `transition`, the `steps`th one of this execution
+        """
+        date_next_update = transition.get_date_next_update()
+        return (
+            steps >= max_steps or
+            bool(date_next_update and date_next_update > timezone.now())
+        )
+
+    def run_callback(self, transition, options):
+        callback = options['callback']
+        cb_kwargs = options['callback_kwargs']
+        with timed('dispatcher_callback_seconds', **self.metric_labels(transition)):
             if hasattr(transition, 'callback'):
-                cb_kwargs = callback_kwargs or {}
                 logging.debug('Callback found on transition, executing with %s', cb_kwargs)
                 transition.callback(**cb_kwargs)
 
             elif callback:
-                cb_kwargs = callback_kwargs or {}
                 logging.debug('Callback found, executing with %s', cb_kwargs)
                 callback(transition, **cb_kwargs)
 
             else:
                 logging.warning('Nothing configured to happen during execution')
 
-            if getattr(transition, 'date_next_update', None):
-                self.date_next_update = transition.date_next_update
+    def execute(self, **kwargs):
+        """
+        Find the valid transition of the chain, run the callback and save the
+        new state.
+
+        With `max_steps`, keeps going with the next valid transitions while
+        holding the same lock, up to that many. `until_stable` does the same
+        until there's no valid transition left (at most
+        `UNTIL_STABLE_MAX_STEPS`). Either way it stops at DONE and after a
+        transition scheduling the chain's next update in the future. The
+        events of the steps are written together.
+
+        With `outbox`, the callback isn't run while the chain is locked: it's
+        queued as a `PendingCallback`, committed along with the new state, and
+        run later by `dispatcher.outbox.drain`. A `callback` passed in has to
+        be importable, its `callback_kwargs` and the transition's context
+        serializable to JSON.
+        """
+        options = self.start_execution(kwargs)
+
+        if options['max_steps'] > 1:
+            with buffered_events():
+                return self.execute_steps(options)
+        return self.execute_steps(options)
+
+    def execute_steps(self, options):
+        taken = []
+        while True:
+            try:
+                transition = self.find_transition(options['initial_context'], options['concurrent'])
+            except:
+                logging.exception('Error while finding transition: %s', traceback.format_exc())
+                increment('dispatcher_errors_total', **self.metric_labels())
+                self.unlock()
+                raise Exception(traceback.format_exc())
+
+            if not transition and taken:
+                # stable
+                return self.run_results(taken[-1], len(taken))
+
+            if not self.needs_callback(transition):
+                return self.finish_without_callback(transition, len(taken))
+
+            try:
+                pending_callback = None
+                if options['outbox']:
+                    pending_callback = PendingCallback.for_transition(transition, options)
+                else:
+                    self.run_callback(transition, options)
+                taken.append(transition)
+                if self.is_last_step(transition, len(taken), options['max_steps']):
+                    return self.finish_transition(
+                        transition, options['requested_by'], len(taken), pending_callback)
+
+                self.persist_transition(
+                    transition, options['requested_by'], release=False, pending_callback=pending_callback)
+
+            except:
+                logging.exception('Error executing chain: %s', traceback.format_exc())
+                increment('dispatcher_errors_total', **self.metric_labels(transition))
+                self.unlock()
+                raise Exception(traceback.format_exc())
+
+    def aexecute(self, **kwargs):
+        """
+        asyncio flavour of `execute`, returns a coroutine. See
+        `dispatcher.aio.aexecute`
+        """
+        from .aio import aexecute
+        return aexecute(self, **kwargs)
+
 
-            self.state = transition.final_state
-            self.is_locked = False
-            self.save()
+class QueuedChain(models.Model):
+    """
+    Work queue of the chains to execute as soon as possible, filled by
+    `Dispatcher.notify` and drained with `Chain.objects.claim_queued`
+    """
 
-            self.log_event(
-                action='state_transition',
-                value=self.state,
-                requested_by=requested_by,
-            )
+    chain = models.OneToOneField('dispatcher.Chain', related_name='queued')
+    date_queued = models.DateTimeField(auto_now_add=True)
+    requested_by = models.CharField(max_length=100, blank=True)
 
-            return self.run_results(transition)
+    class Meta:
+        indexes = [
+            models.Index(fields=['date_queued'], name='dispatcher_queued_date_idx'),
+        ]
 
-        except:
-            logging.exception('Error executing chain: %s', traceback.format_exc())
-            self.unlock()
-            raise Exception(traceback.format_exc())
+
+class PendingCallbackQuerySet(models.QuerySet):
+
+    def due(self):
+        """
+        Callbacks to run by now, not given up on nor being run
+        """
+        now = timezone.now()
+        return self.filter(
+            models.Q(lock_expires__isnull=True) | models.Q(lock_expires__lt=now),
+            failed=False,
+            date_next_attempt__lte=now,
+        )
+
+    def claim(self, limit):
+        """
+        Lease and return up to `limit` due callbacks, the longest overdue
+        first. As with `ChainQuerySet.claim_due`, concurrent callers get
+        disjoint pages. A lease running out, e.g. because its worker died,
+        makes the callback due again.
+        """
+        now = timezone.now()
+        lock_owner = make_lock_owner()
+        queryset = self.due().order_by('date_next_attempt', 'pk')
+
+        with transaction.atomic(using=self.db):
+            if connections[self.db].features.has_select_for_update_skip_locked:
+                queryset = queryset.select_for_update(skip_locked=True)
+            callback_ids = list(queryset.values_list('pk', flat=True)[:limit])
+            self.filter(
+                models.Q(lock_expires__isnull=True) | models.Q(lock_expires__lt=now),
+                pk__in=callback_ids,
+            ).update(lock_owner=lock_owner, lock_expires=now + get_lock_lease())
+
+        return list(
+            self.filter(pk__in=callback_ids, lock_owner=lock_owner)
+            .select_related('chain')
+            .order_by('date_next_attempt', 'pk')
+        )
+
+
+class PendingCallback(models.Model):
+    """
+    Outbox of the callbacks of `execute(outbox=True)`, committed with the
+    transition they belong to and run by `dispatcher.outbox.drain`
+    """
+
+    chain = models.ForeignKey('dispatcher.Chain', related_name='pending_callbacks')
+    # dotted paths of the transition class and the `callback` passed to
+    # `execute`, if any
+    transition = models.CharField(max_length=200)
+    callback = models.CharField(max_length=200, blank=True)
+    context = models.TextField(default='{}')
+    callback_kwargs = models.TextField(default='{}')
+    # the same for every attempt, for the callback to deduplicate its effects
+    idempotency_key = models.CharField(max_length=32, unique=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    failed = models.BooleanField(default=False)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_next_attempt = models.DateTimeField()
+    lock_owner = models.CharField(max_length=100, null=True, blank=True)
+    lock_expires = models.DateTimeField(null=True, blank=True)
+
+    objects = PendingCallbackQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['failed', 'date_next_attempt'], name='dispatcher_outbox_due_idx'),
+        ]
+
+    @classmethod
+    def for_transition(cls, transition, options):
+        """
+        The unsaved callback of `transition`, None if there's nothing to run
+        """
+        callback_path = ''
+        if hasattr(transition, 'callback'):
+            callback = transition.callback
+        elif options['callback']:
+            callback = options['callback']
+            callback_path = options['callback_path']
+        else:
+            logging.warning('Nothing configured to happen during execution')
+            return None
+
+        iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', None)
+        if iscoroutinefunction and iscoroutinefunction(callback):
+            raise ValueError('The outbox only runs synchronous callbacks')
+
+        return cls(
+            chain=transition.chain,
+            transition=import_path(transition.__class__),
+            callback=callback_path,
+            context=json.dumps(transition.context, cls=DjangoJSONEncoder),
+            callback_kwargs=json.dumps(options['callback_kwargs'], cls=DjangoJSONEncoder),
+            idempotency_key=uuid.uuid4().hex,
+            date_next_attempt=timezone.now(),
+        )
+
+    def get_transition(self):
+        """
+        The transition to run the callback of, with the context it had when
+        it was taken. Values that aren't JSON types come back as strings.
+        """
+        Transition = import_string(self.transition)
+        transition = Transition(self.chain, json.loads(self.context))
+        transition.idempotency_key = self.idempotency_key
+        return transition
+
+    def get_options(self):
+        """
+        The `callback` and `callback_kwargs` passed to `execute`
+        """
+        return {
+            'callback': import_string(self.callback) if self.callback else None,
+            'callback_kwargs': json.loads(self.callback_kwargs),
+        }
+
+
+@receiver(post_save, sender=ChainResource)
+@receiver(post_delete, sender=ChainResource)
+def refresh_resource_key(sender, instance, **kwargs):
+    """
+    Keep `Chain.resource_key` in line with the chain's resources when they're
+    changed one by one. Bulk operations have to set the key themselves.
+    """
+    for chain_type, old_resource_key in Chain.objects.filter(
+            pk=instance.chain_id).values_list('chain_type', 'resource_key'):
+        # the chain isn't found by its previous resources anymore
+        invalidate_cached_chain(chain_type, old_resource_key)
+
+    rsc_mappings = ChainResource.objects.filter(
+        chain_id=instance.chain_id,
+    ).values_list('resource_type', 'resource_id')
+    resource_key = make_resource_key(rsc_mappings)
+    Chain.objects.filter(pk=instance.chain_id).update(resource_key=resource_key)
+
+    # so a later save() of the same chain doesn't write back the stale key
+    if ChainResource.chain.is_cached(instance):
+        instance.chain.resource_key = resource_key
+
+
+@receiver(post_save, sender=Chain)
+@receiver(post_delete, sender=Chain)
+def invalidate_chain(sender, instance, **kwargs):
+    """
+    Chains saved one by one, e.g. by `transition_to` or the admin, are
+    dropped from the chain cache. `execute` drops the chains it transitions.
+    """
+    invalidate_cached_chain(instance.chain_type, instance.resource_key)
@@ -0,0 +1,124 @@
+"""
+Callbacks run outside of the chains' locks.
+
+`chain.execute(outbox=True)` doesn't run the transition's callback while the
+chain is locked: a `PendingCallback` is committed along with the new state,
+and the lock is released right away. `drain` (see the
+`dispatcher_drain_outbox` command) runs the pending callbacks in a thread
+pool. A failed callback is retried with an exponential backoff, and kept as
+`failed` after `MAX_ATTEMPTS`:
+
+    DISPATCHER_OUTBOX = {
+        'BACKOFF': 30,        # seconds before the first retry, doubled every attempt
+        'MAX_BACKOFF': 3600,  # seconds
+        'MAX_ATTEMPTS': 10,
+    }
+
+A callback can run more than once, e.g. when its worker dies before
+recording that it ran. It should be idempotent: `transition.idempotency_key`
+is the same for every attempt, to deduplicate the effects with (say, as the
+idempotency key of a payment API). The callbacks of a chain's successive
+transitions can run out of order.
+"""
+import logging
+import traceback
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .metrics import increment
+from .models import PendingCallback
+
+DEFAULT_BACKOFF = 30
+DEFAULT_MAX_BACKOFF = 3600
+DEFAULT_MAX_ATTEMPTS = 10
+
+
+def get_outbox_setting(name, default):
+    return getattr(settings, 'DISPATCHER_OUTBOX', {}).get(name, default)
+
+
+def get_backoff(attempts):
+    """
+    How long to wait before retrying a callback that failed `attempts` times
+    """
+    backoff = get_outbox_setting('BACKOFF', DEFAULT_BACKOFF) * 2 ** (attempts - 1)
+    return timedelta(seconds=min(backoff, get_outbox_setting('MAX_BACKOFF', DEFAULT_MAX_BACKOFF)))
+
+
+def run_pending_callback(pending_callback):
+    """
+    Run a claimed callback. It's deleted once it ran, rescheduled if it
+    failed. Returns 'done', 'retry' or 'failed'.
+    """
+    try:
+        transition = pending_callback.get_transition()
+        pending_callback.chain.run_callback(transition, pending_callback.get_options())
+    except Exception:
+        logging.exception('Callback %s failed', pending_callback.pk)
+        return _reschedule(pending_callback, traceback.format_exc())
+
+    # only if the lease is still ours, whoever took it over runs it again
+    PendingCallback.objects.filter(
+        pk=pending_callback.pk, lock_owner=pending_callback.lock_owner,
+    ).delete()
+    return 'done'
+
+
+def _reschedule(pending_callback, error):
+    attempts = pending_callback.attempts + 1
+    failed = attempts >= get_outbox_setting('MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+    PendingCallback.objects.filter(
+        pk=pending_callback.pk, lock_owner=pending_callback.lock_owner,
+    ).update(
+        attempts=attempts,
+        failed=failed,
+        last_error=error,
+        date_next_attempt=timezone.now() + get_backoff(attempts),
+        lock_owner=None,
+        lock_expires=None,
+    )
+
+    labels = {'chain_type': pending_callback.chain.chain_type}
+    if failed:
+        increment('dispatcher_outbox_failed_total', **labels)
+        return 'failed'
+    increment('dispatcher_outbox_retries_total', **labels)
+    return 'retry'
+
+
+def _run_in_thread(pending_callback):
+    try:
+        return run_pending_callback(pending_callback)
+    finally:
+        # django connections are per thread, don't leave them dangling
+        connections.close_all()
+
+
+def drain(limit=100, max_workers=4):
+    """
+    Claim up to `limit` due callbacks and run them on `max_workers` threads.
+
+    Returns the number of callbacks {'done': ..., 'retry': ..., 'failed': ...}
+    """
+    counts = {'done': 0, 'retry': 0, 'failed': 0}
+    pending_callbacks = PendingCallback.objects.claim(limit)
+    if not pending_callbacks:
+        return counts
+
+    if max_workers > 1:
+        pool = ThreadPool(min(max_workers, len(pending_callbacks)))
+        try:
+            outcomes = pool.map(_run_in_thread, pending_callbacks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outcomes = [run_pending_callback(pending_callback) for pending_callback in pending_callbacks]
+
+    for outcome in outcomes:
+        counts[outcome] += 1
+    return counts
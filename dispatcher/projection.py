@@ -0,0 +1,139 @@
+"""
+Dry run of a whole population of chains: which would transition where, and
+what's blocking the others.
+
+Unlike `execute(dry_run=True)`, nothing is locked or written, the chains are
+only streamed through the transitions' `prefetch` and `find_transition`:
+
+    report = project(Chain.objects.due(['cart_reminder']))
+    print(format_report(report))
+"""
+from collections import Counter, OrderedDict
+
+from django.db.models.query import QuerySet
+
+from .dispatcher import chunked
+from .runner import prefetch_transitions
+
+OTHER = '(other)'
+
+
+class ErrorCollector(object):
+    """
+    Counts error reasons, keeping at most `max_reasons` of them and a few
+    sample chain ids each. Reasons past the limit are counted as `OTHER`,
+    so a run's memory doesn't grow with the number of chains.
+    """
+
+    def __init__(self, max_reasons=100, max_samples=5):
+        self.max_reasons = max_reasons
+        self.max_samples = max_samples
+        self.counts = Counter()
+        self.samples = {}
+
+    def add(self, reason, chain_id):
+        if reason not in self.counts and len(self.counts) >= self.max_reasons:
+            reason = OTHER
+
+        self.counts[reason] += 1
+        samples = self.samples.setdefault(reason, [])
+        if len(samples) < self.max_samples:
+            samples.append(chain_id)
+
+    def top(self, n):
+        return [
+            {'reason': reason, 'count': count, 'chain_ids': self.samples[reason]}
+            for reason, count in self.counts.most_common(n)
+        ]
+
+
+def _error_reasons(chain):
+    for transition, errors in sorted(chain.errors.items()):
+        if not errors:
+            yield '%s is not valid' % transition
+        for error in errors:
+            yield '%s: %s' % (transition, error)
+
+
+def project(chains, initial_context=None, chunk_size=500, top_errors=10, max_reasons=100):
+    """
+    Find the transition every chain would take, without locking or writing
+    anything.
+
+    Args:
+        chains: chains, or a queryset streamed with `.iterator()`
+        initial_context: passed on to the transitions, as in `Chain.execute`
+        chunk_size: number of chains prefetched and checked at a time
+        top_errors: number of error reasons reported
+        max_reasons: distinct error reasons tracked, see `ErrorCollector`
+
+    Returns:
+
+        {
+            'chains': number of chains checked,
+            'moves': [
+                {'from': 'new', 'to': 'reminded', 'transition': 'Remind', 'count': 12},
+                ...
+            ],
+            'blocked': {state: number of chains without a valid transition},
+            'failed': number of chains whose checks raised,
+            'errors': [{'reason': ..., 'count': ..., 'chain_ids': [...]}, ...],
+        }
+    """
+    if isinstance(chains, QuerySet):
+        chains = chains.iterator()
+
+    moves = Counter()
+    blocked = Counter()
+    failed = 0
+    errors = ErrorCollector(max_reasons=max_reasons)
+    total = 0
+
+    for chunk in chunked(chains, chunk_size):
+        prefetch_transitions(chunk, initial_context)
+        for chain in chunk:
+            total += 1
+            source = chain.state
+            try:
+                transition = chain.find_transition(initial_context)
+            except Exception as e:
+                failed += 1
+                errors.add('%s: %s' % (e.__class__.__name__, e), chain.pk)
+                continue
+
+            if transition:
+                moves[(source, transition.final_state, transition.__class__.__name__)] += 1
+            else:
+                blocked[source] += 1
+                for reason in _error_reasons(chain):
+                    errors.add(reason, chain.pk)
+
+            # don't keep what was prefetched for the chunk around
+            chain._prefetched = chain._errors = None
+
+    return {
+        'chains': total,
+        'moves': [
+            {'from': source, 'to': target, 'transition': name, 'count': count}
+            for (source, target, name), count in moves.most_common()
+        ],
+        'blocked': OrderedDict(blocked.most_common()),
+        'failed': failed,
+        'errors': errors.top(top_errors),
+    }
+
+
+def format_report(report):
+    lines = ['%s chains checked' % report['chains']]
+    for move in report['moves']:
+        lines.append('%(count)s chains would move from %(from)s to %(to)s (%(transition)s)' % move)
+    for state, count in report['blocked'].items():
+        lines.append('%s chains blocked in %s' % (count, state))
+    if report['failed']:
+        lines.append('%s chains failed to check' % report['failed'])
+    if report['errors']:
+        lines.append('Top error reasons:')
+        for error in report['errors']:
+            lines.append('  %s x %s (e.g. chains %s)' % (
+                error['count'], error['reason'], ', '.join(str(pk) for pk in error['chain_ids'])))
+    return '\n'.join(lines)
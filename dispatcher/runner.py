@@ -0,0 +1,266 @@
+import logging
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from django.db import connections
+
+from .cache import batch_scope
+from .constants import DONE
+from .events import buffered_events, flush_events
+from .metrics import increment
+from .scheduler import Scheduler
+
+THREAD = 'thread'
+PROCESS = 'process'
+ASYNCIO = 'asyncio'
+EXECUTORS = (THREAD, PROCESS, ASYNCIO)
+
+
+def prefetch_transitions(chains, context=None):
+    """
+    Call each transition class's `prefetch` once, with every chain currently
+    in one of its source states, and hand each chain its slice of the data.
+    This turns the per chain lookups of a batch into one per transition class.
+    A failing `prefetch` is logged, its transition's chains go without the
+    prefetched data rather than the batch failing.
+    """
+    chains_by_transition = OrderedDict()
+    for chain in chains:
+        graph = chain.graph
+        if chain.state == DONE:
+            candidates = (graph.done_transition, ) if graph.done_transition else ()
+        else:
+            candidates = graph.get_transitions(chain.state)
+
+        for Transition in candidates:
+            chains_by_transition.setdefault(Transition, []).append(chain)
+
+    for Transition, transition_chains in chains_by_transition.items():
+        try:
+            data = Transition.prefetch(transition_chains, context)
+        except Exception:
+            logging.exception('%s.prefetch failed', Transition.__name__)
+            continue
+        if not data:
+            continue
+
+        for chain in transition_chains:
+            if chain.pk in data:
+                chain.prefetched[Transition] = data[chain.pk]
+
+
+def _execute_chain(chain, execute_kwargs):
+    """
+    Execute a single chain, turning any failure into an error entry so one
+    chain can't take the whole batch down.
+    """
+    try:
+        return {
+            'chain_id': chain.pk,
+            'result': chain.execute(**dict(execute_kwargs)),
+            'error': None,
+        }
+    except Exception as e:
+        logging.warning('Chain %s failed to execute: %s', chain.pk, e)
+        return {
+            'chain_id': chain.pk,
+            'result': None,
+            'error': str(e),
+        }
+
+
+def _execute_chunk(args):
+    chains, execute_kwargs, batch = args
+    with batch_scope(batch), buffered_events():
+        try:
+            return [_execute_chain(chain, execute_kwargs) for chain in chains]
+        finally:
+            # the worker process inherited the buffering, write its events
+            # before handing the results back
+            flush_events()
+
+
+def _run_threads(chains, max_workers, execute_kwargs, events_scope=None, batch=None):
+    """
+    Execute the chains on `max_workers` threads, in the order given by a
+    `Scheduler`, within the `batch` scope and buffering their events in
+    `events_scope`. Returns the results and the scheduler's waits.
+    """
+    scheduler = Scheduler(chains)
+    condition = threading.Condition()
+    results = [None] * len(chains)
+
+    def next_chain():
+        with condition:
+            while True:
+                item, wait = scheduler.next()
+                if item is not None or not scheduler.pending:
+                    return item
+                # woken up by a chain being done, or when a token is due
+                condition.wait(wait)
+
+    def worker():
+        try:
+            with batch_scope(batch), buffered_events(events_scope):
+                while True:
+                    item = next_chain()
+                    if item is None:
+                        return
+                    i, chain = item
+                    try:
+                        results[i] = _execute_chain(chain, execute_kwargs)
+                    finally:
+                        with condition:
+                            scheduler.done(chain)
+                            condition.notify_all()
+        finally:
+            # django connections are per thread, don't leave them dangling
+            connections.close_all()
+
+    threads = [
+        threading.Thread(target=worker, name='dispatcher-worker-%s' % i)
+        for i in range(min(max_workers, len(chains)))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, scheduler.waits()
+
+
+def _run_processes(chains, max_workers, execute_kwargs, batch=None):
+    # forked children must not share the parent's database sockets, they
+    # open their own connections on first use
+    connections.close_all()
+    # nor write the events the parent has pending
+    flush_events()
+
+    chunk_size = max(1, len(chains) // (max_workers * 4))
+    chunks = [
+        (chains[i:i + chunk_size], execute_kwargs, batch)
+        for i in range(0, len(chains), chunk_size)
+    ]
+
+    pool = Pool(processes=max_workers)
+    try:
+        return [result for results in pool.map(_execute_chunk, chunks) for result in results]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_chains(chains, executor=THREAD, max_workers=4, **execute_kwargs):
+    """
+    Execute a batch of chains concurrently.
+
+    Args:
+        chains: chains to execute
+        executor: 'thread' (callbacks mostly waiting on I/O), 'process'
+            (CPU bound transitions) or 'asyncio' (see `dispatcher.aio`,
+            python 3 only). With processes, the chains, the transitions and
+            any callback have to be picklable, and the chain instances passed
+            in are not updated.
+        max_workers: number of threads or processes, or the number of chains
+            in flight at once on the event loop
+        execute_kwargs: passed on to every `Chain.execute` call
+
+    With threads and asyncio, the chains are handed out by a
+    `dispatcher.scheduler.Scheduler`, following the `max_concurrency`,
+    `rate_limit` and `weight` of their chain_type's config. The process
+    executor splits the batch upfront and doesn't apply them.
+
+    The transitions' `prefetch` hooks are called first, see
+    `prefetch_transitions`. The run is a `dispatcher.cache.batch_scope`:
+    whatever the transitions cache is shared by the whole batch and dropped
+    afterwards. The chains' events are written in bulk, see
+    `dispatcher.events.buffered_events`.
+
+    Returns the aggregated results:
+
+        {
+            'transitions': number of chains that transitioned,
+            'noops': number of chains without a valid transition,
+            'errors': number of chains that failed to execute,
+            'waits': {
+                chain_type: {'concurrency': seconds, 'rate_limit': seconds},
+                ...
+            },
+            'results': [
+                {'chain_id': 1, 'result': <Chain.execute result>, 'error': None},
+                ...
+            ],
+        }
+    """
+    if executor not in EXECUTORS:
+        raise ValueError('Invalid executor %s. Use one of %s' % (executor, EXECUTORS))
+
+    if max_workers < 1:
+        raise ValueError('max_workers must be at least 1')
+
+    chains = list(chains)
+    waits = {}
+    with batch_scope() as batch, buffered_events() as events_scope:
+        if not chains:
+            results = []
+        elif executor == THREAD:
+            prefetch_transitions(chains, execute_kwargs.get('initial_context'))
+            results, waits = _run_threads(chains, max_workers, execute_kwargs, events_scope, batch)
+        elif executor == PROCESS:
+            if any(_has_limits(chain) for chain in chains):
+                logging.warning('The process executor does not apply the chain types\' limits')
+            prefetch_transitions(chains, execute_kwargs.get('initial_context'))
+            results = _run_processes(chains, max_workers, execute_kwargs, batch)
+        else:
+            import asyncio
+            from .aio import arun_chains
+
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(
+                    arun_chains(chains, concurrency=max_workers, **execute_kwargs))
+            finally:
+                loop.close()
+
+    return summarize(results, waits)
+
+
+def _has_limits(chain):
+    limits = chain.graph.limits
+    return limits.max_concurrency is not None or limits.rate_limit is not None
+
+
+def summarize(results, waits=None):
+    """
+    Aggregate the per chain results of a batch run, and record how long each
+    chain_type waited on its limits
+    """
+    summary = {
+        'transitions': 0,
+        'noops': 0,
+        'errors': 0,
+        'waits': waits or {},
+        'results': results,
+    }
+    for chain_type, type_waits in summary['waits'].items():
+        for limit, seconds in type_waits.items():
+            if seconds:
+                increment(
+                    'dispatcher_scheduler_wait_seconds_total', seconds,
+                    chain_type=chain_type, limit=limit,
+                )
+
+    for result in results:
+        if result['error'] is not None:
+            summary['errors'] += 1
+        elif result['result']['transition']:
+            summary['transitions'] += 1
+        else:
+            summary['noops'] += 1
+
+    logging.info(
+        'Ran %s chains: %s transitions, %s no-ops, %s errors',
+        len(results), summary['transitions'], summary['noops'], summary['errors'],
+    )
+    return summary
@@ -0,0 +1,198 @@
+"""
+Fair dispatching of a batch's chains across chain types.
+
+Each chain_type's config can limit how its chains are executed by batch
+runs:
+
+    {
+        'chain_type': 'payment_reminder',
+        'transitions': {...},
+        'max_concurrency': 2,   # chains executing at once
+        'rate_limit': 5,        # chains started per second, on average
+        'burst': 10,            # chains started at once after being idle
+        'weight': 3,            # share of the batch's workers, relative to the other types
+    }
+
+The `Scheduler` hands out the chains of the type with the fewest chains
+started relative to its weight, among the types under their limits, and
+keeps track of how long each type waited on its limits.
+"""
+from collections import OrderedDict, deque
+from timeit import default_timer
+
+CONCURRENCY = 'concurrency'
+RATE_LIMIT = 'rate_limit'
+
+
+class TokenBucket(object):
+    """
+    `rate` tokens per second, up to `burst` saved up. Not thread safe.
+    """
+
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.last = default_timer() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self, now):
+        """
+        Take a token if there's one, returns whether it did
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now):
+        """
+        Seconds until a token is available
+        """
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class ChainTypeLimits(object):
+
+    def __init__(self, max_concurrency=None, rate_limit=None, burst=None, weight=1):
+        self.max_concurrency = max_concurrency
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.weight = weight
+
+    @classmethod
+    def from_config(cls, chain_config):
+        limits = cls(
+            max_concurrency=chain_config.get('max_concurrency'),
+            rate_limit=chain_config.get('rate_limit'),
+            burst=chain_config.get('burst'),
+            weight=chain_config.get('weight', 1),
+        )
+        limits.validate(chain_config.get('chain_type'))
+        return limits
+
+    def validate(self, chain_type):
+        if self.max_concurrency is not None and self.max_concurrency < 1:
+            raise ValueError('%s: max_concurrency must be at least 1' % chain_type)
+        if self.rate_limit is not None and self.rate_limit <= 0:
+            raise ValueError('%s: rate_limit must be positive' % chain_type)
+        if self.burst is not None and self.burst < 1:
+            raise ValueError('%s: burst must be at least 1' % chain_type)
+        if self.weight <= 0:
+            raise ValueError('%s: weight must be positive' % chain_type)
+
+
+class _TypeQueue(object):
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.pending = deque()
+        self.running = 0
+        self.started = 0
+        self.bucket = limits.rate_limit and TokenBucket(limits.rate_limit, limits.burst)
+        self.waits = {CONCURRENCY: 0.0, RATE_LIMIT: 0.0}
+        # (limit, since) while the type has chains held back by a limit
+        self.blocked = None
+
+    def block(self, limit, now):
+        if self.blocked and self.blocked[0] == limit:
+            return
+        self.unblock(now)
+        self.blocked = (limit, now)
+
+    def unblock(self, now):
+        if self.blocked:
+            limit, since = self.blocked
+            self.waits[limit] += now - since
+            self.blocked = None
+
+
+class Scheduler(object):
+    """
+    Hands out the chains of a batch following their chain types' limits.
+    Not thread safe, callers synchronize `next` and `done`.
+
+    Args:
+        chains: the batch, in the order to execute the chains of each type
+        max_in_flight: chains executing at once overall, if the caller doesn't
+            bound it already
+    """
+
+    def __init__(self, chains, max_in_flight=None):
+        self.max_in_flight = max_in_flight
+        self.running = 0
+        self.queues = OrderedDict()
+        for i, chain in enumerate(chains):
+            queue = self.queues.get(chain.chain_type)
+            if queue is None:
+                queue = self.queues[chain.chain_type] = _TypeQueue(chain.graph.limits)
+            queue.pending.append((i, chain))
+
+    @property
+    def pending(self):
+        return any(queue.pending for queue in self.queues.values())
+
+    def next(self):
+        """
+        Returns ((index, chain), None) for the next chain to execute, or
+        (None, seconds) when all the pending chains are held back: the time
+        until a rate limit lets one through, None if waiting on running chains
+        to be `done`. (None, None) once there's nothing left.
+        """
+        now = default_timer()
+        if self.max_in_flight is not None and self.running >= self.max_in_flight:
+            return None, None
+
+        eligible = []
+        wait = None
+        for chain_type, queue in self.queues.items():
+            if not queue.pending:
+                queue.unblock(now)
+                continue
+
+            limits = queue.limits
+            if limits.max_concurrency is not None and queue.running >= limits.max_concurrency:
+                queue.block(CONCURRENCY, now)
+                continue
+
+            if queue.bucket and queue.bucket.wait_time(now) > 0:
+                queue.block(RATE_LIMIT, now)
+                type_wait = queue.bucket.wait_time(now)
+                wait = type_wait if wait is None else min(wait, type_wait)
+                continue
+
+            queue.unblock(now)
+            eligible.append(queue)
+
+        if not eligible:
+            return None, wait
+
+        # stride scheduling: the type furthest behind its share goes first
+        queue = min(eligible, key=lambda q: float(q.started) / q.limits.weight)
+        if queue.bucket:
+            queue.bucket.take(now)
+        queue.started += 1
+        queue.running += 1
+        self.running += 1
+        return queue.pending.popleft(), None
+
+    def done(self, chain):
+        queue = self.queues[chain.chain_type]
+        queue.running -= 1
+        self.running -= 1
+
+    def waits(self):
+        """
+        Seconds spent with chains held back, per chain_type and limit
+        """
+        now = default_timer()
+        waits = {}
+        for chain_type, queue in self.queues.items():
+            queue.unblock(now)
+            waits[chain_type] = dict(queue.waits)
+        return waits
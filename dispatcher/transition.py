@@ -1,8 +1,41 @@
+import random
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+
+def to_datetime(value):
+    """
+    A `date_next_update` as an aware datetime: dates are the start of that
+    day and naive datetimes are in the current timezone
+    """
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time())
+    if settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    elif not settings.USE_TZ and timezone.is_aware(value):
+        value = timezone.make_naive(value)
+    return value
+
+
 class Transition:
 
+    # see `dispatcher.aio.AsyncTransition`
+    is_async = False
+
+    # when the chain is next due once transitioned, as a `timedelta` from
+    # now. Set `date_next_update` (a date or datetime) instead for a fixed time.
+    next_update_delay = None
+    # spread the chains' next updates randomly over this much longer than
+    # scheduled, a `timedelta`
+    next_update_jitter = None
+
     def __init__(self, chain, initial_context=None):
         self.chain = chain
         self.errors = []
+        # this chain's slice of what `prefetch` loaded for the batch
+        self.prefetched = chain.prefetched.get(self.__class__) if chain is not None else None
         self.context = dict(
             initial_context or {},
             **getattr(self, 'initial_context', {})
@@ -26,6 +59,37 @@ class Transition:
     def is_valid(self):
         raise NotImplementedError('%s has no `is_valid` function' % self)
 
+    @classmethod
+    def prefetch(cls, chains, context):
+        """
+        Batch hook, see `dispatcher.runner.prefetch_transitions`. Called once
+        per batch run with all the chains currently in one of this
+        transition's source states, and the batch's initial context.
+
+        Load what the transitions need for all of them in as few queries as
+        possible and return {chain.pk: data}, each transition then finds its
+        chain's data in `self.prefetched`.
+        """
+        return None
+
+    def get_date_next_update(self):
+        """
+        When the chain is next due once transitioned, or None to leave it as
+        it is. Computed once per transition, as the jitter is random.
+        """
+        if not hasattr(self, '_date_next_update'):
+            next_update = getattr(self, 'date_next_update', None)
+            if next_update is None and self.next_update_delay is not None:
+                next_update = timezone.now() + self.next_update_delay
+
+            if next_update is not None:
+                next_update = to_datetime(next_update)
+                if self.next_update_jitter:
+                    jitter = self.next_update_jitter.total_seconds()
+                    next_update += timedelta(seconds=random.uniform(0, jitter))
+            self._date_next_update = next_update
+        return self._date_next_update
+
     def to_dict(self):
         return {
             'errors': self.errors,
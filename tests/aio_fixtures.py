@@ -0,0 +1,46 @@
+import asyncio
+
+from dispatcher.aio import AsyncTransition
+
+
+class AsyncBaseTransition(AsyncTransition):
+
+    async def is_valid(self):
+        await asyncio.sleep(0)
+        return True
+
+
+class AsyncT1(AsyncBaseTransition):
+    final_state = 'async_t1_done'
+
+    async def callback(self, **kwargs):
+        await asyncio.sleep(0)
+        self.chain.callback_calls = getattr(self.chain, 'callback_calls', 0) + 1
+
+
+class AsyncT2(AsyncBaseTransition):
+    final_state = 'async_t2_done'
+
+    async def is_valid(self):
+        self.errors.append('Never valid')
+        return False
+
+
+async def async_callback(transition, **kwargs):
+    await asyncio.sleep(0)
+
+
+class AsyncSlowInvalid(AsyncTransition):
+    final_state = 'async_slow_invalid_done'
+
+    async def is_valid(self):
+        await asyncio.sleep(0.2)
+        return False
+
+
+class AsyncSlowValid(AsyncTransition):
+    final_state = 'async_slow_valid_done'
+
+    async def is_valid(self):
+        await asyncio.sleep(0.2)
+        return True
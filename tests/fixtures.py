@@ -1,4 +1,7 @@
-from dispatcher import Transition
+import datetime
+import time
+
+from dispatcher import DONE, Transition
 
 class BaseTransition(Transition):
     def is_valid(self):
@@ -21,3 +24,78 @@ class T3(BaseTransition):
 
 class T4(BaseTransition):
     final_state = 't4_done'
+
+
+# T1 and T2 get their `is_valid` swapped by some of the transition tests,
+# these always validate
+class Step1(BaseTransition):
+    final_state = 'step1_done'
+
+
+class Step2(BaseTransition):
+    final_state = 'step2_done'
+
+
+class SlowTransition(BaseTransition):
+    """
+    Takes `delay` seconds to validate, to `valid`
+    """
+    delay = 0.2
+    valid = True
+
+    def is_valid(self):
+        time.sleep(self.delay)
+        if not self.valid:
+            self.errors.append('%s is not valid' % self)
+        return self.valid
+
+
+class SlowInvalid(SlowTransition):
+    final_state = 'slow_invalid_done'
+    valid = False
+
+
+class SlowValid(SlowTransition):
+    final_state = 'slow_valid_done'
+
+
+class FastValid(SlowTransition):
+    final_state = 'fast_valid_done'
+    delay = 0
+
+
+class Done(BaseTransition):
+    final_state = DONE
+
+
+class Prefetching(BaseTransition):
+    """
+    Valid for chains whose id `prefetch` found
+    """
+    final_state = 'prefetched'
+    prefetch_calls = []
+
+    @classmethod
+    def prefetch(cls, chains, context):
+        cls.prefetch_calls.append(sorted(chain.pk for chain in chains))
+        return {chain.pk: {'found': True} for chain in chains if chain.pk % 2}
+
+    def is_valid(self):
+        return bool(self.prefetched and self.prefetched['found'])
+
+
+class Later(BaseTransition):
+    """
+    Schedules the chain's next update for tomorrow
+    """
+    final_state = 'later'
+
+    @property
+    def date_next_update(self):
+        return datetime.date.today() + datetime.timedelta(days=1)
+
+
+class InFourHours(BaseTransition):
+    final_state = 'in_four_hours'
+    next_update_delay = datetime.timedelta(hours=4)
+    next_update_jitter = datetime.timedelta(minutes=30)
@@ -0,0 +1,94 @@
+import datetime
+
+import mock
+from django.contrib.admin.sites import AdminSite
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+from dispatcher import Dispatcher
+from dispatcher.admin import (
+    ChainAdmin, ChainEventInLine, DateNextUpdateFilter, EstimatedCountPaginator,
+)
+from dispatcher.constants import NEW
+from dispatcher.models import Chain
+from dispatcher.transition import to_datetime
+from tests.fixtures import Step1
+
+
+def end_of_today():
+    tomorrow = timezone.localtime(timezone.now()).date() + datetime.timedelta(days=1)
+    return to_datetime(tomorrow) - datetime.timedelta(microseconds=1)
+
+
+class ChainAdminTest(TestCase):
+
+    def setUp(self):
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'admin_chain',
+            'transitions': {NEW: [Step1]},
+        }]})
+        self.chains = dispatcher.get_or_create_resource_chains([
+            ('admin_chain', [('booking', str(i)), ('customer', '1')]) for i in range(3)
+        ])
+        self.admin = ChainAdmin(Chain, AdminSite())
+        self.request = RequestFactory().get('/')
+
+    def test_search(self):
+        queryset = Chain.objects.all()
+
+        results, use_distinct = self.admin.get_search_results(self.request, queryset, 'booking:1')
+        self.assertEqual(list(results), [self.chains[1]])
+        self.assertFalse(use_distinct)
+
+        # no duplicates when several resources match
+        results, _ = self.admin.get_search_results(self.request, queryset, 'customer:1')
+        self.assertEqual(sorted(results, key=lambda c: c.pk), self.chains)
+
+        results, _ = self.admin.get_search_results(self.request, queryset, 'id:%s' % self.chains[2].pk)
+        self.assertEqual(list(results), [self.chains[2]])
+
+        # a number alone is a resource id, of any type
+        results, _ = self.admin.get_search_results(self.request, queryset, '2')
+        self.assertEqual(list(results), [self.chains[2]])
+        results, _ = self.admin.get_search_results(self.request, queryset, '1')
+        self.assertEqual(sorted(results, key=lambda c: c.pk), self.chains)
+
+        results, _ = self.admin.get_search_results(self.request, queryset, 'booking')
+        self.assertEqual(list(results), [])
+
+    def test_date_next_update_filter(self):
+        now = timezone.now()
+        Chain.objects.filter(pk=self.chains[1].pk).update(
+            date_next_update=min(now + datetime.timedelta(seconds=5), end_of_today()))
+        Chain.objects.filter(pk=self.chains[2].pk).update(date_next_update=now + datetime.timedelta(days=1))
+
+        def filtered(value):
+            list_filter = DateNextUpdateFilter(
+                self.request, {'date_next_update': value}, Chain, self.admin)
+            return sorted(c.pk for c in list_filter.queryset(self.request, Chain.objects.all()))
+
+        self.assertEqual(filtered('due'), [self.chains[0].pk])
+        self.assertEqual(filtered('today'), [self.chains[1].pk])
+        self.assertEqual(filtered('tomorrow'), [self.chains[2].pk])
+
+    def test_estimated_count(self):
+        queryset = Chain.objects.order_by('pk')
+        with mock.patch.object(EstimatedCountPaginator, 'estimate_count', return_value=5000000):
+            self.assertEqual(EstimatedCountPaginator(queryset, 100).count, 5000000)
+            # filtered lists are counted
+            self.assertEqual(EstimatedCountPaginator(queryset.filter(state=NEW), 100).count, 3)
+
+        with mock.patch.object(EstimatedCountPaginator, 'estimate_count', return_value=None):
+            self.assertEqual(EstimatedCountPaginator(queryset, 100).count, 3)
+
+    def test_latest_events(self):
+        chain = self.chains[0]
+        for i in range(60):
+            chain.log_event('test', str(i), 'test')
+
+        inline = ChainEventInLine(Chain, AdminSite())
+        FormSet = inline.get_formset(self.request, chain)
+        formset = FormSet(instance=chain)
+        self.assertEqual(
+            [form.instance.value for form in formset.initial_forms][:2] + [len(formset.forms)],
+            ['59', '58', 50],
+        )
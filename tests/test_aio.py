@@ -0,0 +1,90 @@
+import time
+from unittest import skipUnless
+
+from django.test import TransactionTestCase
+from django.utils import six
+from dispatcher import Dispatcher
+from dispatcher.constants import NEW
+from dispatcher.models import Chain
+from dispatcher.runner import run_chains
+from tests.fixtures import Step1
+
+if six.PY3:
+    import asyncio
+    from dispatcher.aio import afind_transition
+    from tests.aio_fixtures import (
+        AsyncT1, AsyncT2, AsyncSlowInvalid, AsyncSlowValid, async_callback,
+    )
+
+
+@skipUnless(six.PY3, 'asyncio is python 3 only')
+class AsyncExecuteTest(TransactionTestCase):
+
+    def setUp(self):
+        self.dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'async_chain',
+            'transitions': {
+                NEW: [AsyncT2, AsyncT1],
+                AsyncT1.final_state: [Step1],
+            }
+        }]})
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_aexecute(self):
+        chain = self.dispatcher.get_or_create_resource_chain('async_chain', [('rsc', '1')])
+
+        results = self.run_async(chain.aexecute())
+        self.assertEqual(chain.state, AsyncT1.final_state)
+        self.assertEqual(chain.callback_calls, 1)
+        self.assertEqual(results['errors']['<AsyncT2>'], ['Never valid'])
+        self.assertFalse(Chain.objects.get(pk=chain.pk).is_locked)
+
+        # synchronous transitions and async callbacks mix
+        self.run_async(chain.aexecute(callback=async_callback))
+        self.assertEqual(Chain.objects.get(pk=chain.pk).state, Step1.final_state)
+
+    def test_aexecute_steps(self):
+        chain = self.dispatcher.get_or_create_resource_chain('async_chain', [('rsc', '1')])
+
+        results = self.run_async(chain.aexecute(callback=async_callback, until_stable=True))
+        self.assertEqual(results['steps'], 2)
+        self.assertEqual(Chain.objects.get(pk=chain.pk).state, Step1.final_state)
+        self.assertEqual(
+            list(chain.events.order_by('pk').values_list('value', flat=True)),
+            [AsyncT1.final_state, Step1.final_state],
+        )
+
+    def test_concurrent_checks(self):
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'slow_chain',
+            'transitions': {
+                NEW: [AsyncSlowInvalid, AsyncSlowValid, AsyncT1],
+            }
+        }]})
+        chain = dispatcher.get_or_create_resource_chain('slow_chain', [('rsc', '1')])
+
+        start = time.time()
+        transition = self.run_async(afind_transition(chain, None, concurrent=True))
+        self.assertLess(time.time() - start, 0.35)
+        self.assertIsInstance(transition, AsyncSlowValid)
+        self.assertEqual(list(chain.errors), ['<AsyncSlowInvalid>'])
+
+    def test_execute_async_transition(self):
+        chain = self.dispatcher.get_or_create_resource_chain('async_chain', [('rsc', '1')])
+        with self.assertRaises(Exception):
+            chain.execute()
+        self.assertFalse(Chain.objects.get(pk=chain.pk).is_locked)
+
+    def test_run_chains(self):
+        chains = self.dispatcher.get_or_create_resource_chains([
+            ('async_chain', [('rsc', str(i))]) for i in range(20)
+        ])
+        results = run_chains(chains, executor='asyncio', max_workers=5)
+        self.assertEqual(results['transitions'], 20)
+        self.assertEqual(Chain.objects.filter(state=AsyncT1.final_state).count(), 20)
@@ -0,0 +1,208 @@
+import threading
+
+import mock
+from django.test import TestCase, override_settings
+from dispatcher import Dispatcher, Transition
+from dispatcher.cache import (
+    MISSING, DjangoCache, LocalCache, batch_scope, build_cache, cached_resource, get_chain_cache,
+    set_cache, set_chain_cache,
+)
+from dispatcher.constants import NEW
+from dispatcher.models import Chain, ChainResource
+from tests.fixtures import Step1
+
+loads = []
+
+
+class BookingTransition(Transition):
+
+    final_state = 'booking_checked'
+
+    def is_valid(self):
+        return self.get_booking(self.context['booking_id']) is not None
+
+    @cached_resource('booking')
+    def get_booking(self, booking_id):
+        loads.append(booking_id)
+        return {'id': booking_id}
+
+
+class LocalCacheTest(TestCase):
+
+    def test_lru(self):
+        cache = LocalCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+
+        # 'b' was the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_ttl(self):
+        cache = LocalCache(ttl=10)
+        with mock.patch('dispatcher.cache.time.time', return_value=100):
+            cache.set('a', 1)
+            cache.set('b', None, ttl=20)
+        with mock.patch('dispatcher.cache.time.time', return_value=115):
+            self.assertEqual(cache.get('a', 'missing'), 'missing')
+            self.assertIsNone(cache.get('b', 'missing'))
+
+    def test_build_cache(self):
+        self.assertIsInstance(build_cache({}), LocalCache)
+        self.assertIsInstance(build_cache({'BACKEND': 'django', 'TTL': 5}), DjangoCache)
+        with self.assertRaises(ValueError):
+            build_cache({'BACKEND': 'redis'})
+
+
+class CachedResourceTest(TestCase):
+
+    def setUp(self):
+        del loads[:]
+        self.addCleanup(set_cache, None)
+
+    def check_batch(self):
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'booking_chain',
+            'transitions': {NEW: [BookingTransition]},
+        }]})
+        chains = dispatcher.get_or_create_resource_chains([
+            ('booking_chain', [('booking', '1'), ('customer', str(i))]) for i in range(10)
+        ])
+        with batch_scope():
+            for chain in chains:
+                chain.execute(initial_context={'booking_id': '1'})
+        self.assertEqual(len(chains), 10)
+
+    def test_loaded_once_per_batch(self):
+        set_cache(LocalCache())
+        self.check_batch()
+        self.assertEqual(loads, ['1'])
+
+        # a new batch loads it again
+        with batch_scope():
+            BookingTransition(None).get_booking('1')
+            BookingTransition(None).get_booking('1')
+        self.assertEqual(loads, ['1', '1'])
+
+    def test_outside_batch(self):
+        set_cache(LocalCache())
+        BookingTransition(None).get_booking('1')
+        BookingTransition(None).get_booking('1')
+        self.assertEqual(loads, ['1', '1'])
+
+    def test_thread_scope(self):
+        set_cache(LocalCache())
+
+        def load(scope=None):
+            if scope is None:
+                BookingTransition(None).get_booking('1')
+            else:
+                with batch_scope(scope):
+                    BookingTransition(None).get_booking('1')
+
+        def in_thread(*args):
+            thread = threading.Thread(target=load, args=args)
+            thread.start()
+            thread.join()
+
+        with batch_scope() as scope:
+            load()
+            # other threads don't share the batch's cache
+            in_thread()
+            in_thread()
+            self.assertEqual(loads, ['1', '1', '1'])
+
+            # unless they join it
+            in_thread(scope)
+            self.assertEqual(loads, ['1', '1', '1'])
+
+    def test_extra_arguments(self):
+        with batch_scope(), self.assertRaises(TypeError):
+            BookingTransition(None).get_booking('1', 'other')
+        self.assertEqual(loads, [])
+
+    @override_settings(DISPATCHER_CACHE={'BACKEND': 'django', 'TTL': 60})
+    def test_django_backend(self):
+        set_cache(None)
+        self.check_batch()
+        self.assertEqual(loads, ['1'])
+
+
+class ChainCacheTest(TestCase):
+
+    def setUp(self):
+        set_chain_cache(LocalCache())
+        self.addCleanup(set_chain_cache, MISSING)
+        self.dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'cached_chain',
+            'transitions': {NEW: [Step1]},
+        }]})
+        self.rsc_mappings = [('booking', '1'), ('customer', '2')]
+        self.chain = self.dispatcher.get_or_create_resource_chain('cached_chain', self.rsc_mappings)
+
+    def get_chain(self):
+        return self.dispatcher.get_or_create_resource_chain('cached_chain', self.rsc_mappings)
+
+    def test_read_through(self):
+        with self.assertNumQueries(0):
+            chain = self.get_chain()
+            self.assertEqual((chain.pk, chain.state), (self.chain.pk, NEW))
+
+        # the other fields are loaded on access
+        with self.assertNumQueries(1):
+            self.assertEqual(chain.date_next_update, self.chain.date_next_update)
+
+    def test_state_change(self):
+        self.chain.execute(callback=lambda transition: None)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_chain().state, Step1.final_state)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_chain().state, Step1.final_state)
+
+        Chain.objects.get(pk=self.chain.pk).transition_to(NEW)
+        self.assertEqual(self.get_chain().state, NEW)
+
+    def test_stale_state(self):
+        # written behind the cache's back
+        Chain.objects.filter(pk=self.chain.pk).update(state=Step1.final_state)
+
+        callbacks = []
+        stale = self.get_chain()
+        self.assertEqual(stale.state, NEW)
+        results = stale.execute(callback=callbacks.append)
+
+        # no transition out of step1_done, NEW -> step1_done isn't run again
+        self.assertEqual(callbacks, [])
+        self.assertIsNone(results['transition'])
+        self.assertEqual(stale.state, Step1.final_state)
+        self.assertFalse(self.chain.events.exists())
+        self.assertFalse(Chain.objects.get(pk=self.chain.pk).is_locked)
+        self.assertEqual(self.get_chain().state, Step1.final_state)
+
+    def test_resources_change(self):
+        ChainResource.objects.create(chain=self.chain, resource_type='departure', resource_id='3')
+
+        # the previous resources don't match the chain anymore
+        self.assertNotEqual(self.get_chain().pk, self.chain.pk)
+        chain = self.dispatcher.get_or_create_resource_chain(
+            'cached_chain', self.rsc_mappings + [('departure', '3')])
+        self.assertEqual(chain.pk, self.chain.pk)
+
+    def test_subset_not_cached(self):
+        with self.assertNumQueries(1):
+            self.dispatcher.get_or_create_resource_chain(
+                'cached_chain', self.rsc_mappings[:1], can_be_subset=True)
+
+    def test_disabled(self):
+        set_chain_cache(MISSING)
+        self.assertIsNone(get_chain_cache())
+        with self.assertNumQueries(1):
+            self.get_chain()
+
+        with override_settings(DISPATCHER_CHAIN_CACHE={'BACKEND': 'local', 'MAX_SIZE': 10}):
+            set_chain_cache(MISSING)
+            self.assertIsInstance(get_chain_cache(), LocalCache)
@@ -1,12 +1,16 @@
+import datetime
+
 import mock
 from django.test import TestCase
 from django.conf import settings
+from django.utils import timezone
 from django.db import IntegrityError, transaction
 from dispatcher.dispatcher import Dispatcher
-from dispatcher.models import ChainResource
+from dispatcher import Transition
+from dispatcher.models import Chain, ChainResource, QueuedChain, make_resource_key
 from dispatcher.constants import NEW, DONE
 from tests.fixtures import (
-    T1, T2, T3, T4
+    T1, T2, T3, T4, Done,
 )
 
 dispatcher_config = {'chains': [{
@@ -76,3 +80,280 @@ class DispatcherTest(TestCase):
         ]
         chain1 = dispatcher.get_or_create_resource_chain('sample_chain', rsc_map)
         self.assertEqual(len(chain1.resources.all()), 1)
+
+    def test_bulk_get_chains(self):
+        dispatcher = Dispatcher(dispatcher_config)
+        existing = dispatcher.get_or_create_resource_chain('sample_chain', [('rsc1', '123')])
+
+        chains = dispatcher.get_or_create_resource_chains([
+            ('sample_chain', [('rsc1', '123')]),
+            ('sample_chain', [('rsc1', '456'), ('rsc2', '789')]),
+            ('sample_chain', [('rsc2', '789'), ('rsc1', '456')]),
+            ('sample_chain', [('rsc1', '123'), ('rsc2', '789')]),
+        ])
+        self.assertEqual(len(chains), 4)
+        self.assertEqual(chains[0], existing)
+        self.assertEqual(chains[1], chains[2])
+        self.assertNotEqual(chains[1], chains[3])
+        self.assertNotEqual(chains[0], chains[3])
+        self.assertEqual(
+            {(r.resource_type, r.resource_id) for r in chains[3].resources.all()},
+            {('rsc1', '123'), ('rsc2', '789')},
+        )
+        self.assertEqual(chains[3].state, NEW)
+
+        # resolving again creates nothing new and keeps the input order
+        again = dispatcher.get_or_create_resource_chains([
+            ('sample_chain', [('rsc1', '123'), ('rsc2', '789')]),
+            ('sample_chain', [('rsc1', '123')]),
+        ])
+        self.assertEqual(again, [chains[3], chains[0]])
+
+        subset = dispatcher.get_or_create_resource_chains(
+            [('sample_chain', [('rsc1', '456')])],
+            can_be_subset=True,
+        )
+        self.assertEqual(subset, [chains[1]])
+
+    def test_bulk_create_subsets(self):
+        dispatcher = Dispatcher(dispatcher_config)
+        chains = dispatcher.get_or_create_resource_chains([
+            ('sample_chain', [('rsc1', 'a'), ('rsc2', 'b')]),
+            ('sample_chain', [('rsc1', 'a')]),
+            ('sample_chain', [('rsc2', 'b')]),
+        ], can_be_subset=True)
+
+        # the same as resolving them one by one
+        self.assertEqual(chains, [chains[0]] * 3)
+        self.assertEqual(Chain.objects.filter(resources__resource_id='a').count(), 1)
+        self.assertEqual(
+            dispatcher.get_or_create_resource_chain('sample_chain', [('rsc1', 'a')], can_be_subset=True),
+            chains[0],
+        )
+
+        with self.assertRaises(ValueError):
+            dispatcher.get_or_create_resource_chains([
+                ('sample_chain', [('rsc1', 'c'), ('rsc2', 'd')]),
+                ('sample_chain', [('rsc1', 'c'), ('rsc3', 'e')]),
+                ('sample_chain', [('rsc1', 'c')]),
+            ], can_be_subset=True)
+
+    def test_resource_key(self):
+        dispatcher = Dispatcher(dispatcher_config)
+        rsc_map = [('rsc1', '123'), ('rsc2', '456')]
+        chain = dispatcher.get_or_create_resource_chain('sample_chain', rsc_map)
+        self.assertEqual(chain.resource_key, make_resource_key(reversed(rsc_map)))
+
+        # a worker that lost the race to create the chain gets the winner's
+        chain2 = dispatcher._create_chain('sample_chain', rsc_map)
+        self.assertEqual(chain, chain2)
+        self.assertEqual(ChainResource.objects.filter(chain=chain).count(), 2)
+
+        # the same resources under another chain_type are another chain
+        other_config = {'chains': [dict(dispatcher_config['chains'][0], chain_type='other_chain')]}
+        other = Dispatcher(other_config).get_or_create_resource_chain('other_chain', rsc_map)
+        self.assertNotEqual(chain, other)
+
+        # adding resources one at a time keeps the key up to date
+        ChainResource.objects.create(chain=chain, resource_type='rsc3', resource_id='789')
+        chain.refresh_from_db()
+        self.assertEqual(chain.resource_key, make_resource_key(rsc_map + [('rsc3', '789')]))
+
+        # saving the chain afterwards doesn't write back its previous key
+        ChainResource(chain=chain, resource_type='rsc4', resource_id='012').save()
+        chain.save()
+        rsc_map += [('rsc3', '789'), ('rsc4', '012')]
+        self.assertEqual(Chain.objects.get(pk=chain.pk).resource_key, make_resource_key(rsc_map))
+        self.assertEqual(dispatcher.get_or_create_resource_chain('sample_chain', rsc_map), chain)
+
+    def test_subset_match_query(self):
+        dispatcher = Dispatcher(dispatcher_config)
+        chain = dispatcher.get_or_create_resource_chain('sample_chain', [
+            ('rsc1', '123'),
+            ('rsc2', '456'),
+            ('rsc3', '789'),
+        ])
+        # shares a resource, but doesn't have all of the requested ones
+        dispatcher.get_or_create_resource_chain('sample_chain', [('rsc1', '123'), ('rsc4', '000')])
+
+        with self.assertNumQueries(1):
+            found = dispatcher.get_or_create_resource_chain(
+                'sample_chain',
+                [('rsc1', '123'), ('rsc2', '456'), ('rsc1', '123')],
+                can_be_subset=True,
+            )
+        self.assertEqual(found, chain)
+
+        # chains of other types are never matched
+        other_config = {'chains': [dict(dispatcher_config['chains'][0], chain_type='other_chain')]}
+        other = Dispatcher(other_config).get_or_create_resource_chain(
+            'other_chain', [('rsc1', '123'), ('rsc2', '456')], can_be_subset=True)
+        self.assertNotEqual(other, chain)
+        self.assertEqual(other.chain_type, 'other_chain')
+
+    def test_compiled_config(self):
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'sample_chain',
+            'transitions': {
+                NEW: [T1, T2],
+                T1.final_state: [T3, Done],
+                T2.final_state: [T4],
+            }
+        }]})
+        graph = dispatcher.graphs['sample_chain']
+        self.assertEqual(graph.get_transitions(NEW), (T1, T2))
+        self.assertEqual(graph.get_transitions('nope'), ())
+        self.assertEqual(graph.done_transition, Done)
+
+        # chains share the graph, loaded from the database or not
+        chain = dispatcher.get_or_create_resource_chain('sample_chain', [('rsc1', '123')])
+        self.assertIs(chain.graph, graph)
+        self.assertIs(Chain.objects.get(pk=chain.pk).graph, graph)
+
+        chain.state = DONE
+        self.assertIsInstance(chain.find_transition(None), Done)
+
+    def test_dispatcher_graphs(self):
+        config = {'chains': [{'chain_type': 'owned_chain', 'transitions': {NEW: [T1]}}]}
+        dispatcher = Dispatcher(config)
+        chain = dispatcher.get_or_create_resource_chain('owned_chain', [('rsc1', '123')])
+        self.assertIs(chain.graph, dispatcher.graphs['owned_chain'])
+        self.assertIs(
+            dispatcher.get_or_create_resource_chains([('owned_chain', [('rsc1', '123')])])[0].graph,
+            dispatcher.graphs['owned_chain'],
+        )
+
+        # another config for the same chain_type replaces the registered one,
+        # the chains already returned keep theirs
+        other = Dispatcher({'chains': [{'chain_type': 'owned_chain', 'transitions': {NEW: [T2]}}]})
+        self.assertEqual(chain.graph.get_transitions(NEW), (T1, ))
+        self.assertEqual(
+            other.get_or_create_resource_chain('owned_chain', [('rsc1', '123')]).graph.get_transitions(NEW),
+            (T2, ),
+        )
+
+        # chains loaded from the database fall back on the registered config
+        self.assertEqual(Chain.objects.get(pk=chain.pk).graph.get_transitions(NEW), (T2, ))
+
+    def test_invalid_config(self):
+        class NoFinalState(Transition):
+            pass
+
+        for transitions in (
+            {T1.final_state: [T3]},
+            {NEW: [T1, NoFinalState]},
+            {NEW: [T1], T2.final_state: [T4]},
+        ):
+            with self.assertRaises(ValueError):
+                Dispatcher({'chains': [{'chain_type': 'bad', 'transitions': transitions}]})
+
+        with self.assertRaises(ValueError):
+            Dispatcher({'chains': [
+                {'chain_type': 'twice', 'transitions': {NEW: [T1]}},
+                {'chain_type': 'twice', 'transitions': {NEW: [T2]}},
+            ]})
+
+
+class NotifyTest(TestCase):
+
+    def setUp(self):
+        self.dispatcher = Dispatcher(dispatcher_config)
+        self.chains = self.dispatcher.get_or_create_resource_chains([
+            ('sample_chain', [('booking', '1'), ('customer', str(i))]) for i in range(3)
+        ])
+        self.other = self.dispatcher.get_or_create_resource_chain(
+            'sample_chain', [('booking', '2'), ('customer', '1')])
+
+    def test_notify(self):
+        tomorrow = timezone.now() + datetime.timedelta(days=1)
+        Chain.objects.update(date_next_update=tomorrow)
+        Chain.objects.filter(pk=self.chains[2].pk).update(disabled=True)
+
+        self.assertEqual(self.dispatcher.notify('booking', 1, requested_by='payment'), 2)
+        # notifying again doesn't queue them twice
+        self.assertEqual(self.dispatcher.notify('booking', '1'), 2)
+        self.assertEqual(self.dispatcher.notify('booking', '3'), 0)
+
+        queued = QueuedChain.objects.order_by('pk')
+        self.assertEqual([item.chain_id for item in queued], [self.chains[0].pk, self.chains[1].pk])
+        self.assertEqual(queued[0].requested_by, 'payment')
+        self.assertEqual(
+            set(Chain.objects.filter(date_next_update__lte=timezone.now()).values_list('pk', flat=True)),
+            {self.chains[0].pk, self.chains[1].pk},
+        )
+
+    def test_claim_queued(self):
+        self.dispatcher.notify('customer', '1')
+        Chain.objects.get(pk=self.chains[1].pk).lock()
+
+        claimed = Chain.objects.claim_queued(10)
+        self.assertEqual(claimed, [self.other])
+        self.assertTrue(claimed[0].is_locked)
+
+        # the locked chain stays queued
+        self.assertEqual(
+            list(QueuedChain.objects.values_list('chain_id', flat=True)), [self.chains[1].pk])
+        self.assertEqual(Chain.objects.claim_queued(10), [])
+
+        claimed[0].execute()
+        self.assertNotEqual(Chain.objects.get(pk=self.other.pk).state, NEW)
+
+    def test_claim_queued_rescheduled(self):
+        self.dispatcher.notify('customer', '1')
+        # executed by a scheduled run since it was queued
+        tomorrow = timezone.now() + datetime.timedelta(days=1)
+        Chain.objects.filter(pk=self.chains[1].pk).update(date_next_update=tomorrow)
+
+        self.assertEqual(Chain.objects.claim_queued(10), [self.other])
+        self.assertFalse(QueuedChain.objects.exists())
+        self.assertFalse(Chain.objects.get(pk=self.chains[1].pk).is_locked)
+
+    def test_claim_queued_locked_head(self):
+        self.dispatcher.notify('customer', '1')
+        Chain.objects.get(pk=self.chains[1].pk).lock()
+
+        # the head of the queue is locked, the next chain is claimed instead
+        self.assertEqual(Chain.objects.claim_queued(1), [self.other])
+        self.assertEqual(
+            list(QueuedChain.objects.values_list('chain_id', flat=True)), [self.chains[1].pk])
+
+
+class IterChainsForResourcesTest(TestCase):
+
+    def setUp(self):
+        self.dispatcher = Dispatcher(dispatcher_config)
+        self.chains = self.dispatcher.get_or_create_resource_chains([
+            ('sample_chain', [('departure', '1'), ('booking', str(i))]) for i in range(5)
+        ])
+        self.other = self.dispatcher.get_or_create_resource_chain(
+            'sample_chain', [('departure', '2'), ('booking', '0')])
+
+    def test_iter_chains(self):
+        with self.assertNumQueries(4):
+            # the chains, then their resources two chains at a time
+            chains = list(self.dispatcher.iter_chains_for_resources([('departure', '1')], chunk_size=2))
+            resources = [
+                sorted((rsc.resource_type, rsc.resource_id) for rsc in chain.resources.all())
+                for chain in chains
+            ]
+
+        self.assertEqual(chains, self.chains)
+        self.assertEqual(resources, [[('booking', str(i)), ('departure', '1')] for i in range(5)])
+
+    def test_filters(self):
+        iter_chains = self.dispatcher.iter_chains_for_resources
+        self.assertEqual(
+            list(iter_chains([('booking', '0')])),
+            [self.chains[0], self.other],
+        )
+        self.assertEqual(
+            list(iter_chains([('booking', '0'), ('booking', '1')], chain_type='sample_chain')),
+            self.chains[:2] + [self.other],
+        )
+        self.assertEqual(list(iter_chains([('booking', '0')], chain_type='other_chain')), [])
+
+        Chain.objects.filter(pk=self.other.pk).update(state=DONE)
+        self.assertEqual(list(iter_chains([('booking', '0')], state=DONE)), [self.other])
+
+        with self.assertRaises(ValueError):
+            iter_chains([('booking', 0)])
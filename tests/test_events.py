@@ -0,0 +1,207 @@
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.utils.six import StringIO
+from dispatcher import Dispatcher
+from dispatcher.constants import NEW
+from dispatcher.events import (
+    DatabaseSink, EventSink, JSONLSink, NullSink, buffered_events, build_sink, get_sink, set_sink,
+)
+from dispatcher.models import ChainEvent
+from tests.fixtures import Step1
+
+
+class RecordingSink(EventSink):
+
+    def __init__(self, **kwargs):
+        super(RecordingSink, self).__init__(**kwargs)
+        self.written = []
+
+    def write(self, events):
+        self.written.append(events)
+
+    def values(self):
+        return [[event['value'] for event in events] for events in self.written]
+
+
+class EventSinkTest(TestCase):
+
+    def setUp(self):
+        self.addCleanup(set_sink, None)
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'events_chain',
+            'transitions': {NEW: [Step1]},
+        }]})
+        self.chains = dispatcher.get_or_create_resource_chains([
+            ('events_chain', [('rsc', str(i))]) for i in range(5)
+        ])
+
+    def execute_all(self):
+        for chain in self.chains:
+            chain.execute(callback=mock.Mock(), requested_by='test')
+
+    def test_build_sink(self):
+        self.assertIsInstance(build_sink({}), DatabaseSink)
+        self.assertIsInstance(build_sink({'BACKEND': 'null'}), NullSink)
+        self.assertIsInstance(build_sink({'BACKEND': 'jsonl', 'PATH': 'events.jsonl'}), JSONLSink)
+        with self.assertRaises(ValueError):
+            build_sink({'BACKEND': 'jsonl'})
+        with self.assertRaises(ValueError):
+            build_sink({'BACKEND': 'kafka'})
+
+    def test_unbuffered(self):
+        set_sink(DatabaseSink(batch_size=100))
+        self.chains[0].execute(callback=mock.Mock(), requested_by='test')
+        self.assertEqual(ChainEvent.objects.filter(chain=self.chains[0]).count(), 1)
+
+    def test_buffered(self):
+        set_sink(DatabaseSink(batch_size=2))
+        with mock.patch.object(ChainEvent.objects, 'bulk_create', wraps=ChainEvent.objects.bulk_create) as bulk_create:
+            with buffered_events():
+                self.execute_all()
+                # flushed in pairs, the last one is still pending
+                self.assertEqual(ChainEvent.objects.count(), 4)
+            self.assertEqual(ChainEvent.objects.count(), 5)
+        self.assertEqual(bulk_create.call_count, 3)
+
+    def test_flush_interval(self):
+        set_sink(DatabaseSink(batch_size=100, flush_interval=10))
+        with buffered_events(), mock.patch('dispatcher.events.time') as time:
+            time.time.return_value = 100
+            self.chains[0].execute(callback=mock.Mock())
+            self.assertEqual(ChainEvent.objects.count(), 0)
+
+            time.time.return_value = 110
+            self.chains[1].execute(callback=mock.Mock())
+            self.assertEqual(ChainEvent.objects.count(), 2)
+
+    def test_thread_scope(self):
+        sink = RecordingSink(batch_size=100)
+
+        def emit(value, scope=None):
+            if scope is None:
+                sink.emit(self.chains[0], 'state_transition', value, 'test')
+            else:
+                with buffered_events(scope):
+                    sink.emit(self.chains[0], 'state_transition', value, 'test')
+
+        def in_thread(*args):
+            thread = threading.Thread(target=emit, args=args)
+            thread.start()
+            thread.join()
+
+        with buffered_events() as scope:
+            emit('buffered')
+            # other threads aren't buffering, unless they join the scope
+            in_thread('other')
+            in_thread('joined', scope)
+            self.assertEqual(sink.values(), [['other']])
+
+        self.assertEqual(sink.values(), [['other'], ['buffered', 'joined']])
+
+    def test_jsonl_chain_type(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'events.jsonl')
+
+        with override_settings(DISPATCHER_EVENTS={
+            'CHAIN_TYPES': {'events_chain': {'BACKEND': 'jsonl', 'PATH': path}},
+        }):
+            set_sink(None)
+            with buffered_events():
+                self.execute_all()
+
+        self.assertFalse(ChainEvent.objects.exists())
+        self.assertIsInstance(get_sink(), DatabaseSink)
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(
+            [(e['chain_id'], e['action'], e['value']) for e in events],
+            [(chain.pk, 'state_transition', Step1.final_state) for chain in self.chains],
+        )
+
+    def test_null(self):
+        set_sink(NullSink())
+        with buffered_events():
+            self.execute_all()
+        self.assertFalse(ChainEvent.objects.exists())
+
+
+class ArchiveEventsTest(TestCase):
+
+    def setUp(self):
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'events_chain',
+            'transitions': {NEW: [Step1]},
+        }]})
+        self.chains = dispatcher.get_or_create_resource_chains([
+            ('events_chain', [('rsc', str(i))]) for i in range(2)
+        ])
+        today = datetime.date.today()
+        for chain in self.chains:
+            for days in (30, 20, 10, 0):
+                chain.log_event('state_transition', 'day_%s' % days, 'test')
+                ChainEvent.objects.filter(value='day_%s' % days).update(
+                    date_created=today - datetime.timedelta(days=days))
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'events.jsonl.gz')
+
+    def archive(self, *args):
+        out = StringIO()
+        call_command('dispatcher_archive_events', *args, stdout=out)
+        return out.getvalue().strip()
+
+    def archived(self):
+        with gzip.open(self.path, 'rb') as f:
+            return [json.loads(line.decode('utf-8')) for line in f]
+
+    def remaining(self, chain):
+        return list(chain.events.order_by('pk').values_list('value', flat=True))
+
+    def test_older_than(self):
+        out = self.archive('--older-than', '15', '--output', self.path, '--chunk-size', '3')
+        self.assertEqual(out, 'Archived 4 events of 2 chains to %s' % self.path)
+
+        self.assertEqual(
+            sorted((e['chain_id'], e['value']) for e in self.archived()),
+            sorted((chain.pk, value) for chain in self.chains for value in ('day_30', 'day_20')),
+        )
+        for chain in self.chains:
+            self.assertEqual(self.remaining(chain), ['day_10', 'day_0'])
+
+    def test_keep_last(self):
+        self.archive('--keep-last', '1', '--older-than', '15', '--output', self.path, '--summary')
+
+        for chain in self.chains:
+            self.assertEqual(self.remaining(chain), [
+                'day_10', 'day_0',
+                '2 events from %s to %s' % (
+                    datetime.date.today() - datetime.timedelta(days=30),
+                    datetime.date.today() - datetime.timedelta(days=20),
+                ),
+            ])
+
+        self.archive('--keep-last', '2', '--no-archive')
+        for chain in self.chains:
+            self.assertEqual(len(self.remaining(chain)), 2)
+
+    def test_dry_run(self):
+        out = self.archive('--keep-last', '0', '--no-archive', '--dry-run')
+        self.assertEqual(out, 'Would archive 8 events of 2 chains')
+        self.assertEqual(ChainEvent.objects.count(), 8)
+
+    def test_options(self):
+        with self.assertRaises(CommandError):
+            self.archive('--output', self.path)
+        with self.assertRaises(CommandError):
+            self.archive('--older-than', '10')
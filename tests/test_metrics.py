@@ -0,0 +1,100 @@
+import mock
+from django.test import TestCase
+from dispatcher import Dispatcher
+from dispatcher.constants import NEW
+from dispatcher.metrics import MetricsRegistry, metric_recorded, registry
+from dispatcher.models import Chain
+from tests.fixtures import SlowInvalid, Step1
+
+
+class MetricsRegistryTest(TestCase):
+
+    def test_render(self):
+        metrics = MetricsRegistry(buckets=(0.1, 1, float('inf')))
+        metrics.increment('dispatcher_noops_total', chain_type='a', state='new')
+        metrics.increment('dispatcher_noops_total', chain_type='a', state='new')
+        metrics.increment('custom_total', label='say "hi"\n')
+        metrics.observe('dispatcher_lock_seconds', 0.5, chain_type='a', state='new')
+
+        self.assertEqual(metrics.get('dispatcher_noops_total', chain_type='a', state='new'), 2)
+        self.assertEqual(metrics.get('dispatcher_lock_seconds', chain_type='a', state='new'), (0.5, 1))
+        self.assertEqual(metrics.render().splitlines(), [
+            '# HELP dispatcher_lock_seconds Time to acquire the lock of a chain',
+            '# TYPE dispatcher_lock_seconds histogram',
+            'dispatcher_lock_seconds_bucket{chain_type="a",state="new",le="0.1"} 0',
+            'dispatcher_lock_seconds_bucket{chain_type="a",state="new",le="1"} 1',
+            'dispatcher_lock_seconds_bucket{chain_type="a",state="new",le="+Inf"} 1',
+            'dispatcher_lock_seconds_sum{chain_type="a",state="new"} 0.5',
+            'dispatcher_lock_seconds_count{chain_type="a",state="new"} 1',
+            '# HELP dispatcher_noops_total Executions without a valid transition',
+            '# TYPE dispatcher_noops_total counter',
+            'dispatcher_noops_total{chain_type="a",state="new"} 2',
+            '# TYPE custom_total counter',
+            'custom_total{label="say \\"hi\\"\\n"} 1',
+        ])
+
+
+class ExecuteMetricsTest(TestCase):
+
+    def setUp(self):
+        registry.clear()
+        self.addCleanup(registry.clear)
+        dispatcher = Dispatcher({'chains': [
+            {'chain_type': 'metrics_chain', 'transitions': {NEW: [Step1]}},
+            {'chain_type': 'metrics_noop_chain', 'transitions': {NEW: [SlowInvalid]}},
+        ]})
+        self.chain = dispatcher.get_or_create_resource_chain('metrics_chain', [('rsc', '1')])
+        self.noop_chain = dispatcher.get_or_create_resource_chain('metrics_noop_chain', [('rsc', '1')])
+
+    def test_execute(self):
+        received = []
+
+        def receiver(sender, name, kind, value, labels, **kwargs):
+            received.append(name)
+        metric_recorded.connect(receiver)
+        self.addCleanup(metric_recorded.disconnect, receiver)
+
+        self.chain.execute(callback=mock.Mock())
+
+        labels = {'chain_type': 'metrics_chain', 'state': NEW}
+        transition_labels = dict(labels, transition='Step1')
+        self.assertEqual(registry.get('dispatcher_lock_seconds', **labels)[1], 1)
+        self.assertEqual(registry.get('dispatcher_is_valid_seconds', **transition_labels)[1], 1)
+        self.assertEqual(registry.get('dispatcher_callback_seconds', **transition_labels)[1], 1)
+        self.assertEqual(registry.get('dispatcher_persist_seconds', **transition_labels)[1], 1)
+        self.assertEqual(registry.get('dispatcher_transitions_total', **transition_labels), 1)
+        self.assertEqual(received, [
+            'dispatcher_lock_seconds',
+            'dispatcher_is_valid_seconds',
+            'dispatcher_callback_seconds',
+            'dispatcher_persist_seconds',
+            'dispatcher_transitions_total',
+        ])
+
+    def test_noop_and_contention(self):
+        SlowInvalid.delay = 0
+        self.addCleanup(setattr, SlowInvalid, 'delay', 0.2)
+        self.noop_chain.execute()
+
+        other = Chain.objects.get(pk=self.chain.pk)
+        other.lock()
+        with self.assertRaises(ValueError):
+            self.chain.execute()
+
+        self.assertEqual(
+            registry.get('dispatcher_noops_total', chain_type='metrics_noop_chain', state=NEW), 1)
+        self.assertEqual(
+            registry.get('dispatcher_lock_contention_total', chain_type='metrics_chain', state=NEW), 1)
+        self.assertIn('dispatcher_noops_total{chain_type="metrics_noop_chain",state="new"} 1', registry.render())
+
+    def test_resolve(self):
+        dispatcher = Dispatcher({'chains': [
+            {'chain_type': 'metrics_chain', 'transitions': {NEW: [Step1]}},
+        ]})
+        registry.clear()
+        dispatcher.get_or_create_resource_chain('metrics_chain', [('rsc', '2')])
+        dispatcher.get_or_create_resource_chain('metrics_chain', [('rsc', '2')], can_be_subset=True)
+        self.assertEqual(registry.get(
+            'dispatcher_resolve_seconds', chain_type='metrics_chain', match='exact')[1], 1)
+        self.assertEqual(registry.get(
+            'dispatcher_resolve_seconds', chain_type='metrics_chain', match='subset')[1], 1)
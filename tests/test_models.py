@@ -0,0 +1,290 @@
+import datetime
+
+import mock
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from dispatcher import Dispatcher
+from dispatcher.constants import DONE, NEW
+from dispatcher.models import Chain, ChainEvent
+from tests.fixtures import (
+    Done, Later, Step1, Step2, T1, T2, T3, T4,
+)
+
+dispatcher_config = {'chains': [{
+    'chain_type': 'sample_chain',
+    'transitions': {
+        NEW: [T1, T2],
+        T1.final_state: [T3],
+        T2.final_state: [T4],
+    }
+}]}
+
+
+class ClaimDueTest(TestCase):
+
+    def setUp(self):
+        self.dispatcher = Dispatcher(dispatcher_config)
+        self.chains = [
+            self.dispatcher.get_or_create_resource_chain('sample_chain', [('rsc', str(i))])
+            for i in range(5)
+        ]
+
+    def test_claim_due(self):
+        later = timezone.now() + datetime.timedelta(hours=1)
+        Chain.objects.filter(pk=self.chains[0].pk).update(date_next_update=later)
+        Chain.objects.filter(pk=self.chains[1].pk).update(disabled=True)
+        Chain.objects.filter(pk=self.chains[2].pk).update(
+            is_locked=True,
+            lock_owner='other_worker',
+            lock_expires=timezone.now() + datetime.timedelta(minutes=5),
+        )
+        Chain.objects.filter(pk=self.chains[3].pk).update(chain_type='other_chain')
+        done = self.dispatcher.get_or_create_resource_chain('sample_chain', [('rsc', 'done')])
+        Chain.objects.filter(pk=done.pk).update(state=DONE)
+
+        self.assertEqual(Chain.objects.claim_due(10, chain_types=['nope']), [])
+
+        claimed = Chain.objects.claim_due(10, chain_types=['sample_chain'])
+        self.assertEqual(claimed, [self.chains[4]])
+        self.assertTrue(claimed[0].is_locked)
+
+        # already claimed, so other workers don't get it
+        self.assertEqual(Chain.objects.claim_due(10), [self.chains[3]])
+        self.assertEqual(Chain.objects.claim_due(10), [])
+
+    def test_claim_due_limit(self):
+        first = Chain.objects.claim_due(2)
+        second = Chain.objects.claim_due(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 2)
+        self.assertFalse(set(first) & set(second))
+
+    def test_execute_claimed(self):
+        chain = Chain.objects.claim_due(1)[0]
+
+        cb = mock.Mock()
+        chain.execute(callback=cb)
+        cb.assert_called_once()
+
+        chain.refresh_from_db()
+        self.assertFalse(chain.is_locked)
+        self.assertEqual(chain.state, T1.final_state)
+
+    def test_execute_claimed_not_due(self):
+        chain = Chain.objects.claim_due(1)[0]
+        # rescheduled after it was claimed
+        chain.date_next_update = timezone.now() + datetime.timedelta(hours=1)
+
+        with self.assertRaises(ValueError):
+            chain.execute()
+        self.assertFalse(Chain.objects.get(pk=chain.pk).is_locked)
+
+
+class LockTest(TestCase):
+
+    def setUp(self):
+        dispatcher = Dispatcher(dispatcher_config)
+        self.chain = dispatcher.get_or_create_resource_chain('sample_chain', [('rsc', '1')])
+
+    def test_lock(self):
+        other = Chain.objects.get(pk=self.chain.pk)
+
+        self.assertTrue(self.chain.lock())
+        self.assertFalse(other.lock())
+        # renewing our own lock is fine
+        self.assertTrue(self.chain.lock())
+
+        # only the holder releases the lock
+        other.unlock()
+        self.assertTrue(Chain.objects.get(pk=self.chain.pk).is_locked)
+
+        self.chain.unlock()
+        db_chain = Chain.objects.get(pk=self.chain.pk)
+        self.assertFalse(db_chain.is_locked)
+        self.assertIsNone(db_chain.lock_owner)
+        self.assertIsNone(db_chain.lock_expires)
+        self.assertTrue(other.lock())
+
+    def test_execute_locked(self):
+        other = Chain.objects.get(pk=self.chain.pk)
+        other.lock()
+
+        with self.assertRaises(ValueError):
+            self.chain.execute()
+
+    @override_settings(DISPATCHER_LOCK_LEASE=-1)
+    def test_expired_lease(self):
+        other = Chain.objects.get(pk=self.chain.pk)
+
+        # the lease of a dead worker's lock runs out and the lock is taken over
+        self.assertTrue(self.chain.lock())
+        self.assertTrue(other.lock())
+        self.assertEqual(Chain.objects.get(pk=self.chain.pk).lock_owner, other.lock_owner)
+
+        # and it can be claimed again
+        self.assertEqual(Chain.objects.claim_due(10), [self.chain])
+
+    def test_legacy_lock(self):
+        # locked by code predating the leases
+        Chain.objects.filter(pk=self.chain.pk).update(is_locked=True)
+
+        # it's given a lease instead of being taken over
+        self.assertEqual(Chain.objects.claim_due(10), [])
+        self.assertFalse(self.chain.lock())
+        db_chain = Chain.objects.get(pk=self.chain.pk)
+        self.assertTrue(db_chain.is_locked)
+        self.assertIsNotNone(db_chain.lock_expires)
+
+        Chain.objects.filter(pk=self.chain.pk).update(
+            lock_expires=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(Chain.objects.expire_locks(), 1)
+        self.assertEqual(Chain.objects.claim_due(10), [self.chain])
+
+
+class ExecuteWritesTest(TestCase):
+
+    def setUp(self):
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'writes_chain',
+            'transitions': {
+                NEW: [Step1],
+                Step1.final_state: [Done],
+            },
+        }]})
+        self.chain = dispatcher.get_or_create_resource_chain('writes_chain', [('rsc', '1')])
+
+    def writes(self, queries):
+        return [
+            query['sql'].split()[0] for query in queries
+            if query['sql'].split()[0] in ('INSERT', 'UPDATE', 'DELETE')
+        ]
+
+    def test_transition(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.chain.execute(callback=mock.Mock(), requested_by='test')
+
+        # lock, then the new state and unlock at once, and the event
+        self.assertEqual(self.writes(queries), ['UPDATE', 'UPDATE', 'INSERT'])
+
+        db_chain = Chain.objects.get(pk=self.chain.pk)
+        self.assertEqual(db_chain.state, Step1.final_state)
+        self.assertFalse(db_chain.is_locked)
+        self.assertIsNone(db_chain.lock_owner)
+        self.assertEqual(
+            list(db_chain.events.values_list('action', 'value', 'requested_by')),
+            [('state_transition', Step1.final_state, 'test')],
+        )
+
+    def test_done(self):
+        Chain.objects.filter(pk=self.chain.pk).update(state=Step1.final_state)
+        self.chain.refresh_from_db()
+
+        with CaptureQueriesContext(connection) as queries:
+            self.chain.execute()
+        self.assertEqual(self.writes(queries), ['UPDATE', 'UPDATE'])
+
+        db_chain = Chain.objects.get(pk=self.chain.pk)
+        self.assertEqual(db_chain.state, DONE)
+        self.assertFalse(db_chain.is_locked)
+
+    def test_lost_lock(self):
+        def steal_lock(transition):
+            Chain.objects.filter(pk=self.chain.pk).update(lock_owner='other_worker')
+
+        with self.assertRaises(Exception):
+            self.chain.execute(callback=steal_lock)
+
+        db_chain = Chain.objects.get(pk=self.chain.pk)
+        self.assertEqual(db_chain.state, NEW)
+        self.assertEqual(db_chain.lock_owner, 'other_worker')
+        self.assertFalse(ChainEvent.objects.filter(chain=self.chain).exists())
+
+    def test_lost_lock_done(self):
+        Chain.objects.filter(pk=self.chain.pk).update(state=Step1.final_state)
+        self.chain.refresh_from_db()
+        find_transition = Chain.find_transition
+
+        def steal_lock(chain, *args):
+            Chain.objects.filter(pk=chain.pk).update(lock_owner='other_worker')
+            return find_transition(chain, *args)
+
+        with mock.patch.object(Chain, 'find_transition', steal_lock):
+            with self.assertRaises(ValueError):
+                self.chain.execute()
+        self.assertEqual(Chain.objects.get(pk=self.chain.pk).state, Step1.final_state)
+
+    def test_rolled_back(self):
+        with mock.patch.object(Chain, 'log_event', side_effect=ValueError('Sink unavailable')):
+            with self.assertRaises(Exception):
+                self.chain.execute(callback=mock.Mock())
+
+        # the lock is released and the instance left as it was
+        db_chain = Chain.objects.get(pk=self.chain.pk)
+        self.assertEqual(db_chain.state, NEW)
+        self.assertFalse(db_chain.is_locked)
+        self.assertEqual(self.chain.state, NEW)
+
+        result = self.chain.execute(callback=mock.Mock())
+        self.assertEqual(result['chain']['state'], Step1.final_state)
+
+
+class ExecuteStepsTest(TestCase):
+
+    def setUp(self):
+        self.dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'steps_chain',
+            'transitions': {
+                NEW: [Step1],
+                Step1.final_state: [Step2],
+                Step2.final_state: [Later],
+                Later.final_state: [Done],
+            },
+        }]})
+        self.chain = self.dispatcher.get_or_create_resource_chain('steps_chain', [('rsc', '1')])
+
+    def events(self):
+        return list(self.chain.events.order_by('pk').values_list('value', flat=True))
+
+    def test_max_steps(self):
+        cb = mock.Mock()
+        with CaptureQueriesContext(connection) as queries:
+            result = self.chain.execute(callback=cb, max_steps=2)
+
+        self.assertEqual(result['steps'], 2)
+        self.assertEqual(result['transition']['final_state'], Step2.final_state)
+        self.assertEqual(cb.call_count, 2)
+        # a single lock, a write per step and the events together
+        writes = [q['sql'].split()[0] for q in queries if q['sql'].split()[0] in ('UPDATE', 'INSERT')]
+        self.assertEqual(writes, ['UPDATE', 'UPDATE', 'UPDATE', 'INSERT'])
+
+        db_chain = Chain.objects.get(pk=self.chain.pk)
+        self.assertEqual(db_chain.state, Step2.final_state)
+        self.assertFalse(db_chain.is_locked)
+        self.assertEqual(self.events(), [Step1.final_state, Step2.final_state])
+
+    def test_until_stable(self):
+        # stops once the next update is scheduled for later
+        result = self.chain.execute(callback=mock.Mock(), until_stable=True)
+        self.assertEqual(result['steps'], 3)
+        self.assertEqual(Chain.objects.get(pk=self.chain.pk).state, Later.final_state)
+        self.assertEqual(self.events(), [Step1.final_state, Step2.final_state, Later.final_state])
+
+    def test_stable(self):
+        Chain.objects.filter(pk=self.chain.pk).update(state=Step2.final_state)
+        self.chain.refresh_from_db()
+        self.chain.graph.transitions[Step2.final_state] = ()
+        self.addCleanup(self.chain.graph.transitions.__setitem__, Step2.final_state, (Later, ))
+
+        result = self.chain.execute(callback=mock.Mock(), max_steps=5)
+        self.assertIsNone(result['transition'])
+        self.assertEqual(result['steps'], 0)
+
+    def test_single_step(self):
+        result = self.chain.execute(callback=mock.Mock())
+        self.assertEqual(result['steps'], 1)
+        self.assertEqual(Chain.objects.get(pk=self.chain.pk).state, Step1.final_state)
+
+        with self.assertRaises(ValueError):
+            self.chain.execute(max_steps=0)
@@ -0,0 +1,126 @@
+import datetime
+
+import mock
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+from dispatcher import Dispatcher
+from dispatcher.constants import NEW
+from dispatcher.models import Chain, PendingCallback
+from dispatcher.outbox import drain, get_backoff
+from tests.fixtures import Step1, Step2
+
+calls = []
+
+
+def record_callback(transition, **kwargs):
+    calls.append((transition, kwargs))
+
+
+def failing_callback(transition, **kwargs):
+    raise ValueError('Service unavailable')
+
+
+class OutboxTest(TestCase):
+
+    def setUp(self):
+        del calls[:]
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'outbox_chain',
+            'transitions': {
+                NEW: [Step1],
+                Step1.final_state: [Step2],
+            },
+        }]})
+        self.chain = dispatcher.get_or_create_resource_chain('outbox_chain', [('booking', '1')])
+
+    def test_execute(self):
+        results = self.chain.execute(
+            outbox=True,
+            callback=record_callback,
+            callback_kwargs={'template': 'reminder'},
+            initial_context={'booking_id': 1},
+        )
+        self.assertEqual(results['chain']['state'], Step1.final_state)
+        self.assertEqual(calls, [])
+
+        chain = Chain.objects.get(pk=self.chain.pk)
+        self.assertEqual(chain.state, Step1.final_state)
+        self.assertFalse(chain.is_locked)
+        pending_callback = PendingCallback.objects.get(chain=chain)
+        self.assertEqual(pending_callback.transition, 'tests.fixtures.Step1')
+        self.assertEqual(pending_callback.callback, 'tests.test_outbox.record_callback')
+
+        self.assertEqual(drain(max_workers=1), {'done': 1, 'retry': 0, 'failed': 0})
+        [(transition, kwargs)] = calls
+        self.assertIsInstance(transition, Step1)
+        self.assertEqual(transition.context, {'booking_id': 1})
+        self.assertEqual(transition.idempotency_key, pending_callback.idempotency_key)
+        self.assertEqual(kwargs, {'template': 'reminder'})
+        self.assertFalse(PendingCallback.objects.exists())
+
+    def test_execute_steps(self):
+        self.chain.execute(outbox=True, callback=record_callback, until_stable=True)
+        self.assertEqual(Chain.objects.get(pk=self.chain.pk).state, Step2.final_state)
+        self.assertEqual(
+            list(PendingCallback.objects.order_by('pk').values_list('transition', flat=True)),
+            ['tests.fixtures.Step1', 'tests.fixtures.Step2'],
+        )
+
+    def test_not_importable(self):
+        with self.assertRaises(ValueError):
+            self.chain.execute(outbox=True, callback=lambda transition: None)
+        self.assertFalse(Chain.objects.get(pk=self.chain.pk).is_locked)
+        self.assertFalse(PendingCallback.objects.exists())
+
+    def test_committed_with_state(self):
+        with mock.patch.object(Chain, '_update_locked', return_value=None):
+            with self.assertRaises(Exception):
+                self.chain.execute(outbox=True, callback=record_callback)
+        self.assertFalse(PendingCallback.objects.exists())
+
+    def test_retry(self):
+        self.chain.execute(outbox=True, callback=failing_callback)
+
+        self.assertEqual(drain(max_workers=1), {'done': 0, 'retry': 1, 'failed': 0})
+        pending_callback = PendingCallback.objects.get()
+        self.assertEqual(pending_callback.attempts, 1)
+        self.assertIn('Service unavailable', pending_callback.last_error)
+        self.assertIsNone(pending_callback.lock_owner)
+        self.assertGreater(pending_callback.date_next_attempt, timezone.now() + datetime.timedelta(seconds=20))
+
+        # not due again until the backoff is over
+        self.assertEqual(drain(max_workers=1), {'done': 0, 'retry': 0, 'failed': 0})
+
+        PendingCallback.objects.update(date_next_attempt=timezone.now())
+        with override_settings(DISPATCHER_OUTBOX={'MAX_ATTEMPTS': 2}):
+            self.assertEqual(drain(max_workers=1), {'done': 0, 'retry': 0, 'failed': 1})
+        self.assertTrue(PendingCallback.objects.get().failed)
+        self.assertFalse(PendingCallback.objects.due().exists())
+
+    def test_claim(self):
+        self.chain.execute(outbox=True, callback=record_callback)
+
+        claimed = PendingCallback.objects.claim(10)
+        self.assertEqual(len(claimed), 1)
+        # leased until the lock lease runs out
+        self.assertEqual(PendingCallback.objects.claim(10), [])
+
+        PendingCallback.objects.update(lock_expires=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(len(PendingCallback.objects.claim(10)), 1)
+
+    @override_settings(DISPATCHER_OUTBOX={'BACKOFF': 10, 'MAX_BACKOFF': 60})
+    def test_backoff(self):
+        self.assertEqual(
+            [get_backoff(attempts).total_seconds() for attempts in range(1, 6)],
+            [10, 20, 40, 60, 60],
+        )
+
+    def test_command(self):
+        self.chain.execute(outbox=True, callback=record_callback)
+
+        out = StringIO()
+        call_command('dispatcher_drain_outbox', max_workers=1, stdout=out)
+        self.assertIn('Ran 1 callbacks: 0 failed and will be retried, 0 gave up', out.getvalue())
+        self.assertEqual(len(calls), 1)
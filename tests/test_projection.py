@@ -0,0 +1,86 @@
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils.six import StringIO
+from dispatcher import Dispatcher, Transition
+from dispatcher.constants import NEW
+from dispatcher.models import Chain, ChainEvent
+from dispatcher.projection import OTHER, ErrorCollector, format_report, project
+
+
+class OddOnly(Transition):
+
+    final_state = 'odd'
+
+    def is_valid(self):
+        if self.chain.pk % 2:
+            return True
+        self.errors.append('even chain')
+        return False
+
+
+dispatcher_config = {'chains': [{
+    'chain_type': 'projection_chain',
+    'transitions': {NEW: [OddOnly]},
+}]}
+
+
+class ProjectionTest(TestCase):
+
+    def setUp(self):
+        dispatcher = Dispatcher(dispatcher_config)
+        self.chains = dispatcher.get_or_create_resource_chains([
+            ('projection_chain', [('rsc', str(i))]) for i in range(10)
+        ])
+        self.odd = [chain.pk for chain in self.chains if chain.pk % 2]
+
+    def test_project(self):
+        with self.assertNumQueries(1):
+            report = project(Chain.objects.filter(chain_type='projection_chain'), chunk_size=3)
+
+        self.assertEqual(report['chains'], 10)
+        self.assertEqual(report['moves'], [
+            {'from': NEW, 'to': 'odd', 'transition': 'OddOnly', 'count': len(self.odd)},
+        ])
+        self.assertEqual(dict(report['blocked']), {NEW: 10 - len(self.odd)})
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual(report['errors'][0]['reason'], '<OddOnly>: even chain')
+        self.assertEqual(report['errors'][0]['count'], 10 - len(self.odd))
+        self.assertEqual(len(report['errors'][0]['chain_ids']), 5)
+
+        self.assertIn(
+            '%s chains would move from new to odd (OddOnly)' % len(self.odd),
+            format_report(report),
+        )
+
+        # nothing was locked or written
+        self.assertFalse(Chain.objects.filter(is_locked=True).exists())
+        self.assertFalse(Chain.objects.exclude(state=NEW).exists())
+        self.assertFalse(ChainEvent.objects.exists())
+
+    @override_settings(DISPATCHER_CONFIG=dispatcher_config)
+    def test_command(self):
+        out = StringIO()
+        call_command('dispatcher_run', '--project', stdout=out)
+        self.assertIn('10 chains checked', out.getvalue())
+        self.assertFalse(Chain.objects.exclude(state=NEW).exists())
+
+    def test_errors_per_chain(self):
+        # the errors of one chain don't leak into the others
+        even = Chain.objects.get(pk=next(c.pk for c in self.chains if not c.pk % 2))
+        odd = Chain.objects.get(pk=self.odd[0])
+        even.find_transition(None)
+        odd.find_transition(None)
+        self.assertEqual(even.errors, {'<OddOnly>': ['even chain']})
+        self.assertEqual(odd.errors, {})
+
+
+class ErrorCollectorTest(TestCase):
+
+    def test_bounded(self):
+        errors = ErrorCollector(max_reasons=2, max_samples=2)
+        for i in range(10):
+            errors.add('reason %s' % (i % 4), i)
+
+        self.assertEqual(len(errors.counts), 3)
+        self.assertEqual(errors.top(1), [{'reason': OTHER, 'count': 4, 'chain_ids': [2, 3]}])
+        self.assertEqual(errors.counts['reason 0'], 3)
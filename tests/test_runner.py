@@ -0,0 +1,168 @@
+import datetime
+import threading
+import time
+from unittest import skipIf
+
+import mock
+from django.core.management import call_command
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+from dispatcher import Dispatcher
+from dispatcher.constants import NEW
+from dispatcher.models import Chain
+from dispatcher.runner import run_chains
+from tests.fixtures import (
+    Prefetching, Step1, Step2,
+)
+
+dispatcher_config = {'chains': [{
+    'chain_type': 'sample_chain',
+    'transitions': {
+        NEW: [Step1],
+        Step1.final_state: [Step2],
+    }
+}]}
+
+
+def noop_callback(transition):
+    pass
+
+
+class RunChainsTest(TransactionTestCase):
+
+    def setUp(self):
+        self.dispatcher = Dispatcher(dispatcher_config)
+        self.chains = self.dispatcher.get_or_create_resource_chains([
+            ('sample_chain', [('rsc', str(i))]) for i in range(6)
+        ])
+
+    def test_thread_executor(self):
+        Chain.objects.filter(pk=self.chains[0].pk).update(
+            is_locked=True,
+            lock_owner='other_worker',
+            lock_expires=timezone.now() + datetime.timedelta(minutes=5),
+        )
+
+        cb = mock.Mock()
+        results = run_chains(self.chains, max_workers=3, callback=cb)
+
+        self.assertEqual(results['transitions'], 5)
+        self.assertEqual(results['noops'], 0)
+        self.assertEqual(results['errors'], 1)
+        self.assertEqual(cb.call_count, 5)
+        self.assertEqual(
+            [result['chain_id'] for result in results['results']],
+            [chain.pk for chain in self.chains],
+        )
+        self.assertIn('Chain is locked', results['results'][0]['error'])
+        self.assertEqual(
+            Chain.objects.filter(state=Step1.final_state, is_locked=False).count(), 5)
+
+        # nothing left to transition to from step2_done
+        run_chains(self.chains[1:], callback=cb)
+        results = run_chains(self.chains[1:], callback=cb)
+        self.assertEqual(results['noops'], 5)
+
+    @skipIf(connection.vendor == 'sqlite', 'in-memory sqlite is not shared with child processes')
+    def test_process_executor(self):
+        results = run_chains(self.chains, executor='process', max_workers=2, callback=noop_callback)
+        self.assertEqual(results['transitions'], 6)
+        self.assertEqual(Chain.objects.filter(state=Step1.final_state).count(), 6)
+
+    def test_prefetch(self):
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'prefetch_chain',
+            'transitions': {NEW: [Prefetching]},
+        }]})
+        chains = dispatcher.get_or_create_resource_chains([
+            ('prefetch_chain', [('rsc', str(i))]) for i in range(6)
+        ])
+        del Prefetching.prefetch_calls[:]
+
+        results = run_chains(self.chains + chains, max_workers=2)
+        # once for the whole batch, only with the chains in its source state
+        self.assertEqual(Prefetching.prefetch_calls, [sorted(chain.pk for chain in chains)])
+        self.assertEqual(results['transitions'], 9)
+        self.assertEqual(results['noops'], 3)
+        self.assertEqual(
+            set(Chain.objects.filter(state=Prefetching.final_state).values_list('pk', flat=True)),
+            {chain.pk for chain in chains if chain.pk % 2},
+        )
+
+    def test_prefetch_failed(self):
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'prefetch_chain',
+            'transitions': {NEW: [Prefetching]},
+        }]})
+        chains = dispatcher.get_or_create_resource_chains([
+            ('prefetch_chain', [('rsc', str(i))]) for i in range(2)
+        ])
+
+        with mock.patch.object(Prefetching, 'prefetch', side_effect=Exception('down')):
+            results = run_chains(self.chains + chains, max_workers=2)
+        # the other chains go on, Prefetching's ones just find nothing
+        self.assertEqual(results['transitions'], 6)
+        self.assertEqual(results['noops'], 2)
+        self.assertEqual(results['errors'], 0)
+        self.assertFalse(Chain.objects.filter(is_locked=True).exists())
+
+    def test_max_concurrency(self):
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'limited_chain',
+            'transitions': {NEW: [Step1]},
+            'max_concurrency': 1,
+        }]})
+        chains = dispatcher.get_or_create_resource_chains([
+            ('limited_chain', [('rsc', str(i))]) for i in range(3)
+        ])
+
+        lock = threading.Lock()
+        running = []
+        concurrency = []
+
+        def callback(transition):
+            with lock:
+                running.append(transition)
+                concurrency.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(transition)
+
+        results = run_chains(chains, max_workers=3, callback=callback)
+        self.assertEqual(results['transitions'], 3)
+        self.assertEqual(max(concurrency), 1)
+        self.assertGreater(results['waits']['limited_chain']['concurrency'], 0)
+        self.assertEqual(results['waits']['limited_chain']['rate_limit'], 0)
+
+    def test_invalid_executor(self):
+        with self.assertRaises(ValueError):
+            run_chains(self.chains, executor='fibers')
+
+    @override_settings(DISPATCHER_CONFIG=dispatcher_config)
+    def test_command(self):
+        Chain.objects.filter(pk=self.chains[0].pk).update(disabled=True)
+
+        out = StringIO()
+        call_command('dispatcher_run', batch_size=2, stdout=out)
+        self.assertIn('Executed 5 chains: 5 transitions, 0 no-ops, 0 errors', out.getvalue())
+
+        # chains without a valid transition are only executed once per run
+        out = StringIO()
+        call_command('dispatcher_run', batch_size=2, stdout=out)
+        call_command('dispatcher_run', batch_size=2, stdout=out)
+        self.assertIn('Executed 5 chains: 0 transitions, 5 no-ops, 0 errors', out.getvalue())
+        self.assertFalse(Chain.objects.filter(is_locked=True).exists())
+
+    @override_settings(DISPATCHER_CONFIG=dispatcher_config)
+    def test_command_queue(self):
+        tomorrow = timezone.now() + datetime.timedelta(days=1)
+        Chain.objects.update(date_next_update=tomorrow)
+        self.dispatcher.notify('rsc', '1')
+
+        out = StringIO()
+        call_command('dispatcher_run', '--queue', batch_size=2, stdout=out)
+        self.assertIn('Executed 1 chains: 1 transitions, 0 no-ops, 0 errors', out.getvalue())
+        self.assertEqual(Chain.objects.get(resources__resource_id='1').state, Step1.final_state)
+        self.assertFalse(Chain.objects.filter(queued__isnull=False).exists())
@@ -0,0 +1,102 @@
+import mock
+from django.test import SimpleTestCase
+from dispatcher import Dispatcher
+from dispatcher.constants import NEW
+from dispatcher.graph import ChainGraph
+from dispatcher.scheduler import (
+    CONCURRENCY, RATE_LIMIT, ChainTypeLimits, Scheduler, TokenBucket,
+)
+from tests.fixtures import Step1
+
+
+def make_chains(chain_type, count, **limits):
+    graph = ChainGraph(chain_type, {NEW: [Step1]}, limits=ChainTypeLimits(**limits))
+    return [mock.Mock(chain_type=chain_type, graph=graph, pk='%s-%s' % (chain_type, i)) for i in range(count)]
+
+
+class TokenBucketTest(SimpleTestCase):
+
+    def test_take(self):
+        bucket = TokenBucket(2, burst=2, now=0)
+        self.assertTrue(bucket.take(0))
+        self.assertTrue(bucket.take(0))
+        self.assertFalse(bucket.take(0))
+        self.assertEqual(bucket.wait_time(0), 0.5)
+
+        self.assertTrue(bucket.take(0.5))
+        # saved up tokens are capped by the burst
+        self.assertEqual(bucket.wait_time(100), 0)
+        self.assertEqual(bucket.tokens, 2)
+
+
+@mock.patch('dispatcher.scheduler.default_timer', return_value=0)
+class SchedulerTest(SimpleTestCase):
+
+    def take_all(self, scheduler):
+        chains = []
+        while True:
+            item, _ = scheduler.next()
+            if item is None:
+                return chains
+            chains.append(item[1])
+
+    def test_weights(self, timer):
+        heavy = make_chains('heavy', 8, weight=3)
+        light = make_chains('light', 8)
+        scheduler = Scheduler(heavy + light)
+
+        chain_types = [chain.chain_type for chain in self.take_all(scheduler)[:8]]
+        self.assertEqual(chain_types.count('heavy'), 6)
+        self.assertEqual(chain_types.count('light'), 2)
+        self.assertFalse(scheduler.pending)
+
+    def test_max_concurrency(self, timer):
+        chains = make_chains('limited', 3, max_concurrency=2)
+        scheduler = Scheduler(chains)
+
+        self.assertEqual(self.take_all(scheduler), chains[:2])
+        self.assertEqual(scheduler.next(), (None, None))
+
+        timer.return_value = 4
+        scheduler.done(chains[0])
+        self.assertEqual(scheduler.next(), ((2, chains[2]), None))
+        self.assertEqual(scheduler.waits(), {'limited': {CONCURRENCY: 4, RATE_LIMIT: 0}})
+
+    def test_max_in_flight(self, timer):
+        chains = make_chains('unlimited', 3)
+        scheduler = Scheduler(chains, max_in_flight=1)
+
+        self.assertEqual(self.take_all(scheduler), chains[:1])
+        scheduler.done(chains[0])
+        self.assertEqual(self.take_all(scheduler), chains[1:2])
+
+    def test_rate_limit(self, timer):
+        limited = make_chains('limited', 2, rate_limit=0.5)
+        other = make_chains('other', 1)
+        scheduler = Scheduler(limited + other)
+
+        # the rate limit doesn't hold back the other types
+        self.assertEqual(self.take_all(scheduler), [limited[0], other[0]])
+        self.assertEqual(scheduler.next(), (None, 2))
+
+        timer.return_value = 2
+        self.assertEqual(scheduler.next(), ((1, limited[1]), None))
+        self.assertEqual(scheduler.next(), (None, None))
+        self.assertEqual(scheduler.waits()['limited'], {CONCURRENCY: 0, RATE_LIMIT: 2})
+        self.assertEqual(scheduler.waits()['other'], {CONCURRENCY: 0, RATE_LIMIT: 0})
+
+    def test_config(self, timer):
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'limited_chain',
+            'transitions': {NEW: [Step1]},
+            'max_concurrency': 2,
+            'rate_limit': 10,
+            'weight': 2,
+        }]})
+        limits = dispatcher.graphs['limited_chain'].limits
+        self.assertEqual((limits.max_concurrency, limits.rate_limit, limits.weight), (2, 10, 2))
+
+        for invalid in ({'max_concurrency': 0}, {'rate_limit': 0}, {'burst': 0.5}, {'weight': 0}):
+            config = dict({'chain_type': 'limited_chain', 'transitions': {NEW: [Step1]}}, **invalid)
+            with self.assertRaises(ValueError):
+                Dispatcher({'chains': [config]})
@@ -1,10 +1,15 @@
+import datetime
+import time
+
 import mock
 from django.test import TestCase
 from django.conf import settings
+from django.utils import timezone
 from dispatcher import Dispatcher
 from dispatcher.constants import NEW
+from dispatcher.models import Chain
 from tests.fixtures import (
-    T1, T2, T3, T4,
+    T1, T2, T3, T4, InFourHours, Later, SlowInvalid, SlowValid, FastValid,
 )
 
 dispatcher_config = {'chains': [{
@@ -139,3 +144,59 @@ class TransitionTest(TestCase):
         chain.execute(callback=cb1)
         self.assertEqual(chain.state, NEW)
         cb1.assert_not_called()
+
+    def test_concurrent_checks(self):
+        """
+        The candidates are checked at the same time, but the first valid one
+        in config order still wins
+        """
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'slow_chain',
+            'transitions': {
+                NEW: [SlowInvalid, SlowValid, FastValid],
+            }
+        }]})
+        chain = dispatcher.get_or_create_resource_chain('slow_chain', [('rsc1', '123')])
+
+        start = time.time()
+        transition = chain.find_transition(None, concurrent=True)
+        self.assertLess(time.time() - start, 0.35)
+        self.assertIsInstance(transition, SlowValid)
+        self.assertEqual(chain.errors['<SlowInvalid>'], ['<SlowInvalid> is not valid'])
+        self.assertNotIn('<FastValid>', chain.errors)
+
+        chain.execute(concurrent=True)
+        self.assertEqual(chain.state, SlowValid.final_state)
+
+
+class NextUpdateTest(TestCase):
+
+    def setUp(self):
+        dispatcher = Dispatcher({'chains': [{
+            'chain_type': 'scheduled_chain',
+            'transitions': {NEW: [InFourHours]},
+        }]})
+        self.chain = dispatcher.get_or_create_resource_chain('scheduled_chain', [('rsc', '1')])
+
+    def test_delay_and_jitter(self):
+        before = timezone.now()
+        self.chain.execute(callback=mock.Mock())
+        after = timezone.now()
+
+        next_update = Chain.objects.get(pk=self.chain.pk).date_next_update
+        self.assertGreaterEqual(next_update, before + InFourHours.next_update_delay)
+        self.assertLessEqual(
+            next_update,
+            after + InFourHours.next_update_delay + InFourHours.next_update_jitter,
+        )
+        # not due before then
+        self.assertFalse(Chain.objects.due().filter(pk=self.chain.pk).exists())
+        self.assertTrue(Chain.objects.due(until=next_update).filter(pk=self.chain.pk).exists())
+        with self.assertRaises(ValueError):
+            self.chain.execute()
+
+    def test_date(self):
+        # a date is the start of that day
+        next_update = Later(self.chain).get_date_next_update()
+        self.assertEqual(timezone.localtime(next_update).date(), datetime.date.today() + datetime.timedelta(days=1))
+        self.assertEqual(timezone.localtime(next_update).time(), datetime.time())